@@ -0,0 +1,75 @@
+"""
+Compare per-message regexp compilation with precompiled ruleset
+
+    python benchmarks/bench_dynamic_filters.py [--count 2000]
+"""
+import argparse
+import random
+import re
+import time
+
+from critical.manipulator.matchers import RegexpRuleset
+from generator import GELFGenerator
+
+PATTERN_COUNTS = (10, 100, 300)
+
+
+def patterns(count: int, seed: int = 0) -> list:
+    """Mix of regexps, literals and invalid regexps as typed in chats"""
+    rnd = random.Random(seed)
+    result = []
+    for index in range(count):
+        kind = rnd.random()
+        if kind < 0.6:
+            result.append(rf'GigabitEthernet\d+/{index}\b.*down')
+        elif kind < 0.9:
+            result.append(f'sw-{index:04d}.example.net')
+        else:
+            result.append(f'vlan [{index}')
+    return result
+
+
+def naive_filter(message: str, patterns_: set) -> bool:
+    """RedisExcludeRegexp.filter before rulesets"""
+    hit = False
+    for pattern in patterns_:
+        try:
+            regexp = re.compile(pattern)
+        except re.error:
+            hit = pattern in message
+        else:
+            hit = regexp.search(message) is not None
+        if hit:
+            break
+    return hit
+
+
+def rate(function, messages) -> float:
+    start = time.perf_counter()
+    for message in messages:
+        function(message)
+    return len(messages) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=2000)
+    args = parser.parse_args()
+
+    generator = GELFGenerator()
+    messages = [generator.message_dict()['full_message']
+                for _ in range(args.count)]
+    print(f'{"patterns":<10}{"naive msg/s":>14}{"ruleset msg/s":>16}'
+          f'{"speedup":>10}')
+    for count in PATTERN_COUNTS:
+        patterns_ = set(patterns(count))
+        ruleset = RegexpRuleset(patterns_)
+        naive = rate(lambda message: naive_filter(message, patterns_),
+                     messages)
+        compiled = rate(ruleset.search, messages)
+        print(f'{count:<10}{naive:>14.0f}{compiled:>16.0f}'
+              f'{compiled / naive:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
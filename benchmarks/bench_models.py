@@ -0,0 +1,56 @@
+"""
+Compare GELF message representations: decoding throughput and memory
+
+    python benchmarks/bench_models.py [--count 20000]
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+from critical.manipulator.decoders import get_decoder
+from generator import GELFGenerator
+
+DECODINGS = ('full', 'lazy', 'compact')
+# fields touched by typical handler: IP filter, body filter, formatter
+FIELDS = frozenset({'_gl2_remote_ip', 'short_message'})
+
+
+def touch(message):
+    return message.gl2_remote_ip_, message.short_message
+
+
+def throughput(decoder, values) -> float:
+    start = time.perf_counter()
+    for value in values:
+        touch(decoder(value))
+    return len(values) / (time.perf_counter() - start)
+
+
+def memory(decoder, values) -> float:
+    gc.collect()
+    tracemalloc.start()
+    messages = [decoder(value) for value in values]
+    for message in messages:
+        touch(message)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=20000)
+    args = parser.parse_args()
+
+    values = GELFGenerator().values(args.count)
+    print(f'{"decoding":<10}{"msg/s":>12}{"bytes/msg":>12}')
+    for decoding in DECODINGS:
+        decoder = get_decoder(decoding, FIELDS)
+        rate = throughput(decoder, values)
+        size = memory(decoder, values)
+        print(f'{decoding:<10}{rate:>12.0f}{size:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Per-component throughput and latency of the manipulator pipeline,
+results can be saved as baseline and compared with later runs
+
+    python benchmarks/bench_pipeline.py [--count 20000]
+        [--save baseline.json] [--compare baseline.json] [--tolerance 0.2]
+"""
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import sys
+import time
+from typing import Callable, List
+
+from critical.manipulator.consumers import AbstractAsyncConsumer
+from critical.manipulator.decoders import get_decoder
+from critical.manipulator.formatters import (CopyFieldFormatter,
+                                             SimpleMailFormatter,
+                                             TemplateFormatter)
+from critical.manipulator.handler import Handler
+from critical.manipulator.senders import DummySender
+from critical.manipulator.static_filters import (MessageBodyAnyFilter,
+                                                 MessageBodyFilter,
+                                                 SourceIPFilter)
+from generator import GELFGenerator
+
+# per-message latency is sampled on part of messages only
+LATENCY_SAMPLES = 2000
+
+
+class MemoryAsyncConsumer(AbstractAsyncConsumer):
+    def __init__(self, values: List[bytes], decoder: Callable,
+                 batch_size: int = 500):
+        """
+        Consumer replaying raw record values from memory
+        :param values: raw Kafka record values
+        :param decoder: same as for KafkaAsyncConsumer
+        :param batch_size: messages per batch
+        """
+        self.values = values
+        self.decoder = decoder
+        self.batch_size = batch_size
+        self.position = 0
+
+    async def consume(self):
+        batch = await self.consume_batch()
+        return batch[0] if batch else None
+
+    async def consume_batch(self):
+        values = self.values[self.position:self.position + self.batch_size]
+        self.position += len(values)
+        if not values:
+            self.exhausted = True
+        return [self.decoder(value) for value in values]
+
+    @classmethod
+    def from_dict(cls, settings: dict):
+        return cls(**settings)
+
+
+def static_filters() -> dict:
+    return {
+        'SourceIPFilter/prefixes': SourceIPFilter(
+            prefixes=['10.0.0.0/14', '10.8.0.0/15', '192.168.0.0/16']),
+        'SourceIPFilter/ips': SourceIPFilter(
+            ips=[f'10.{i % 16}.0.{i}' for i in range(200)]),
+        'MessageBodyFilter': MessageBodyFilter('changed state to down'),
+        'MessageBodyAnyFilter': MessageBodyAnyFilter(
+            [f'GigabitEthernet0/{port},' for port in range(1, 25)]
+            + ['NO_IGMP_QUERIER', 'SSH_CLIENT']),
+    }
+
+
+def formatters() -> dict:
+    return {
+        'CopyFieldFormatter': CopyFieldFormatter('short_message'),
+        'SimpleMailFormatter': SimpleMailFormatter('host', 'full_message'),
+        'TemplateFormatter': TemplateFormatter(
+            '{host} ({_gl2_remote_ip}): {short_message}'),
+    }
+
+
+def measure(function: Callable, items: list) -> dict:
+    """
+    :return: messages per second over all items, per-message latency
+    percentiles over a sample of them
+    """
+    start = time.perf_counter()
+    for item in items:
+        function(item)
+    elapsed = time.perf_counter() - start
+    latencies = []
+    for item in items[:LATENCY_SAMPLES]:
+        start = time.perf_counter()
+        function(item)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {'msg_per_s': round(len(items) / elapsed),
+            'mean_us': round(elapsed / len(items) * 1e6, 3),
+            'p50_us': round(statistics.median(latencies) * 1e6, 3),
+            'p99_us': round(latencies[int(len(latencies) * 0.99)] * 1e6, 3)}
+
+
+async def end_to_end(values: List[bytes]) -> dict:
+    """Handler fed by MemoryAsyncConsumer, until senders are done"""
+    filters = static_filters()
+    handler = Handler([filters['SourceIPFilter/prefixes'],
+                       filters['MessageBodyFilter']], [],
+                      formatters()['TemplateFormatter'],
+                      [DummySender([1, 2])], 'benchmark', 'benchmark',
+                      decoding='lazy')
+    consumer = MemoryAsyncConsumer(values, handler.decoder)
+    await handler.start()
+    start = time.perf_counter()
+    await consumer.run(handler)
+    await handler.stop()
+    elapsed = time.perf_counter() - start
+    return {'msg_per_s': round(len(values) / elapsed),
+            'mean_us': round(elapsed / len(values) * 1e6, 3)}
+
+
+def run(count: int) -> dict:
+    values = GELFGenerator().values(count)
+    results = {}
+    for decoding in ('full', 'lazy', 'compact'):
+        results[f'decode/{decoding}'] = measure(get_decoder(decoding),
+                                                values)
+    messages = [get_decoder('full')(value) for value in values]
+    for name, filter_ in static_filters().items():
+        results[f'static_filter/{name}'] = measure(filter_.filter, messages)
+    for name, formatter in formatters().items():
+        results[f'formatter/{name}'] = measure(formatter.format, messages)
+    results['handler/end_to_end'] = asyncio.run(end_to_end(values))
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """:return: components slower than baseline by more than tolerance"""
+    regressions = []
+    for name, old in baseline['results'].items():
+        new = results.get(name)
+        if new is None:
+            continue
+        change = new['msg_per_s'] / old['msg_per_s'] - 1
+        mark = ''
+        if change < -tolerance:
+            mark = '  REGRESSION'
+            regressions.append(name)
+        print(f'{name:<42}{old["msg_per_s"]:>12}{new["msg_per_s"]:>12}'
+              f'{change:>+9.1%}{mark}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--save', help='write results to JSON file')
+    parser.add_argument('--compare', help='baseline JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed throughput drop, 0.2 is 20%%')
+    args = parser.parse_args()
+
+    results = run(args.count)
+    print(f'{"component":<42}{"msg/s":>12}{"mean us":>10}'
+          f'{"p50 us":>10}{"p99 us":>10}')
+    for name, result in results.items():
+        percentiles = [f'{result[key]:>10.2f}' if key in result
+                       else f'{"-":>10}' for key in ('p50_us', 'p99_us')]
+        print(f'{name:<42}{result["msg_per_s"]:>12}'
+              f'{result["mean_us"]:>10.2f}{"".join(percentiles)}')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'count': args.count,
+                       'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'results': results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        print(f'{"component":<42}{"baseline":>12}{"current":>12}'
+              f'{"change":>9}')
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
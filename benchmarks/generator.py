@@ -0,0 +1,70 @@
+"""
+Synthetic GELF messages resembling network equipment syslog
+"""
+import datetime
+import json
+import random
+import uuid
+
+MNEMONICS = [
+    '%LINK-3-UPDOWN: Interface GigabitEthernet0/{port}, '
+    'changed state to {state}',
+    '%LINEPROTO-5-UPDOWN: Line protocol on Interface '
+    'GigabitEthernet0/{port}, changed state to {state}',
+    '%SPANTREE-6-INTERFACE_STATE: Port {port} instance 0 moving from '
+    'learning to forwarding',
+    '%IGMPSNOOPING-6-NO_IGMP_QUERIER: No IGMP querier present on vlan {vlan}',
+    '%SECURITY-6-SSH_CLIENT_CONNECTING: SSH client 10.0.{vlan}.{port} '
+    'is connecting',
+    '%SYS-5-CONFIG_I: Configured from console by admin on vty0 '
+    '(10.0.{vlan}.{port})',
+    'Port {port} link {state}',
+    'ETHPORT/4/LINKDOWN(t):Slot=1;Port {port} link is {state}, '
+    'VLAN {vlan} is affected',
+]
+
+
+class GELFGenerator:
+    def __init__(self, seed: int = 0, networks: int = 16):
+        self.random = random.Random(seed)
+        # most traffic comes from few busy devices
+        self.hosts = [(f'sw-{i:04d}.example.net',
+                       f'10.{i % networks}.{i // 256 % 256}.{i % 256}')
+                      for i in range(1024)]
+        self.weights = [1 / (rank + 1) for rank in range(len(self.hosts))]
+
+    def message_dict(self) -> dict:
+        rnd = self.random
+        hostname, ip_address = rnd.choices(self.hosts, self.weights)[0]
+        short = rnd.choice(MNEMONICS).format(
+            port=rnd.randint(1, 48), vlan=rnd.randint(1, 4094),
+            state=rnd.choice(('up', 'down')))
+        now = datetime.datetime.now(datetime.timezone.utc)
+        full = '<190>' + now.strftime('%Y-%m-%d %H:%M:%S') + ' '
+        full += hostname + ' ' + short
+        return {'version': '1.1',
+                'timestamp': now.timestamp(),
+                'host': hostname,
+                'short_message': short,
+                'level': 6,
+                'full_message': full,
+                '_level': 6,
+                '_gl2_remote_ip': ip_address,
+                '_gl2_remote_port': 33333,
+                '_gl2_message_id': uuid.UUID(int=rnd.getrandbits(128)).hex,
+                '_kafka_topic': 'critical-topic',
+                '_source': hostname,
+                '_message': short,
+                '_gl2_source_input': '0123456789abcdef01234567',
+                '_full_message': full,
+                '_facility_num': 23,
+                '_forwarder': 'org.graylog2.outputs.GelfOutput',
+                '_gl2_source_node': str(uuid.UUID(int=rnd.getrandbits(128))),
+                '_id': str(uuid.UUID(int=rnd.getrandbits(128))),
+                '_facility': 'local7',
+                '_timestamp': now.isoformat()}
+
+    def values(self, count: int) -> list:
+        """Raw Kafka record values"""
+        return [json.dumps(self.message_dict()).encode('utf-8')
+                for _ in range(count)]
@@ -4,6 +4,8 @@ from aiogram.filters.command import Command
 from aiogram.fsm.context import FSMContext
 import redis.asyncio as redis
 
+from critical.manipulator.dynamic_filters import INVALIDATION_CHANNEL
+
 router = Router()
 
 
@@ -18,6 +20,7 @@ async def add_pattern(message: types.Message,
     if not result:
         await message.reply('Already ignored')
     else:
+        await redis_instance.publish(INVALIDATION_CHANNEL, key)
         await message.reply(f'Will be ignored from now')
 
 
@@ -32,6 +35,7 @@ async def remove_pattern(message: types.Message,
     if not result:
         await message.reply('Already not ignored')
     else:
+        await redis_instance.publish(INVALIDATION_CHANNEL, key)
         await message.reply('Will not be ignored from now')
 
 
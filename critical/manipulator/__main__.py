@@ -1,13 +1,24 @@
 import asyncio
 from collections import defaultdict
+import copy
 import pathlib
+import signal
+import sys
+from typing import Callable, Dict, List, Optional, Tuple, Union
 import typer
 from typing_extensions import Annotated
 import yaml
 
-from .consumers import KafkaAsyncConsumer, AbstractAsyncConsumer
-from .handler import Handler
+from critical.manipulator import consumers
+
+from .consumers import KafkaAsyncConsumer
+from .handler import Handler, HandlerGroup
 from .loggers import customize_logger, main_logger
+from .metrics import serve_metrics
+from .profiling import (end_to_end, format_report, load_values,
+                        profile_stages, stub_config)
+from .reload import AnyTarget, ConfigWatcher, ReloadableHandler
+from .supervisor import Supervisor
 
 
 LOGGING_LEVELS = defaultdict(lambda: 'DEBUG',
@@ -15,21 +26,151 @@ LOGGING_LEVELS = defaultdict(lambda: 'DEBUG',
                               1: 'WARNING',
                               2: 'INFO',
                               3: 'DEBUG'})
+CONFIG_SUFFIXES = ('.yaml', '.yml')
 
 
 def typer_main():
+    if sys.argv[1:2] == ['profile']:
+        app = typer.Typer(add_completion=False)
+        app.command()(profile)
+        app(args=sys.argv[2:], prog_name='critical profile')
+        return
     typer.run(main)
 
 
-def main(config: Annotated[pathlib.Path, typer.Argument()],
+def profile(config: Annotated[pathlib.Path, typer.Argument(
+                help='Handler config')],
+            sample: Annotated[pathlib.Path, typer.Argument(
+                help='Captured messages, NDJSON or \\x00-delimited GELF')],
+            *,
+            limit: Annotated[
+                int, typer.Option('--limit',
+                                  help='Messages to read from sample, '
+                                       '0 reads all')] = 0,
+            batch_size: Annotated[
+                int, typer.Option('--batch-size')] = 500,
+            dynamic_filters: Annotated[
+                bool, typer.Option('--dynamic-filters',
+                                   help='Keep dynamic filters, they need '
+                                        'their services (e.g. Redis)')
+            ] = False,
+            cprofile: Annotated[
+                Optional[pathlib.Path], typer.Option(
+                    '--cprofile',
+                    help='Dump cProfile stats of end to end run there')
+            ] = None,
+            verbose: Annotated[
+                int, typer.Option('--verbose', '-v', count=True)] = 0):
+    """
+    Report cost of every stage and static filter of a handler config
+    against sample traffic, senders are stubbed
+    """
+    customize_logger(LOGGING_LEVELS[verbose])
+    values = load_values(sample, limit)
+    if not values:
+        main_logger.critical(f'No messages found in {sample}')
+        raise typer.Exit(1)
+    handler_dict = stub_config(load_config(config), dynamic_filters)
+    stages = profile_stages(Handler.from_dict(copy.deepcopy(handler_dict)),
+                            values)
+    elapsed = end_to_end(handler_dict, values, batch_size, cprofile)
+    typer.echo(format_report(stages, elapsed, len(values)))
+    if cprofile is not None:
+        typer.echo(f'cProfile stats: {cprofile}')
+
+
+def main(config: Annotated[Optional[pathlib.Path], typer.Argument(
+             help='Handler config, omit to run every config from etc path'
+         )] = None,
+         *,
          kafka_server: Annotated[
              str, typer.Option('--kafka-server',
                                envvar='CRITICAL_KAFKA_SERVER',
-                               show_envvar=True)],
+                               show_envvar=True)] = 'localhost',
          etc_path: Annotated[
              str, typer.Option('--etc-path',
                                envvar='CRITICAL_ETC_PATH',
                                show_envvar=True)] = '',
+         batch_size: Annotated[
+             int, typer.Option('--batch-size',
+                               envvar='CRITICAL_BATCH_SIZE',
+                               show_envvar=True)] = 500,
+         batch_timeout: Annotated[
+             int, typer.Option('--batch-timeout',
+                               help='Batch wait timeout, ms',
+                               envvar='CRITICAL_BATCH_TIMEOUT',
+                               show_envvar=True)] = 1000,
+         at_least_once: Annotated[
+             bool, typer.Option('--at-least-once',
+                                help='Commit offsets only after messages '
+                                     'are delivered',
+                                envvar='CRITICAL_AT_LEAST_ONCE',
+                                show_envvar=True)] = False,
+         commit_interval: Annotated[
+             float, typer.Option('--commit-interval',
+                                 help='Seconds between offset commits',
+                                 envvar='CRITICAL_COMMIT_INTERVAL',
+                                 show_envvar=True)] = 5,
+         commit_records: Annotated[
+             int, typer.Option('--commit-records',
+                               help='Commit earlier once that many '
+                                    'messages are delivered',
+                               envvar='CRITICAL_COMMIT_RECORDS',
+                               show_envvar=True)] = 1000,
+         replay: Annotated[
+             Optional[List[pathlib.Path]], typer.Option(
+                 '--replay',
+                 help='Read messages from NDJSON or \\x00-delimited GELF '
+                      'files instead of Kafka, can be repeated')] = None,
+         replay_speed: Annotated[
+             float, typer.Option('--replay-speed',
+                                 help='Replay at original pace that many '
+                                      'times faster, 0 is as fast as '
+                                      'possible')] = 0,
+         gelf_tcp_port: Annotated[
+             int, typer.Option('--gelf-tcp-port',
+                               help='Receive GELF over TCP instead of '
+                                    'Kafka, 0 disables',
+                               envvar='CRITICAL_GELF_TCP_PORT',
+                               show_envvar=True)] = 0,
+         gelf_udp_port: Annotated[
+             int, typer.Option('--gelf-udp-port',
+                               help='Receive GELF over UDP instead of '
+                                    'Kafka, 0 disables',
+                               envvar='CRITICAL_GELF_UDP_PORT',
+                               show_envvar=True)] = 0,
+         gelf_host: Annotated[
+             str, typer.Option('--gelf-host',
+                               envvar='CRITICAL_GELF_HOST',
+                               show_envvar=True)] = '0.0.0.0',
+         workers: Annotated[
+             int, typer.Option('--workers',
+                               help='Number of worker processes',
+                               envvar='CRITICAL_WORKERS',
+                               show_envvar=True)] = 1,
+         stats_interval: Annotated[
+             int, typer.Option('--stats-interval',
+                               help='Seconds between stats records '
+                                    'in multi-process mode',
+                               envvar='CRITICAL_STATS_INTERVAL',
+                               show_envvar=True)] = 60,
+         metrics_port: Annotated[
+             int, typer.Option('--metrics-port',
+                               help='Serve Prometheus metrics on that port '
+                                    '(next ones for more workers), '
+                                    '0 disables metrics',
+                               envvar='CRITICAL_METRICS_PORT',
+                               show_envvar=True)] = 0,
+         metrics_host: Annotated[
+             str, typer.Option('--metrics-host',
+                               envvar='CRITICAL_METRICS_HOST',
+                               show_envvar=True)] = '127.0.0.1',
+         reload_interval: Annotated[
+             float, typer.Option('--reload-interval',
+                                 help='Seconds between config changes '
+                                      'checks, 0 reloads on SIGHUP only',
+                                 envvar='CRITICAL_RELOAD_INTERVAL',
+                                 show_envvar=True)] = 0,
          verbose: Annotated[
              int, typer.Option('--verbose', '-v',
                                count=True,
@@ -38,75 +179,319 @@ def main(config: Annotated[pathlib.Path, typer.Argument()],
     customize_logger(LOGGING_LEVELS[verbose])
     main_logger.error('Starting app...')
 
-    full_path = pathlib.Path(etc_path) / config
-    with open(full_path) as f:
-        handler_dict = yaml.safe_load(f)
+    etc_dir = pathlib.Path(etc_path)
+    if not config_files(etc_dir, config):
+        main_logger.critical(f'No handler configs found in {etc_dir}')
+        raise typer.Exit(1)
 
-    if 'name' not in handler_dict:
-        handler_name = pathlib.Path(config).stem
-        handler_dict['name'] = handler_name
+    consumer_dict = {'bootstrap_servers': kafka_server,
+                     'max_records': batch_size,
+                     'timeout_ms': batch_timeout,
+                     'at_least_once': at_least_once,
+                     'commit_interval': commit_interval,
+                     'commit_records': commit_records}
+    # other sources ignore topics, every handler gets every message
+    if replay:
+        consumer_dict = {'class': 'FileAsyncConsumer',
+                         'paths': replay,
+                         'speed': replay_speed,
+                         'max_records': batch_size}
+    elif gelf_tcp_port or gelf_udp_port:
+        consumer_dict = {'class': 'GELFAsyncConsumer',
+                         'host': gelf_host,
+                         'tcp_port': gelf_tcp_port or None,
+                         'udp_port': gelf_udp_port or None,
+                         'max_records': batch_size,
+                         'timeout_ms': batch_timeout}
+    if 'class' in consumer_dict and workers > 1:
+        main_logger.warning(f'{consumer_dict["class"]} runs in one process')
+        workers = 1
+    group_name = etc_dir.resolve().name
+    metrics_address = (metrics_host, metrics_port) if metrics_port else None
+    # workers load configs themselves, so they can reload them
+    args = (consumer_dict, (etc_dir, config), group_name, stats_interval,
+            metrics_address, reload_interval)
+
+    if workers > 1:
+        # workers join the same consumer groups, so partitions
+        # are spread among processes
+        supervisor = Supervisor(worker_main, args, workers,
+                                LOGGING_LEVELS[verbose],
+                                stats_interval=stats_interval)
+        supervisor.run()
+        return
+    worker_main(*args)
 
-    consumer_dict = {'bootstrap_servers': kafka_server}
 
+def worker_main(consumer_dict: dict,
+                config_source: Tuple[pathlib.Path, Optional[pathlib.Path]],
+                group_name: str = None,
+                stats_interval: float = 60,
+                metrics_address: Optional[Tuple[str, int]] = None,
+                reload_interval: float = 0,
+                on_stats: Callable[[List[dict]], None] = None,
+                worker: int = 0):
+    if metrics_address is not None:
+        # every worker process serves its own metrics
+        host, port = metrics_address
+        metrics_address = (host, port + worker)
     try:
-        asyncio.run(_main(consumer_dict, handler_dict))
+        asyncio.run(_main(consumer_dict, config_source, group_name,
+                          stats_interval, on_stats, metrics_address,
+                          reload_interval))
     except KeyboardInterrupt:
         main_logger.error('Keyboard Interrupt, stop')
 
 
+def config_files(etc_dir: pathlib.Path,
+                 config: Optional[pathlib.Path] = None
+                 ) -> List[pathlib.Path]:
+    """Given config or every config from etc directory"""
+    if config is not None:
+        return [etc_dir / config]
+    return sorted(path for path in etc_dir.iterdir()
+                  if path.suffix in CONFIG_SUFFIXES)
+
+
+def load_config(path: pathlib.Path) -> dict:
+    with open(path) as f:
+        handler_dict = yaml.safe_load(f)
+    if 'name' not in handler_dict:
+        handler_dict['name'] = path.stem
+    return handler_dict
+
+
+def handlers_of(target: AnyTarget) -> List[Handler]:
+    if isinstance(target, HandlerGroup):
+        return target.handlers
+    return [target]
+
+
+class Runtime:
+    def __init__(self, consumer_dict: dict,
+                 config_source: Tuple[pathlib.Path, Optional[pathlib.Path]],
+                 group_name: str = None):
+        """
+        Handlers with their consumers, one per topic
+        On reload handlers are rebuilt from configs and swapped in while
+        consumers keep running; consumers are started and stopped only for
+        added and removed topics
+        :param consumer_dict: consumer settings
+        :param config_source: etc directory and config (None for every
+        config in etc directory)
+        :param group_name: name of handler groups
+        """
+        self.consumer_dict = consumer_dict
+        self.config_source = config_source
+        self.group_name = group_name
+        self.targets: Dict[str, ReloadableHandler] = {}
+        self.runners: Dict[str, asyncio.Task] = {}
+        # by name, reloaded handler reuses components of previous one
+        self.handlers: Dict[str, Handler] = {}
+        self.reloading: Optional[asyncio.Task] = None
+        self.reload_pending = False
+        self.changed = asyncio.Event()
+
+    def list_files(self) -> List[pathlib.Path]:
+        return config_files(*self.config_source)
+
+    def build(self, strict: bool = False) -> Dict[str, AnyTarget]:
+        """
+        :param strict: raise on invalid config instead of skipping it
+        :return: handlers or handler groups by topic
+        """
+        handlers = []
+        for path in self.list_files():
+            try:
+                handler_dict = load_config(path)
+                previous = self.handlers.get(handler_dict['name'])
+                handlers.append(Handler.from_dict(handler_dict, previous))
+            except (AttributeError, ValueError, KeyError, OSError,
+                    yaml.YAMLError) as e:
+                main_logger.critical(f'{path.name}: {e}')
+                if strict:
+                    raise
+        if handlers:
+            main_logger.error(f'{len(handlers)} handler(s) initialized')
+
+        by_topic = defaultdict(list)
+        specification = None
+        if self.consumer_dict.get('class', 'KafkaAsyncConsumer') == \
+                'KafkaAsyncConsumer':
+            # every topic is consumed and decoded once for all its handlers
+            for handler in handlers:
+                by_topic[handler.consumer_specification].append(handler)
+        elif handlers:
+            # consumer ignoring topics is started once for all handlers
+            specification = self.group_name or 'all'
+            by_topic[specification] = handlers
+        targets = {}
+        for topic, topic_handlers in by_topic.items():
+            if len(topic_handlers) == 1:
+                targets[topic] = topic_handlers[0]
+            else:
+                targets[topic] = HandlerGroup(topic_handlers, self.group_name,
+                                              specification)
+        return targets
+
+    def remember(self) -> None:
+        self.handlers = {handler.name: handler
+                         for target in self.targets.values()
+                         for handler in handlers_of(target.target)}
+
+    def add(self, topic: str, target: AnyTarget) -> None:
+        reloadable = ReloadableHandler(target)
+        self.targets[topic] = reloadable
+        self.runners[topic] = asyncio.create_task(
+            run_handler(dict(self.consumer_dict), reloadable))
+        self.changed.set()
+
+    def start(self) -> bool:
+        """:return: False if there is nothing to run"""
+        for topic, target in self.build().items():
+            self.add(topic, target)
+        self.remember()
+        return bool(self.targets)
+
+    async def run(self) -> None:
+        """Wait for consumers, finite ones (e.g. replay) may finish"""
+        try:
+            while self.runners:
+                self.changed.clear()
+                changed = asyncio.create_task(self.changed.wait())
+                await asyncio.wait([changed, *self.runners.values()],
+                                   return_when=asyncio.FIRST_COMPLETED)
+                changed.cancel()
+                for topic, runner in list(self.runners.items()):
+                    if runner.done():
+                        del self.runners[topic]
+                        del self.targets[topic]
+        finally:
+            for runner in self.runners.values():
+                runner.cancel()
+            await asyncio.gather(*self.runners.values(),
+                                 return_exceptions=True)
+
+    def request_reload(self) -> None:
+        """Reload now, or once more after reload in progress"""
+        if self.reloading is not None and not self.reloading.done():
+            self.reload_pending = True
+            return
+        self.reloading = asyncio.create_task(self.reload_loop())
+
+    async def reload_loop(self) -> None:
+        self.reload_pending = True
+        while self.reload_pending:
+            self.reload_pending = False
+            await self.reload()
+
+    async def reload(self) -> None:
+        main_logger.error('Reloading configs...')
+        try:
+            targets = self.build(strict=True)
+        except Exception as e:
+            main_logger.critical(f'Reload aborted, old configs are kept: '
+                                 f'{e.__class__.__name__}: {e}')
+            return
+        if not targets:
+            main_logger.critical('Reload aborted, no handler configs found')
+            return
+        # handler moved to another topic keeps its components
+        keep = [component for target in targets.values()
+                for component in target.components]
+        for topic in set(self.runners) - set(targets):
+            main_logger.error(f'{topic}: no handlers left, stopping')
+            self.targets[topic].keep = keep
+            runner = self.runners.pop(topic)
+            runner.cancel()
+            await asyncio.gather(runner, return_exceptions=True)
+            del self.targets[topic]
+        for topic, target in targets.items():
+            if topic in self.targets:
+                await self.targets[topic].swap(target, keep)
+            else:
+                self.add(topic, target)
+        self.remember()
+        main_logger.error('Configs reloaded')
+
+
 async def _main(consumer_dict: dict,
-                handler_dict: dict):
-    try:
-        handler = Handler.from_dict(handler_dict)
-    except AttributeError as e:
-        main_logger.critical(str(e))
+                config_source: Tuple[pathlib.Path, Optional[pathlib.Path]],
+                group_name: str = None,
+                stats_interval: float = 60,
+                on_stats: Callable[[List[dict]], None] = None,
+                metrics_address: Optional[Tuple[str, int]] = None,
+                reload_interval: float = 0):
+    runtime = Runtime(consumer_dict, config_source, group_name)
+    if not runtime.start():
         return
-    main_logger.error('Handler initialized')
-
-    topic = handler.consumer_specification
-    handler_name = ''.join(filter(str.isalnum, handler.name)).lower()
-    group_id = topic + ':' + handler_name
-    consumer_dict['topic'] = topic
-    consumer_dict['group_id'] = group_id
-    consumer = KafkaAsyncConsumer.from_dict(consumer_dict)
-    main_logger.error('Consumer initialized')
-    await consumer.start()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGHUP, runtime.request_reload)
+    tasks = []
+    if reload_interval:
+        watcher = ConfigWatcher(runtime.list_files)
+        tasks.append(asyncio.create_task(
+            watcher.watch(reload_interval, runtime.request_reload)))
+    if on_stats is not None:
+        tasks.append(asyncio.create_task(
+            report_stats(runtime.targets, on_stats, stats_interval)))
+    server = None
+    if metrics_address is not None:
+        server = await serve_metrics(*metrics_address)
+    try:
+        await runtime.run()
+    finally:
+        loop.remove_signal_handler(signal.SIGHUP)
+        for task in tasks:
+            task.cancel()
+        if server is not None:
+            server.close()
+
 
-    workers = []
-    count = await consumer.consumer_target_count()
-    for i in range(count):
-        worker_task = asyncio.create_task(worker(consumer, i, handler))
-        workers.append(worker_task)
+async def report_stats(targets: Dict[str, ReloadableHandler],
+                       on_stats: Callable[[List[dict]], None],
+                       interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        stats = []
+        for target in targets.values():
+            target_stats = target.stats()
+            if isinstance(target_stats, dict):
+                target_stats = [target_stats]
+            stats.extend(target_stats)
+        on_stats(stats)
+
+
+async def run_handler(consumer_dict: dict,
+                      handler: Union[Handler, HandlerGroup,
+                                     ReloadableHandler]):
+    consumer_cls = getattr(consumers,
+                           consumer_dict.pop('class', 'KafkaAsyncConsumer'))
+    consumer_dict['decoder'] = handler.decoder
+    if consumer_cls is KafkaAsyncConsumer:
+        topic = handler.consumer_specification
+        handler_name = ''.join(filter(str.isalnum, handler.name)).lower()
+        group_id = topic + ':' + handler_name
+        consumer_dict['topic'] = topic
+        consumer_dict['group_id'] = group_id
+        consumer = consumer_cls.from_dict(consumer_dict)
+        main_logger.error(f'Consumer initialized, group ID {group_id}')
+    else:
+        consumer = consumer_cls.from_dict(consumer_dict)
+        main_logger.error(f'{consumer_cls.__name__} initialized')
+    await consumer.start()
     try:
         await handler.start()
-        await asyncio.gather(*workers)
+        # one consumer, partitions are handled by tasks started and
+        # stopped on rebalance
+        await consumer.run(handler)
     except asyncio.exceptions.CancelledError:
         main_logger.error('Handler cancelled, stop')
     finally:
+        # consumer commits offsets of messages handler has delivered,
+        # so handler is stopped in between
+        await consumer.drain()
         await handler.stop()
         main_logger.error('Handler stopped')
-
-
-async def worker(parent_consumer: AbstractAsyncConsumer,
-                 number: int,
-                 handler: Handler):
-    main_logger.error(f'Start consumer #{number}')
-    if number == 1:
-        consumer = parent_consumer
-    else:
-        consumer = await parent_consumer.fork()
-    while True:
-        try:
-            msg = await consumer.consume()
-            main_logger.info(f'Consumer #{number} get new message')
-            main_logger.debug(msg.short_message)
-            await handler.handle(msg)
-        except asyncio.CancelledError:
-            main_logger.error(f'Stopping consumer #{number}')
-            await consumer.stop()
-            main_logger.error(f'Consumer #{number} stopped')
-            break
-        except Exception as e:
-            error_text = e.__class__.__name__ + ': ' + str(e)
-            main_logger.error(error_text)
-
+        await consumer.stop()
+        main_logger.error('Consumer stopped')
@@ -1,78 +1,470 @@
+import asyncio
 from abc import ABC, abstractmethod
+from collections import deque
+from functools import partial
+import mmap
+import os
+import re
 import aiokafka
-from typing import Optional, TypeVar
-import json
+import time
+from typing import (TYPE_CHECKING, Deque, Dict, Iterator, List, Optional,
+                    Set, TypeVar)
+from .decoders import Decoder, decode_full
+from .gelf_input import ChunkAssembler, GELFUDPProtocol
 from .models import GELFMessage
 from .loggers import consumers_logger as logger
+from .metrics import METRICS
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .handler import Handler
 
 AnyAsyncConsumer = TypeVar('AnyAsyncConsumer', bound='AbstractAsyncConsumer')
-AnyKafkaConsumer = TypeVar('AnyKafkaConsumer', bound='KafkaConsumer')
 
 
 class AbstractAsyncConsumer(ABC):
+    # set by finite sources once every message is consumed, ends run
+    exhausted: bool = False
+
     async def start(self) -> None:
         pass
 
     async def stop(self) -> None:
         pass
 
-    async def consumer_target_count(self) -> int:
-        return 1
+    async def drain(self) -> None:
+        """Pass messages already taken from source to handler"""
+        pass
+
+    async def pause(self) -> None:
+        """Stop fetching new messages"""
+        pass
 
-    async def fork(self) -> AnyAsyncConsumer:
-        return self
+    async def resume(self) -> None:
+        """Continue fetching messages after pause"""
+        pass
 
     @abstractmethod
-    async def consume(self) -> GELFMessage:  # pragma: no cover
+    async def consume(self) -> Optional[GELFMessage]:  # pragma: no cover
+        """
+        Get next GELF message
+        :return: None once finite source is exhausted (`exhausted` is set)
+        """
         raise NotImplementedError
 
+    async def consume_batch(self) -> List[GELFMessage]:
+        """Get a batch of GELF messages (single message by default)"""
+        message = await self.consume()
+        return [] if message is None else [message]
+
+    async def run(self, handler: 'Handler') -> None:
+        """
+        Pass consumed batches to handler until cancelled or exhausted
+        Consumption is paused while handler is saturated
+        :param handler: Handler or HandlerGroup
+        :return: None
+        """
+        while not self.exhausted:
+            try:
+                if handler.saturated:
+                    await self.pause()
+                    while not await handler.wait_drained(1):
+                        pass
+                    await self.resume()
+                batch = await self.consume_batch()
+                if not batch:
+                    continue
+                logger.info(f'Got {len(batch)} new message(s)')
+                await handler.handle_batch(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error_text = e.__class__.__name__ + ': ' + str(e)
+                logger.error(error_text)
+
     @classmethod
     @abstractmethod
     def from_dict(cls, settings: dict):  # pragma: no cover
         raise NotImplementedError
 
 
+class OffsetTracker:
+    def __init__(self):
+        """
+        Offsets of one partition taken for processing, but not finished
+        Messages may be finished out of order, only offsets below the
+        first unfinished one are safe to commit
+        """
+        self.offsets: Deque[int] = deque()
+        self.finished: Set[int] = set()
+        # next offset to consume, i.e. value to commit
+        self.watermark: Optional[int] = None
+        self.committed: Optional[int] = None
+
+    @property
+    def in_flight(self) -> int:
+        return len(self.offsets)
+
+    def add(self, offset: int) -> None:
+        """Offsets must be added in increasing order"""
+        if self.watermark is None:
+            # consumption started here, nothing to commit yet
+            self.watermark = self.committed = offset
+        self.offsets.append(offset)
+
+    def finish(self, offset: int) -> None:
+        if not self.offsets or offset < self.offsets[0]:
+            # not in flight here, e.g. acknowledged late by a handler of
+            # previous assignment of partition
+            return
+        self.finished.add(offset)
+        while self.offsets and self.offsets[0] in self.finished:
+            self.finished.discard(self.offsets[0])
+            self.watermark = self.offsets.popleft() + 1
+
+    @property
+    def uncommitted(self) -> bool:
+        return self.watermark is not None and \
+            self.watermark != self.committed
+
+
+class PartitionListener(aiokafka.ConsumerRebalanceListener):
+    def __init__(self, consumer: 'KafkaAsyncConsumer'):
+        self.consumer = consumer
+
+    async def on_partitions_revoked(self, revoked):
+        await self.consumer.revoke(revoked)
+
+    async def on_partitions_assigned(self, assigned):
+        await self.consumer.assign(assigned)
+
+
 class KafkaAsyncConsumer(AbstractAsyncConsumer):
-    def __init__(self, consumer: aiokafka.AIOKafkaConsumer, topic: str):
+    def __init__(self, consumer: aiokafka.AIOKafkaConsumer, topic: str,
+                 max_records: int = 500,
+                 timeout_ms: int = 1000,
+                 decoder: Optional[Decoder] = None,
+                 partition_queue_size: int = 2,
+                 drain_timeout: float = 10,
+                 at_least_once: bool = False,
+                 commit_interval: float = 5,
+                 commit_records: int = 1000):
+        """
+        :param consumer: aiokafka consumer
+        :param topic: Kafka topic name
+        :param max_records: maximum number of records in one batch
+        :param timeout_ms: how long to wait for a batch to fill up
+        :param decoder: turns record value into GELF message
+        :param partition_queue_size: fetched batches waiting for partition
+        task, partition is paused when its queue is full
+        :param drain_timeout: how long to wait for queued batches of
+        revoked partitions
+        :param at_least_once: commit offsets manually, only after every
+        sender is done with message (consumer must not auto commit)
+        :param commit_interval: seconds between commits
+        :param commit_records: commit earlier once that many messages
+        are finished
+        """
         self.consumer = consumer
         self.topic = topic
+        self.max_records = max_records
+        self.timeout_ms = timeout_ms
+        self.decode = decoder or decode_full
+        self.partition_queue_size = partition_queue_size
+        self.drain_timeout = drain_timeout
+        self.handler: Optional['Handler'] = None
+        self.queues: Dict[aiokafka.TopicPartition, asyncio.Queue] = {}
+        self.tasks: Dict[aiokafka.TopicPartition, asyncio.Task] = {}
+        self.paused_partitions: Set[aiokafka.TopicPartition] = set()
+        self.at_least_once = at_least_once
+        self.commit_interval = commit_interval
+        self.commit_records = commit_records
+        self.trackers: Dict[aiokafka.TopicPartition, OffsetTracker] = {}
+        self.finished_since_commit = 0
+        self.commit_wanted = asyncio.Event()
 
     async def start(self) -> None:
-        """Set up consumer"""
+        """Subscribe to topic and set up consumer"""
+        self.consumer.subscribe([self.topic],
+                                listener=PartitionListener(self))
         await self.consumer.start()
 
+    async def drain(self) -> None:
+        """Let partition tasks finish queued batches and stop them"""
+        await self.stop_tasks(list(self.tasks))
+
     async def stop(self) -> None:
-        """Dispose consumer and delete all connections"""
+        """
+        Finish queued batches, commit finished messages, dispose consumer
+        and delete all connections
+        """
+        await self.drain()
+        await self.commit()
         await self.consumer.stop()
 
-    async def consumer_target_count(self) -> int:
-        """Get target count of concurrent consumers"""
-        logger.debug('Getting target count of concurrent consumers...')
-        partitions = self.consumer.partitions_for_topic(self.topic)
-        logger.debug('Got list of partitions')
-        result = len(partitions)
-        return result
-
-    async def fork(self) -> AnyKafkaConsumer:
-        """Create copy of consumer and set it up"""
-        new_consumer = aiokafka.AIOKafkaConsumer(
-            self.topic,
-            bootstrap_servers=self.consumer._client._bootstrap_servers,
-            group_id=self.consumer._group_id,
-            enable_auto_commit=True
-        )
-        child_consumer = KafkaAsyncConsumer(new_consumer, self.topic)
-        await child_consumer.start()
-        return child_consumer
+    async def pause(self) -> None:
+        """Pause fetching from all assigned partitions"""
+        self.consumer.pause(*self.consumer.assignment())
+
+    async def resume(self) -> None:
+        """Resume fetching from all paused partitions"""
+        self.consumer.resume(*self.consumer.paused())
+        self.paused_partitions.clear()
+
+    async def assign(self,
+                     partitions: List[aiokafka.TopicPartition]) -> None:
+        """Start task for every newly assigned partition"""
+        for partition in partitions:
+            if partition in self.tasks:
+                continue
+            if self.at_least_once:
+                self.trackers[partition] = OffsetTracker()
+            queue = asyncio.Queue()
+            self.queues[partition] = queue
+            self.tasks[partition] = asyncio.create_task(
+                self.work(partition, queue))
+        logger.info(f'Assigned partitions: '
+                    f'{sorted(tp.partition for tp in self.tasks)}')
+
+    async def revoke(self,
+                     partitions: List[aiokafka.TopicPartition]) -> None:
+        """
+        Let tasks of revoked partitions finish queued batches, stop them
+        and commit finished messages
+        Messages still being delivered will be consumed again by new owner
+        """
+        await self.stop_tasks(partitions)
+        await self.commit(partitions)
+        for partition in partitions:
+            tracker = self.trackers.pop(partition, None)
+            if tracker is not None and tracker.in_flight:
+                logger.warning(f'Partition {partition.partition} revoked '
+                               f'with {tracker.in_flight} message(s) in '
+                               f'flight')
+        logger.info(f'Revoked partitions: '
+                    f'{sorted(tp.partition for tp in partitions)}')
+
+    async def stop_tasks(self,
+                         partitions: List[aiokafka.TopicPartition]) -> None:
+        """
+        Let partition tasks finish queued batches (for up to drain_timeout)
+        and stop them
+        """
+        queues = {}
+        for partition in partitions:
+            queue = self.queues.pop(partition, None)
+            if queue is not None:
+                queues[partition] = queue
+            self.paused_partitions.discard(partition)
+        if not queues:
+            return
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in queues.values())),
+                self.drain_timeout)
+        except asyncio.TimeoutError:
+            dropped = sum(queue.qsize() for queue in queues.values())
+            logger.warning(f'{dropped} queued batch(es) dropped')
+        tasks = [self.tasks.pop(partition) for partition in queues]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def finish(self, partition: aiokafka.TopicPartition,
+               tracker: OffsetTracker, offset: int) -> None:
+        """
+        Every sender is done with message, its offset can be committed
+        :param tracker: tracker offset was added to, acknowledgements
+        arriving after partition was revoked (and maybe reassigned) are
+        ignored
+        """
+        if self.trackers.get(partition) is not tracker:
+            return
+        tracker.finish(offset)
+        self.finished_since_commit += 1
+        if self.finished_since_commit >= self.commit_records:
+            self.commit_wanted.set()
+
+    async def commit(self, partitions: List[aiokafka.TopicPartition] = None
+                     ) -> None:
+        """Commit watermarks that moved since last commit"""
+        if partitions is None:
+            partitions = list(self.trackers)
+        offsets = {}
+        for partition in partitions:
+            tracker = self.trackers.get(partition)
+            if tracker is not None and tracker.uncommitted:
+                offsets[partition] = tracker.watermark
+        self.commit_wanted.clear()
+        self.finished_since_commit = 0
+        if not offsets:
+            return
+        try:
+            await self.consumer.commit(offsets)
+        except Exception as e:
+            error_text = e.__class__.__name__ + ': ' + str(e)
+            logger.error(f'Commit failed: {error_text}')
+            return
+        for partition, offset in offsets.items():
+            tracker = self.trackers.get(partition)
+            if tracker is not None:
+                tracker.committed = offset
+        committed = {tp.partition: offset for tp, offset in offsets.items()}
+        logger.debug(f'Committed offsets: {committed}')
+
+    async def commit_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.commit_wanted.wait(),
+                                       self.commit_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.commit()
+
+    def update_flow(self) -> None:
+        """
+        Pause partitions with full queues (or all of them while handler
+        is saturated), resume the rest
+        """
+        saturated = self.handler is not None and self.handler.saturated
+        for partition, queue in self.queues.items():
+            pause = saturated or queue.qsize() >= self.partition_queue_size
+            if pause and partition not in self.paused_partitions:
+                self.consumer.pause(partition)
+                self.paused_partitions.add(partition)
+            elif not pause and partition in self.paused_partitions:
+                self.consumer.resume(partition)
+                self.paused_partitions.discard(partition)
+
+    async def work(self, partition: aiokafka.TopicPartition,
+                   queue: asyncio.Queue) -> None:
+        """Pass batches of one partition to handler in order"""
+        while True:
+            records = await queue.get()
+            try:
+                acks = None
+                if METRICS.enabled:
+                    started = time.perf_counter()
+                if self.at_least_once:
+                    messages, acks = self.decode_tracked(partition, records)
+                else:
+                    messages = self.decode_records(records)
+                if METRICS.enabled:
+                    METRICS.latency.observe(
+                        (time.perf_counter() - started) / len(records),
+                        'decode', count=len(records))
+                if messages:
+                    logger.debug(f'Partition {partition.partition}: '
+                                 f'{len(messages)} new message(s)')
+                    await self.handler.handle_batch(messages, acks)
+            except Exception as e:
+                error_text = e.__class__.__name__ + ': ' + str(e)
+                logger.error(error_text)
+            finally:
+                queue.task_done()
+            self.update_flow()
+
+    async def run(self, handler: 'Handler') -> None:
+        """
+        Fetch records for all assigned partitions and dispatch them to
+        partition tasks until cancelled
+        :param handler: Handler or HandlerGroup
+        :return: None
+        """
+        self.handler = handler
+        if self.at_least_once:
+            committer = asyncio.create_task(self.commit_loop())
+        try:
+            await self.fetch()
+        finally:
+            if self.at_least_once:
+                committer.cancel()
+
+    async def fetch(self) -> None:
+        while True:
+            self.update_flow()
+            try:
+                batch = await self.consumer.getmany(
+                    timeout_ms=self.timeout_ms, max_records=self.max_records)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error_text = e.__class__.__name__ + ': ' + str(e)
+                logger.error(error_text)
+                continue
+            for partition, records in batch.items():
+                queue = self.queues.get(partition)
+                if queue is None:
+                    logger.warning(f'Partition {partition.partition} '
+                                   f'is not assigned, records skipped')
+                    continue
+                queue.put_nowait(records)
+                if METRICS.enabled:
+                    self.record_lag(partition, records[-1].offset)
+
+    def record_lag(self, partition: aiokafka.TopicPartition,
+                   offset: int) -> None:
+        highwater = self.consumer.highwater(partition)
+        if highwater is not None:
+            METRICS.lag.set(highwater - offset - 1, partition.topic,
+                            partition.partition)
+
+    def decode_tracked(self, partition: aiokafka.TopicPartition,
+                       records: List[aiokafka.ConsumerRecord]):
+        """
+        Decode records and make acknowledgement callback for each message
+        Records that could not be decoded are finished right away
+        """
+        tracker = self.trackers[partition]
+        for record in records:
+            tracker.add(record.offset)
+        messages, acks = [], []
+        for record in records:
+            try:
+                messages.append(self.decode(record.value))
+            except Exception as e:
+                error_text = e.__class__.__name__ + ': ' + str(e)
+                logger.error(error_text)
+                self.finish(partition, tracker, record.offset)
+                continue
+            acks.append(partial(self.finish, partition, tracker,
+                                record.offset))
+        return messages, acks
+
+    def decode_records(self, records: List[aiokafka.ConsumerRecord]
+                       ) -> List[GELFMessage]:
+        """Messages that could not be decoded are logged and skipped"""
+        messages = []
+        for record in records:
+            try:
+                messages.append(self.decode(record.value))
+            except Exception as e:
+                error_text = e.__class__.__name__ + ': ' + str(e)
+                logger.error(error_text)
+        return messages
 
     async def consume(self) -> GELFMessage:
         """Get another GELF message"""
         msg = await self.consumer.getone()
-        value = msg.value.decode('utf-8')
-        json_value = json.loads(value)
-        message = GELFMessage(**json_value)
+        if not METRICS.enabled:
+            return self.decode(msg.value)
+        started = time.perf_counter()
+        message = self.decode(msg.value)
+        METRICS.latency.observe(time.perf_counter() - started, 'decode')
         return message
 
+    async def consume_batch(self) -> List[GELFMessage]:
+        """
+        Get all GELF messages fetched within timeout (up to max_records)
+        Messages that could not be decoded are logged and skipped
+        """
+        batch = await self.consumer.getmany(timeout_ms=self.timeout_ms,
+                                            max_records=self.max_records)
+        messages = []
+        for records in batch.values():
+            messages.extend(self.decode_records(records))
+        logger.debug(f'Got batch of {len(messages)} messages')
+        return messages
+
     @classmethod
     def from_dict(cls, settings: dict):
         bootstrap_servers = settings.pop('bootstrap_servers', 'localhost')
@@ -85,13 +477,350 @@ class KafkaAsyncConsumer(AbstractAsyncConsumer):
             group_id = settings.pop('group_id')
         except KeyError:
             raise ValueError('Kafka group ID is not provided')
+        max_records = settings.pop('max_records', 500)
+        timeout_ms = settings.pop('timeout_ms', 1000)
+        decoder = settings.pop('decoder', None)
+        at_least_once = settings.pop('at_least_once', False)
+        commit_interval = settings.pop('commit_interval', 5)
+        commit_records = settings.pop('commit_records', 1000)
 
         if settings:
             raise ValueError('Unexpected key(s): ' + ', '.join(settings.keys()))
 
+        # topic is subscribed on start, together with rebalance listener
         consumer = aiokafka.AIOKafkaConsumer(
-                    topic,
                     bootstrap_servers=bootstrap_servers,
                     group_id=group_id,
-                    enable_auto_commit=True)
-        return cls(consumer, topic)
+                    enable_auto_commit=not at_least_once)
+        return cls(consumer, topic, max_records, timeout_ms, decoder,
+                   at_least_once=at_least_once,
+                   commit_interval=commit_interval,
+                   commit_records=commit_records)
+
+
+# GELF timestamp is taken from raw record, whatever decoder keeps
+TIMESTAMP = re.compile(
+    rb'"timestamp"\s*:\s*"?(-?[0-9.]+(?:[eE][-+]?[0-9]+)?)')
+DELIMITERS = {'ndjson': b'\n', 'gelf': b'\x00'}
+
+
+def detect_delimiter(buffer: mmap.mmap) -> bytes:
+    """GELF dumps are \\x00-delimited, anything else is read as NDJSON"""
+    if buffer.find(DELIMITERS['gelf'], 0, 65536) != -1:
+        return DELIMITERS['gelf']
+    return DELIMITERS['ndjson']
+
+
+def split_records(buffer: mmap.mmap, delimiter: bytes) -> Iterator[bytes]:
+    """Yield non-empty records, surrounding whitespace is stripped"""
+    position, size = 0, len(buffer)
+    while position < size:
+        end = buffer.find(delimiter, position)
+        if end == -1:
+            end = size
+        record = buffer[position:end].strip()
+        position = end + len(delimiter)
+        if record:
+            yield record
+
+
+class FileAsyncConsumer(AbstractAsyncConsumer):
+    def __init__(self, paths: List[str],
+                 file_format: str = 'auto',
+                 speed: float = 0,
+                 max_records: int = 500,
+                 decoder: Optional[Decoder] = None):
+        """
+        Replay GELF messages captured to files
+        Files are memory-mapped and read record by record, so they don't
+        have to fit into memory
+        :param paths: files replayed one after another
+        :param file_format: `ndjson` (message per line), `gelf`
+        (\\x00-delimited dump) or `auto` to detect it for every file
+        :param speed: 0 replays as fast as possible, otherwise messages are
+        passed according to their timestamps, `speed` times faster
+        :param max_records: maximum batch size
+        :param decoder: same as for KafkaAsyncConsumer
+        """
+        logger.debug('File consumer initializing...')
+        if file_format != 'auto' and file_format not in DELIMITERS:
+            raise ValueError(f'Unknown file format {file_format}')
+        self.paths = list(paths)
+        logger.debug(f'Files: {", ".join(map(str, self.paths))}')
+        self.delimiter = DELIMITERS.get(file_format)
+        self.speed = speed
+        logger.debug(f'Speed: {self.speed or "as fast as possible"}')
+        self.max_records = max_records
+        self.decode = decoder or decode_full
+        self.records: Optional[Iterator[bytes]] = None
+        # record taken from file, but not due yet
+        self.pending: Optional[bytes] = None
+        # timestamp of first replayed message and its replay time
+        self.first_timestamp: Optional[float] = None
+        self.started_at = 0.0
+        self.exhausted = False
+        logger.info('File consumer has been set')
+
+    async def start(self) -> None:
+        self.records = self.read_records()
+
+    async def stop(self) -> None:
+        if self.records is not None:
+            # closes file and mapping of unfinished replay
+            self.records.close()
+            self.records = None
+
+    def read_records(self) -> Iterator[bytes]:
+        for path in self.paths:
+            with open(path, 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    delimiter = self.delimiter or detect_delimiter(mm)
+                    logger.info(f'Replaying {path}')
+                    yield from split_records(mm, delimiter)
+
+    def next_record(self) -> Optional[bytes]:
+        if self.pending is not None:
+            record, self.pending = self.pending, None
+            return record
+        if self.records is None:
+            self.records = self.read_records()
+        return next(self.records, None)
+
+    def delay(self, record: bytes) -> float:
+        """Seconds left until record is due"""
+        match = TIMESTAMP.search(record)
+        if match is None:
+            return 0
+        timestamp = float(match.group(1))
+        now = time.monotonic()
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+            self.started_at = now
+        due = (timestamp - self.first_timestamp) / self.speed
+        return due - (now - self.started_at)
+
+    async def consume(self) -> Optional[GELFMessage]:
+        """Get another GELF message, None once files are replayed"""
+        while not self.exhausted:
+            batch = await self.read(1)
+            if batch:
+                return batch[0]
+        return None
+
+    async def consume_batch(self) -> List[GELFMessage]:
+        """
+        Get up to max_records messages, in realtime mode only those
+        that are due
+        Messages that could not be decoded are logged and skipped
+        """
+        return await self.read(self.max_records)
+
+    async def read(self, limit: int) -> List[GELFMessage]:
+        # fast replay shouldn't starve delivery workers; messages are
+        # decoded and returned without yielding, like other consumers do
+        await asyncio.sleep(0)
+        values = []
+        while len(values) < limit:
+            record = self.next_record()
+            if record is None:
+                self.exhausted = True
+                logger.info('Replay finished')
+                break
+            if self.speed:
+                delay = self.delay(record)
+                if delay > 0:
+                    if values:
+                        self.pending = record
+                        break
+                    await asyncio.sleep(delay)
+            values.append(record)
+        messages = []
+        for value in values:
+            try:
+                messages.append(self.decode(value))
+            except Exception as e:
+                error_text = e.__class__.__name__ + ': ' + str(e)
+                logger.error(error_text)
+        return messages
+
+    @classmethod
+    def from_dict(cls, settings: dict):
+        try:
+            paths = settings.pop('paths')
+        except KeyError:
+            raise ValueError('Replayed files are not provided')
+        file_format = settings.pop('file_format', 'auto')
+        speed = settings.pop('speed', 0)
+        max_records = settings.pop('max_records', 500)
+        decoder = settings.pop('decoder', None)
+        if settings:
+            raise ValueError('Unexpected key(s): '
+                             + ', '.join(settings.keys()))
+        return cls(paths, file_format, speed, max_records, decoder)
+
+
+class GELFAsyncConsumer(AbstractAsyncConsumer):
+    def __init__(self, host: str = '0.0.0.0',
+                 tcp_port: Optional[int] = 12201,
+                 udp_port: Optional[int] = 12201,
+                 max_records: int = 500,
+                 timeout_ms: int = 1000,
+                 queue_size: int = 10000,
+                 max_message_size: int = 1048576,
+                 chunk_timeout: float = 5,
+                 max_chunked_messages: int = 1000,
+                 decoder: Optional[Decoder] = None):
+        """
+        GELF input: \\x00-delimited messages over TCP, optionally chunked
+        and zlib/gzip-compressed messages over UDP
+        :param host: address to listen on
+        :param tcp_port: None disables TCP input, 0 picks free port
+        :param udp_port: None disables UDP input, 0 picks free port
+        :param max_records: maximum batch size
+        :param timeout_ms: batch wait timeout
+        :param queue_size: received messages waiting for handler, TCP
+        clients are not read while it is full, UDP messages are dropped
+        :param max_message_size: larger messages are dropped (TCP
+        connection sending one is closed)
+        :param chunk_timeout: seconds to wait for all chunks of message
+        :param max_chunked_messages: incomplete chunked messages kept
+        :param decoder: same as for KafkaAsyncConsumer
+        """
+        logger.debug('GELF consumer initializing...')
+        self.host = host
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+        logger.debug(f'TCP port: {tcp_port}, UDP port: {udp_port}')
+        self.max_records = max_records
+        self.timeout_ms = timeout_ms
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.max_message_size = max_message_size
+        self.assembler = ChunkAssembler(chunk_timeout, max_chunked_messages,
+                                        max_message_size)
+        self.decode = decoder or decode_full
+        self.tcp_server: Optional[asyncio.AbstractServer] = None
+        self.udp_transport: Optional[asyncio.DatagramTransport] = None
+        self.connections: Set[asyncio.StreamWriter] = set()
+        self.dropped = 0
+        logger.info('GELF consumer has been set')
+
+    async def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self.tcp_port is not None:
+            self.tcp_server = await asyncio.start_server(
+                self.handle_connection, self.host, self.tcp_port,
+                limit=self.max_message_size)
+            self.tcp_port = self.tcp_server.sockets[0].getsockname()[1]
+            logger.error(f'GELF TCP input on {self.host}:{self.tcp_port}')
+        if self.udp_port is not None:
+            self.udp_transport, _ = await loop.create_datagram_endpoint(
+                lambda: GELFUDPProtocol(self.receive, self.assembler,
+                                        self.max_message_size),
+                local_addr=(self.host, self.udp_port))
+            self.udp_port = self.udp_transport.get_extra_info('sockname')[1]
+            logger.error(f'GELF UDP input on {self.host}:{self.udp_port}')
+
+    async def stop(self) -> None:
+        if self.udp_transport is not None:
+            self.udp_transport.close()
+            self.udp_transport = None
+        if self.tcp_server is not None:
+            self.tcp_server.close()
+            for writer in list(self.connections):
+                writer.close()
+            await self.tcp_server.wait_closed()
+            self.tcp_server = None
+        if self.dropped or self.assembler.dropped:
+            logger.warning(f'GELF input dropped {self.dropped} message(s) '
+                           f'on full queue, {self.assembler.dropped} '
+                           f'incomplete chunked message(s)')
+
+    def receive(self, payload: bytes) -> None:
+        """Queue UDP message, drop it if queue is full"""
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f'GELF input queue is full, '
+                               f'{self.dropped} message(s) dropped')
+
+    async def handle_connection(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info('peername')
+        self.connections.add(writer)
+        try:
+            while True:
+                try:
+                    data = await reader.readuntil(b'\x00')
+                except asyncio.IncompleteReadError as e:
+                    # connection closed, last message may lack delimiter
+                    if e.partial.strip():
+                        await self.queue.put(e.partial.strip())
+                    break
+                except asyncio.LimitOverrunError:
+                    logger.warning(f'GELF TCP from {peer}: message is '
+                                   f'larger than {self.max_message_size} '
+                                   f'bytes, closing connection')
+                    break
+                data = data[:-1].strip()
+                if data:
+                    # full queue stops reading, TCP slows the client down
+                    await self.queue.put(data)
+        except ConnectionError as e:
+            logger.warning(f'GELF TCP from {peer}: {e}')
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    def decode_values(self, values: List[bytes]) -> List[GELFMessage]:
+        messages = []
+        for value in values:
+            try:
+                messages.append(self.decode(value))
+            except Exception as e:
+                error_text = e.__class__.__name__ + ': ' + str(e)
+                logger.error(error_text)
+        return messages
+
+    async def consume(self) -> GELFMessage:
+        """Get another GELF message"""
+        while True:
+            messages = self.decode_values([await self.queue.get()])
+            if messages:
+                return messages[0]
+
+    async def consume_batch(self) -> List[GELFMessage]:
+        """
+        Get messages received within timeout (up to max_records)
+        Messages that could not be decoded are logged and skipped
+        """
+        try:
+            values = [await asyncio.wait_for(self.queue.get(),
+                                             self.timeout_ms / 1000)]
+        except asyncio.TimeoutError:
+            return []
+        while len(values) < self.max_records and not self.queue.empty():
+            values.append(self.queue.get_nowait())
+        return self.decode_values(values)
+
+    @classmethod
+    def from_dict(cls, settings: dict):
+        host = settings.pop('host', '0.0.0.0')
+        tcp_port = settings.pop('tcp_port', 12201)
+        udp_port = settings.pop('udp_port', 12201)
+        max_records = settings.pop('max_records', 500)
+        timeout_ms = settings.pop('timeout_ms', 1000)
+        queue_size = settings.pop('queue_size', 10000)
+        max_message_size = settings.pop('max_message_size', 1048576)
+        chunk_timeout = settings.pop('chunk_timeout', 5)
+        max_chunked_messages = settings.pop('max_chunked_messages', 1000)
+        decoder = settings.pop('decoder', None)
+        if settings:
+            raise ValueError('Unexpected key(s): '
+                             + ', '.join(settings.keys()))
+        return cls(host, tcp_port, udp_port, max_records, timeout_ms,
+                   queue_size, max_message_size, chunk_timeout,
+                   max_chunked_messages, decoder)
@@ -0,0 +1,64 @@
+import json
+from typing import Any, Callable, FrozenSet, Optional
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+from .models import CompactGELFMessage, GELFMessage, LazyGELFMessage
+from .loggers import consumers_logger as logger
+
+Decoder = Callable[[bytes], Any]
+
+# both accept raw bytes, no need to decode them into str first
+loads = orjson.loads if orjson is not None else json.loads
+
+
+def decode_full(value: bytes) -> GELFMessage:
+    """Validate every GELF field at once"""
+    value = value.decode('utf-8')
+    json_value = json.loads(value)
+    message = GELFMessage(**json_value)
+    return message
+
+
+class LazyDecoder:
+    def __init__(self, fields: Optional[FrozenSet[str]] = None):
+        """
+        :param fields: GELF keys to keep, all keys are kept if None
+        """
+        self.fields = fields
+
+    def __call__(self, value: bytes) -> LazyGELFMessage:
+        """Keep only required fields, validate them on first access"""
+        json_value = loads(value)
+        if self.fields is not None:
+            json_value = {key: json_value[key] for key in self.fields
+                          if key in json_value}
+        return LazyGELFMessage(json_value)
+
+
+def decode_compact(value: bytes) -> CompactGELFMessage:
+    """Build slotted message, convert heavy fields on access"""
+    return CompactGELFMessage(loads(value))
+
+
+def get_decoder(decoding: str = 'full',
+                fields: Optional[FrozenSet[str]] = None) -> Decoder:
+    """
+    Get decoder for specified decoding mode
+    :param decoding: `full`, `lazy` or `compact`
+    :param fields: GELF keys needed by handler (None means all of them)
+    :return: callable that turns raw bytes into GELF message
+    """
+    logger.debug(f'Decoding: {decoding}')
+    if decoding == 'full':
+        return decode_full
+    if decoding == 'lazy':
+        if fields is not None:
+            logger.debug(f'Fields to decode: {", ".join(sorted(fields))}')
+        return LazyDecoder(fields)
+    if decoding == 'compact':
+        return decode_compact
+    raise ValueError(f'Unknown decoding {decoding}')
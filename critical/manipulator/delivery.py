@@ -0,0 +1,155 @@
+import asyncio
+from typing import Callable, List, Optional, Set
+
+from .dynamic_filters import AbstractDynamicFilter
+from .loggers import senders_logger as logger
+from .senders import AbstractAsyncSender
+
+Ack = Callable[[], None]
+
+
+class Acknowledgement:
+    __slots__ = ('callback', 'remaining')
+
+    def __init__(self, callback: Ack, parts: int):
+        """
+        Acknowledge message once every part of its processing is done
+        :param callback: called when the last part is done
+        :param parts: number of calls needed, e.g. number of senders
+        """
+        self.callback = callback
+        self.remaining = parts
+        if parts <= 0:
+            callback()
+
+    def __call__(self) -> None:
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.callback()
+
+
+class OutboundQueue:
+    def __init__(self, sender: AbstractAsyncSender,
+                 dynamic_filters: List[AbstractDynamicFilter],
+                 name: str = 'sender',
+                 workers: int = 1,
+                 maxsize: int = 1000,
+                 batch_size: int = 100,
+                 on_change: Optional[Callable[[], None]] = None,
+                 stop_timeout: Optional[float] = 10):
+        """
+        Bounded queue between formatting and sending
+        Background workers take formatted messages and pass them to sender
+        :param sender: sender to deliver messages with
+        :param dynamic_filters: dynamic filters applied by sender
+        :param name: queue name for logs and stats
+        :param workers: number of concurrent delivery workers
+        :param maxsize: queue capacity, `put` waits when queue is full
+        :param batch_size: maximum number of queued messages worker passes
+        to sender at once
+        :param on_change: called whenever queue depth decreases
+        :param stop_timeout: seconds stop waits for delivery, messages
+        left are dropped, None waits until everything is delivered
+        """
+        self.sender = sender
+        self.dynamic_filters = dynamic_filters
+        self.name = name
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize)
+        self.batch_size = batch_size
+        self.on_change = on_change
+        self.stop_timeout = stop_timeout
+        self.tasks: List[asyncio.Task] = []
+        # taken by workers, but not delivered yet
+        self.in_flight = 0
+        # deliveries sender still works on after send_batch returned
+        self.pending: Set[asyncio.Future] = set()
+
+    @property
+    def depth(self) -> int:
+        """Messages queued or being delivered"""
+        return self.queue.qsize() + self.in_flight
+
+    async def start(self) -> None:
+        for number in range(self.workers):
+            self.tasks.append(asyncio.create_task(self.work(number)))
+        logger.debug(f'{self.name}: {self.workers} delivery worker(s) started')
+
+    async def drain(self) -> None:
+        """Wait until everything queued is delivered"""
+        if self.tasks:
+            await self.queue.join()
+        await asyncio.gather(*self.pending, return_exceptions=True)
+
+    async def stop(self) -> None:
+        """
+        Deliver everything queued, then stop workers
+        Messages not delivered within stop_timeout are dropped and
+        acknowledged, like failed deliveries, so offsets are still committed
+        """
+        try:
+            await asyncio.wait_for(self.drain(), self.stop_timeout)
+        except asyncio.TimeoutError:
+            logger.error(f'{self.name}: {self.depth} message(s) not '
+                         f'delivered within {self.stop_timeout} seconds, '
+                         f'dropped')
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        while not self.queue.empty():
+            _, ack = self.queue.get_nowait()
+            self.queue.task_done()
+            if ack is not None:
+                ack()
+        # sender drops deliveries whose futures are cancelled, acks of
+        # cancelled deliveries are called by done callbacks
+        for pending in self.pending:
+            pending.cancel()
+        await asyncio.gather(*self.pending, return_exceptions=True)
+
+    async def put(self, message: str, ack: Optional[Ack] = None) -> None:
+        """
+        :param message: formatted message
+        :param ack: called once sender is done with message
+        """
+        await self.queue.put((message, ack))
+
+    def acknowledge(self, ack: Optional[Ack],
+                    futures: List[asyncio.Future]) -> None:
+        """Call ack now or once sender resolves its futures"""
+        if ack is None:
+            return
+        if not futures:
+            ack()
+            return
+        pending = asyncio.gather(*futures, return_exceptions=True)
+        self.pending.add(pending)
+        pending.add_done_callback(lambda _: ack())
+        pending.add_done_callback(self.pending.discard)
+
+    async def work(self, number: int) -> None:
+        while True:
+            items = [await self.queue.get()]
+            while len(items) < self.batch_size and not self.queue.empty():
+                items.append(self.queue.get_nowait())
+            messages = [message for message, _ in items]
+            self.in_flight += len(items)
+            results = [[] for _ in items]
+            try:
+                # senders not tracking deliveries return nothing
+                results = await self.sender.send_batch(
+                    messages, self.dynamic_filters) or results
+            except Exception as e:
+                # failed messages are dropped, so they are acknowledged too
+                error_text = e.__class__.__name__ + ': ' + str(e)
+                logger.error(f'{self.name} worker #{number}: {error_text}')
+                self.sender.record_error()
+            finally:
+                for (_, ack), futures in zip(items, results):
+                    self.acknowledge(ack, futures)
+                self.in_flight -= len(items)
+                for _ in items:
+                    self.queue.task_done()
+                if self.on_change is not None:
+                    self.on_change()
@@ -1,8 +1,13 @@
-import re
+import asyncio
+import time
 from abc import ABC, abstractmethod
 import redis.asyncio as redis
-from typing import Optional
+from typing import Any, Dict, List, Optional, Set, Tuple
 from .loggers import filters_logger as logger
+from .matchers import LiteralMatcher, RegexpRuleset
+
+# critical-bot publishes changed Redis keys here
+INVALIDATION_CHANNEL = 'critical:patterns'
 
 
 class AbstractDynamicFilter(ABC):
@@ -14,6 +19,10 @@ class AbstractDynamicFilter(ABC):
     async def filter(self, message: str, key: str) -> bool:  # pragma: no cover
         raise NotImplementedError
 
+    async def filter_many(self, message: str, keys: List[str]) -> List[bool]:
+        """Check message against several receiver keys at once"""
+        return [await self.filter(message, key) for key in keys]
+
     async def start(self):  # pragma: no cover
         pass
 
@@ -27,44 +36,156 @@ class AbstractDynamicFilter(ABC):
 
 
 class RedisDynamicFilter(AbstractDynamicFilter, ABC):
-    def __init__(self, redis_instance: redis.Redis):
+    def __init__(self, redis_instance: redis.Redis,
+                 cache_ttl: float = 60,
+                 channel: str = INVALIDATION_CHANNEL):
+        """
+        :param redis_instance: Redis client
+        :param cache_ttl: how long pattern sets are cached, seconds.
+        0 disables cache, so Redis is asked on every message
+        :param channel: pub/sub channel to listen to for changed keys
+        """
         self.redis = redis_instance
+        self.cache_ttl = cache_ttl
+        self.channel = channel
+        self.cache: Dict[str, Tuple[float, Set[str]]] = {}
+        # bumped on every invalidation, protects from caching stale fetches
+        self.generation = 0
+        self.listener: Optional[asyncio.Task] = None
+        # compiled matchers along with pattern sets they were built from
+        self.compiled: Dict[str, Tuple[Set[str], Any]] = {}
+
+    async def start(self):
+        if self.cache_ttl:
+            self.listener = asyncio.create_task(self.listen())
 
     async def stop(self):
+        if self.listener is not None:
+            self.listener.cancel()
+            try:
+                await self.listener
+            except asyncio.CancelledError:
+                pass
+            self.listener = None
         await self.redis.close()
 
+    def invalidate(self, key: Optional[str] = None) -> None:
+        """Drop cached patterns of key (or of all keys)"""
+        self.generation += 1
+        if key is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(key, None)
+
+    async def listen(self) -> None:
+        """Drop cached keys as soon as they are reported changed"""
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                # anything could change while we were not subscribed
+                self.invalidate()
+                logger.info(f'Listening to {self.channel} for changes')
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        logger.debug(f'Patterns changed: {message["data"]}')
+                        self.invalidate(message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error_text = e.__class__.__name__ + ': ' + str(e)
+                logger.error(error_text)
+                self.invalidate()
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.close()
+
+    async def patterns(self, key: str) -> Set[str]:
+        """Get patterns of key, from cache if possible"""
+        return (await self.patterns_many([key]))[0]
+
+    async def patterns_many(self, keys: List[str]) -> List[Set[str]]:
+        """
+        Get patterns of several keys
+        Keys missing in cache are fetched within one pipeline
+        """
+        now = time.monotonic()
+        result = []
+        missing = []
+        for key in keys:
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] > now:
+                result.append(cached[1])
+            else:
+                result.append(None)
+                missing.append(key)
+        if not missing:
+            return result
+        generation = self.generation
+        if len(missing) == 1:
+            fetched = [await self.redis.smembers(missing[0])]
+        else:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for key in missing:
+                    pipe.smembers(key)
+                fetched = await pipe.execute()
+        fetched = dict(zip(missing, fetched))
+        if self.cache_ttl and generation == self.generation:
+            for key, patterns in fetched.items():
+                self.cache[key] = (now + self.cache_ttl, patterns)
+        return [fetched[key] if patterns is None else patterns
+                for key, patterns in zip(keys, result)]
+
+    @abstractmethod
+    def compile(self, patterns: Set[str]) -> Any:  # pragma: no cover
+        """Build matcher with `search(message) -> bool` method"""
+        raise NotImplementedError
+
+    def _matcher(self, key: str, patterns: Set[str]) -> Any:
+        """Get matcher of key, rebuild it only if patterns have changed"""
+        compiled = self.compiled.get(key)
+        if compiled is not None:
+            if compiled[0] is patterns:
+                return compiled[1]
+            if compiled[0] == patterns:
+                self.compiled[key] = (patterns, compiled[1])
+                return compiled[1]
+        matcher = self.compile(patterns)
+        self.compiled[key] = (patterns, matcher)
+        return matcher
+
+    async def matcher(self, key: str) -> Any:
+        return self._matcher(key, await self.patterns(key))
+
+    async def filter(self, message: str, key: str) -> bool:
+        matcher = await self.matcher(key)
+        return matcher.search(message)
+
+    async def filter_many(self, message: str, keys: List[str]) -> List[bool]:
+        all_patterns = await self.patterns_many(keys)
+        return [self._matcher(key, patterns).search(message)
+                for key, patterns in zip(keys, all_patterns)]
+
     @classmethod
     def from_dict(cls, settings: dict):
         host = settings.get('host', 'localhost')
         port = settings.get('port', 6379)
         db = settings.get('db', 0)
+        cache_ttl = settings.get('cache_ttl', 60)
+        channel = settings.get('channel', INVALIDATION_CHANNEL)
         redis_instance = redis.Redis(host=host, port=port, db=db,
                                      decode_responses=True)
-        return cls(redis_instance)
+        return cls(redis_instance, cache_ttl, channel)
 
 
 class RedisExcludePattern(RedisDynamicFilter):
-    async def filter(self, message: str, key: str) -> bool:  # pragma: no cover
-        patterns = await self.redis.smembers(key)
-        pattern_present = any(pattern in message
-                              for pattern in patterns)
-        return pattern_present
+    def compile(self, patterns: Set[str]) -> LiteralMatcher:
+        return LiteralMatcher(patterns)
 
 
 class RedisExcludeRegexp(RedisDynamicFilter):
-    async def filter(self, message: str, key: str) -> bool:
-        patterns = await self.redis.smembers(key)
-        hit = False
-        for pattern in patterns:
-            try:
-                regexp = re.compile(pattern)
-            except re.error:
-                hit = pattern in message
-            else:
-                hit = regexp.search(message) is not None
-            if hit:
-                break
-        return hit
+    def compile(self, patterns: Set[str]) -> RegexpRuleset:
+        return RegexpRuleset(patterns)
 
 
 class DummyDynamicFilter(AbstractDynamicFilter):  # pragma: no cover
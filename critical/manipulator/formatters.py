@@ -1,10 +1,63 @@
+import string
 from abc import ABC, abstractmethod
+from operator import itemgetter
+from typing import Any, Callable, FrozenSet, Optional
 
-from .models import GELFMessage
+from .models import GELFMessage, field_getter, to_alias
 from .loggers import formatters_logger as logger
 
+CONVERSIONS = {'r': repr, 's': str, 'a': ascii}
+
+
+def compile_template(template: str,
+                     resolve: Callable[[str], Callable[[Any], Any]]
+                     ) -> Callable[[Any], str]:
+    """
+    Parse str.format-like template once
+    :param template: template with named fields, e.g. `{host}: {message}`
+    :param resolve: turns field name into getter applied to render argument
+    :return: render function
+    """
+    parts = []
+    for literal, field_name, format_spec, conversion in \
+            string.Formatter().parse(template):
+        if literal:
+            parts.append(literal)
+        if field_name is None:
+            continue
+        if not field_name or field_name.isdigit():
+            raise ValueError('Only named fields are allowed in template')
+        if '{' in format_spec:
+            raise ValueError('Nested fields are not allowed in template')
+        convert = CONVERSIONS.get(conversion)
+        parts.append((resolve(field_name), convert, format_spec))
+
+    def render(source: Any) -> str:
+        chunks = []
+        for part in parts:
+            if part.__class__ is str:
+                chunks.append(part)
+                continue
+            getter, convert, format_spec = part
+            value = getter(source)
+            if convert is not None:
+                value = convert(value)
+            chunks.append(format(value, format_spec))
+        return ''.join(chunks)
+    return render
+
+
+def template_fields(template: str) -> FrozenSet[str]:
+    """Names of all fields referenced in template"""
+    return frozenset(field_name for _, field_name, _, _
+                     in string.Formatter().parse(template)
+                     if field_name)
+
 
 class AbstractFormatter(ABC):
+    # GELF keys used by formatter, None means formatter may use any field
+    required_fields: Optional[FrozenSet[str]] = None
+
     @abstractmethod  # pragma: no cover
     def __init__(self, **kwargs):
         raise NotImplementedError
@@ -21,16 +74,15 @@ class AbstractFormatter(ABC):
 class CopyFieldFormatter(AbstractFormatter):
     def __init__(self, field: str):
         logger.debug('CopyField formatter initializing...')
-        if field.endswith('_'):
-            field = '_' + field[:-1]
+        field = to_alias(field)
         self.field = field
+        self.required_fields = frozenset({field})
+        self.getter = field_getter(field)
         logger.debug(f'Field: {self.field}')
         logger.info('CopyField formatter has been set')
 
     def format(self, obj: GELFMessage) -> str:
-        logger.debug('Start copy field message formatting')
-        logger.debug(f'Field: {self.field}')
-        result = str(obj.dict(by_alias=True).get(self.field))
+        result = str(self.getter(obj))
         logger.debug(f'Outgoing message: {result}')
         return result
 
@@ -45,20 +97,23 @@ class SimpleMailFormatter(AbstractFormatter):
                  body_field: str,
                  template: str = None,
                  **kwargs):
-        if subject_field.endswith('_'):
-            subject_field = '_' + subject_field[:-1]
-        if body_field.endswith('_'):
-            body_field = '_' + body_field[:-1]
+        subject_field = to_alias(subject_field)
+        body_field = to_alias(body_field)
         self.subject_field = subject_field
         self.body_field = body_field
+        self.required_fields = frozenset({subject_field, body_field,
+                                          '_timestamp'})
         self.template = template or 'Subject: {subject}\n\n{body}'
+        self.subject_getter = field_getter(subject_field)
+        self.body_getter = field_getter(body_field)
+        self.render = compile_template(self.template, itemgetter)
 
     def format(self, obj: GELFMessage) -> str:
-        subject = str(obj.dict(by_alias=True).get(self.subject_field))
-        body = str(obj.dict(by_alias=True).get(self.body_field))
+        subject = str(self.subject_getter(obj))
+        body = str(self.body_getter(obj))
         body += '\n\n'
         body += obj.timestamp_.isoformat()
-        text = self.template.format(subject=subject, body=body)
+        text = self.render({'subject': subject, 'body': body})
         return text
 
     @classmethod
@@ -71,6 +126,31 @@ class SimpleMailFormatter(AbstractFormatter):
                                    template=template)
 
 
+class TemplateFormatter(AbstractFormatter):
+    def __init__(self, template: str):
+        """
+        :param template: str.format-like template referencing GELF fields,
+        e.g. `{host} ({_gl2_remote_ip}): {short_message}`
+        """
+        logger.debug('Template formatter initializing...')
+        self.template = template
+        logger.debug(f'Template: {self.template}')
+        self.required_fields = frozenset(map(to_alias,
+                                             template_fields(template)))
+        self.render = compile_template(template, field_getter)
+        logger.info('Template formatter has been set')
+
+    def format(self, obj: GELFMessage) -> str:
+        result = self.render(obj)
+        logger.debug(f'Outgoing message: {result}')
+        return result
+
+    @classmethod
+    def from_dict(cls, settings: dict):
+        template = settings.get('template')
+        return TemplateFormatter(template)
+
+
 class DummyFormatter(AbstractFormatter):  # pragma: no cover
     def __init__(self, **kwargs):
         pass
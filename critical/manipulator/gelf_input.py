@@ -0,0 +1,133 @@
+import asyncio
+import time
+import zlib
+from typing import Callable, Dict, List, Optional
+
+from .loggers import consumers_logger as logger
+
+CHUNK_MAGIC = b'\x1e\x0f'
+# magic, message ID (8 bytes), sequence number, sequence count
+CHUNK_HEADER_SIZE = 12
+MAX_CHUNKS = 128
+GZIP_MAGIC = b'\x1f\x8b'
+ZLIB_MAGIC = b'\x78'
+
+
+def decompress(data: bytes, max_size: int) -> bytes:
+    """
+    Decompress zlib or gzip GELF payload, uncompressed one is returned as is
+    :param data: payload
+    :param max_size: larger messages are rejected, so a small datagram
+    can't be inflated into huge one
+    :return: GELF JSON
+    """
+    if data[:2] == GZIP_MAGIC:
+        wbits = 16 + zlib.MAX_WBITS
+    elif data[:1] == ZLIB_MAGIC:
+        wbits = zlib.MAX_WBITS
+    else:
+        return data
+    decompressor = zlib.decompressobj(wbits)
+    result = decompressor.decompress(data, max_size)
+    if decompressor.unconsumed_tail:
+        raise ValueError(f'Message is larger than {max_size} bytes')
+    return result
+
+
+class PartialMessage:
+    __slots__ = ('created_at', 'chunks', 'received', 'size')
+
+    def __init__(self, count: int):
+        self.created_at = time.monotonic()
+        self.chunks: List[Optional[bytes]] = [None] * count
+        self.received = 0
+        self.size = 0
+
+
+class ChunkAssembler:
+    def __init__(self, timeout: float = 5, max_messages: int = 1000,
+                 max_size: int = 1048576):
+        """
+        Reassemble chunked GELF messages
+        Incomplete messages are dropped after timeout, as GELF spec says
+        :param timeout: seconds to wait for the rest of chunks
+        :param max_messages: incomplete messages kept at once, the oldest
+        one is dropped to make room for a new one
+        :param max_size: messages growing larger are dropped
+        """
+        self.timeout = timeout
+        self.max_messages = max_messages
+        self.max_size = max_size
+        # in order of creation, so expired messages are at the beginning
+        self.messages: Dict[bytes, PartialMessage] = {}
+        self.dropped = 0
+
+    def expire(self) -> None:
+        deadline = time.monotonic() - self.timeout
+        while self.messages:
+            message_id = next(iter(self.messages))
+            if self.messages[message_id].created_at > deadline:
+                break
+            del self.messages[message_id]
+            self.dropped += 1
+
+    def add(self, datagram: bytes) -> Optional[bytes]:
+        """
+        :param datagram: GELF chunk
+        :return: whole payload once every chunk is received
+        """
+        if len(datagram) < CHUNK_HEADER_SIZE:
+            raise ValueError('Truncated chunk header')
+        message_id = datagram[2:10]
+        number, count = datagram[10], datagram[11]
+        if not count or count > MAX_CHUNKS or number >= count:
+            raise ValueError(f'Malformed chunk {number}/{count}')
+        self.expire()
+        message = self.messages.get(message_id)
+        if message is None:
+            if len(self.messages) >= self.max_messages:
+                del self.messages[next(iter(self.messages))]
+                self.dropped += 1
+            message = self.messages[message_id] = PartialMessage(count)
+        if len(message.chunks) != count:
+            raise ValueError('Chunk count changed within message')
+        if message.chunks[number] is None:
+            chunk = datagram[CHUNK_HEADER_SIZE:]
+            message.chunks[number] = chunk
+            message.received += 1
+            message.size += len(chunk)
+        if message.size > self.max_size:
+            del self.messages[message_id]
+            raise ValueError(f'Message is larger than {self.max_size} bytes')
+        if message.received < count:
+            return None
+        del self.messages[message_id]
+        return b''.join(message.chunks)
+
+
+class GELFUDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, on_message: Callable[[bytes], None],
+                 assembler: ChunkAssembler, max_message_size: int):
+        """
+        :param on_message: called with every complete uncompressed payload
+        :param assembler: chunk reassembly buffer
+        :param max_message_size: decompressed size limit
+        """
+        self.on_message = on_message
+        self.assembler = assembler
+        self.max_message_size = max_message_size
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        try:
+            if data[:2] == CHUNK_MAGIC:
+                data = self.assembler.add(data)
+                if data is None:
+                    return
+            payload = decompress(data, self.max_message_size)
+        except (ValueError, zlib.error) as e:
+            logger.warning(f'GELF UDP from {addr[0]}: {e}')
+            return
+        self.on_message(payload)
+
+    def error_received(self, exc: Exception) -> None:
+        logger.error(f'GELF UDP: {exc}')
@@ -1,12 +1,19 @@
-from typing import List, Type, TypeVar
+import asyncio
+import json
+import time
+from typing import (Any, Collection, Dict, FrozenSet, List, Optional,
+                    Tuple, Type, TypeVar)
 
 from critical.manipulator import formatters, static_filters, \
     dynamic_filters, senders
 
-from .static_filters import AbstractStaticFilter
+from .decoders import get_decoder
+from .delivery import Ack, Acknowledgement, OutboundQueue
+from .static_filters import AbstractStaticFilter, AdaptiveFilterChain
 from .dynamic_filters import AbstractDynamicFilter
 from .formatters import AbstractFormatter
 from .loggers import handlers_logger as logger
+from .metrics import METRICS
 from .models import GELFMessage
 from .senders import AbstractAsyncSender
 
@@ -14,6 +21,11 @@ from .senders import AbstractAsyncSender
 AnyHandler = TypeVar('AnyHandler', bound='Handler')
 
 
+def settings_key(settings: dict) -> str:
+    """Components built from equal settings are interchangeable"""
+    return json.dumps(settings, sort_keys=True, default=str)
+
+
 class Handler:
     def __init__(
             self,
@@ -22,38 +34,266 @@ class Handler:
             formatter: AbstractFormatter,
             sender_list: List[AbstractAsyncSender],
             consumer_specification: str,
-            name: str = 'Unnamed Handler'):
+            name: str = 'Unnamed Handler',
+            decoding: str = 'full',
+            filter_chain: Optional[AdaptiveFilterChain] = None,
+            delivery: Optional[dict] = None):
+        """
+        :param delivery: outbound queues settings: `queue_size` (per
+        sender), `high_water` and `low_water` marks of the fullest queue,
+        `stop_timeout` seconds to deliver queued messages on stop
+        """
         logger.debug('Handler initializing')
         self.static_filters = static_filter_list
+        self.filter_chain = filter_chain
         self.dynamic_filters = dynamic_filter_list
         self.formatter = formatter
         self.senders = sender_list
         self.consumer_specification = consumer_specification
         self.name = name
+        self.decoding = decoding
+        self.decoder = get_decoder(decoding, self.required_fields)
+        delivery = delivery or {}
+        queue_size = delivery.get('queue_size', 1000)
+        self.high_water = delivery.get('high_water', queue_size * 4 // 5)
+        self.low_water = delivery.get('low_water', queue_size // 5)
+        self.queues = [OutboundQueue(sender, self.dynamic_filters,
+                                     f'{sender.__class__.__name__}#{index}',
+                                     sender.delivery_workers, queue_size,
+                                     on_change=self.check_backpressure,
+                                     stop_timeout=delivery.get(
+                                         'stop_timeout', 10))
+                       for index, sender in enumerate(self.senders)]
+        # set while queues are below high water mark
+        self.drained = asyncio.Event()
+        self.drained.set()
+        # senders and dynamic filters with settings they were built from,
+        # lets reloaded handler reuse them
+        self.keyed_components: List[Tuple[str, Any]] = []
+        # components taken from previous handler, already started
+        self.shared: List[Any] = []
         logger.info(f'{self.name} handler has been set')
 
+    @property
+    def required_fields(self) -> Optional[FrozenSet[str]]:
+        """GELF keys used by static filters and formatter"""
+        fields = set()
+        for component in [*self.static_filters, self.formatter]:
+            if component.required_fields is None:
+                return None
+            fields.update(component.required_fields)
+        return frozenset(fields)
+
+    @property
+    def components(self) -> List[Any]:
+        """Senders and dynamic filters, the ones holding connections"""
+        return [*self.senders, *self.dynamic_filters]
+
     async def start(self) -> None:
-        for sender in self.senders:
-            await sender.start()
-        for dynamic_filter in self.dynamic_filters:
-            await dynamic_filter.start()
-
-    async def stop(self) -> None:
-        for sender in self.senders:
-            await sender.stop()
-        for dynamic_filter in self.dynamic_filters:
-            await dynamic_filter.stop()
-
-    async def handle(self, obj: GELFMessage) -> None:
-        if not all(filter_.filter(obj) for filter_ in self.static_filters):
+        for component in self.components:
+            if component not in self.shared:
+                await component.start()
+        for queue in self.queues:
+            await queue.start()
+
+    async def stop(self, keep: Collection[Any] = ()) -> None:
+        """
+        :param keep: senders and dynamic filters left running, because
+        they are passed to another handler
+        """
+        logger.info(f'{self.name} handler stats: {self.stats()}')
+        for queue in self.queues:
+            await queue.stop()
+        for component in self.components:
+            if component not in keep:
+                await component.stop()
+
+    def stats(self) -> dict:
+        if self.filter_chain is not None:
+            static_filters_stats = self.filter_chain.dump()
+        else:
+            static_filters_stats = []
+        return {'handler': self.name,
+                'static_filters': static_filters_stats,
+                'queue_depth': self.queue_depth}
+
+    @property
+    def queue_depth(self) -> Dict[str, int]:
+        return {queue.name: queue.depth for queue in self.queues}
+
+    @property
+    def saturated(self) -> bool:
+        """True from reaching high water mark until going below low one"""
+        return not self.drained.is_set()
+
+    def check_backpressure(self) -> None:
+        depth = max((queue.depth for queue in self.queues), default=0)
+        if depth >= self.high_water and not self.saturated:
+            logger.warning(f'{self.name}: outbound queue depth {depth}, '
+                           f'pausing consumption')
+            self.drained.clear()
+        elif depth <= self.low_water and self.saturated:
+            logger.warning(f'{self.name}: outbound queue depth {depth}, '
+                           f'resuming consumption')
+            self.drained.set()
+
+    async def wait_drained(self, timeout: Optional[float] = None) -> bool:
+        """Wait until queues go below low water mark"""
+        try:
+            await asyncio.wait_for(self.drained.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def passes(self, obj: GELFMessage) -> bool:
+        """Check message against all static filters"""
+        if self.filter_chain is not None:
+            return self.filter_chain.filter(obj)
+        return all(filter_.filter(obj) for filter_ in self.static_filters)
+
+    def rejected_by(self, obj: GELFMessage) -> Optional[str]:
+        """
+        Same as passes, but tells which filter rejected message
+        :return: filter name or None if message passes
+        """
+        if self.filter_chain is not None:
+            if self.filter_chain.filter(obj):
+                return None
+            return self.filter_chain.rejected_by
+        for index, filter_ in enumerate(self.static_filters):
+            if not filter_.filter(obj):
+                return f'{filter_.__class__.__name__}#{index}'
+        return None
+
+    async def handle(self, obj: GELFMessage, ack: Optional[Ack] = None
+                     ) -> None:
+        """
+        :param obj: GELF message
+        :param ack: called once every sender is done with message
+        (or right away if message is filtered out)
+        """
+        await self.handle_batch([obj], None if ack is None else [ack])
+
+    async def handle_batch(self, objs: List[GELFMessage],
+                           acks: Optional[List[Ack]] = None) -> None:
+        """
+        :param objs: GELF messages
+        :param acks: callbacks, one per message, same as for handle
+        """
+        if METRICS.enabled:
+            messages = self.measured_filter_format(objs, acks)
+        else:
+            messages = []
+            for index, obj in enumerate(objs):
+                ack = None if acks is None else acks[index]
+                try:
+                    if not self.passes(obj):
+                        if ack is not None:
+                            ack()
+                        continue
+                    message = self.formatter.format(obj)
+                except Exception as e:
+                    self.drop(e, ack)
+                    continue
+                messages.append((message, self.acknowledgement(ack)))
+        logger.debug(f'{len(messages)} of {len(objs)} messages passed '
+                     f'static filters')
+        if not messages:
             return
-        message = self.formatter.format(obj)
-        for sender in self.senders:
-            await sender.send(message, self.dynamic_filters)
+        handed = 0
+        try:
+            for queue in self.queues:
+                for message, ack in messages:
+                    await queue.put(message, ack)
+                    handed += 1
+        except Exception:
+            # parts not handed to queues are dropped, so they are done
+            for index in range(handed, len(self.queues) * len(messages)):
+                ack = messages[index % len(messages)][1]
+                if ack is not None:
+                    ack()
+            raise
+        self.check_backpressure()
+
+    def acknowledgement(self, ack: Optional[Ack]) -> Optional[Ack]:
+        """Wrap ack to be called once every queue is done with message"""
+        if ack is None:
+            return None
+        return Acknowledgement(ack, len(self.queues))
+
+    def drop(self, error: Exception, ack: Optional[Ack]) -> None:
+        """
+        Drop message static filter or formatter failed on
+        It is acknowledged, like failed deliveries
+        """
+        error_text = error.__class__.__name__ + ': ' + str(error)
+        logger.error(f'{self.name}: message dropped, {error_text}')
+        if ack is not None:
+            ack()
+
+    def measured_filter_format(self, objs: List[GELFMessage],
+                               acks: Optional[List[Ack]] = None
+                               ) -> List[tuple]:
+        """handle_batch filtering and formatting with metrics recorded"""
+        METRICS.consumed.inc(self.name, amount=len(objs))
+        started = time.perf_counter()
+        passed = []
+        for index, obj in enumerate(objs):
+            ack = None if acks is None else acks[index]
+            try:
+                rejected_by = self.rejected_by(obj)
+            except Exception as e:
+                self.drop(e, ack)
+                continue
+            if rejected_by is not None:
+                METRICS.static_rejections.inc(self.name, rejected_by)
+                if ack is not None:
+                    ack()
+                continue
+            passed.append((obj, ack))
+        filtered_at = time.perf_counter()
+        messages = []
+        for obj, ack in passed:
+            try:
+                message = self.formatter.format(obj)
+            except Exception as e:
+                self.drop(e, ack)
+                continue
+            messages.append((message, self.acknowledgement(ack)))
+        formatted_at = time.perf_counter()
+        if objs:
+            METRICS.latency.observe((filtered_at - started) / len(objs),
+                                    'filter', count=len(objs))
+        if passed:
+            METRICS.latency.observe((formatted_at - filtered_at)
+                                    / len(passed), 'format',
+                                    count=len(passed))
+        METRICS.filtered.inc(self.name, amount=len(objs) - len(passed))
+        METRICS.queued.inc(self.name, amount=len(messages))
+        return messages
 
     @classmethod
-    def from_dict(cls, config: dict) -> AnyHandler:
+    def from_dict(cls, config: dict,
+                  previous: Optional['Handler'] = None) -> AnyHandler:
+        """
+        :param config: handler config
+        :param previous: handler being replaced, its senders and dynamic
+        filters are reused if their settings did not change
+        """
         logger.info('Creating handler from dict...')
+        available = list(previous.keyed_components) if previous else []
+        keyed_components = []
+        shared = []
+
+        def reuse(settings: dict) -> Tuple[str, Any]:
+            key = settings_key(settings)
+            for index, (available_key, component) in enumerate(available):
+                if available_key == key:
+                    del available[index]
+                    shared.append(component)
+                    return key, component
+            return key, None
+
         formatter_settings = config.get('formatter')
         formatter_cls_name = formatter_settings.pop('class')
         try:
@@ -68,6 +308,12 @@ class Handler:
         senders_ = []
         all_senders_settings = config.pop('senders')
         for sender_settings in all_senders_settings:
+            key, sender = reuse(sender_settings)
+            if sender is not None:
+                logger.info(f'{sender.__class__.__name__} reused')
+                keyed_components.append((key, sender))
+                senders_.append(sender)
+                continue
             sender_cls_name = sender_settings.pop('class')
             try:
                 sender_cls: Type[AbstractAsyncSender] = getattr(
@@ -76,7 +322,10 @@ class Handler:
                 logger.critical(f'Sender class {sender_cls_name} '
                                 f'does not exist')
                 raise
+            delivery_workers = sender_settings.pop('delivery_workers', 1)
             sender = sender_cls.from_dict(sender_settings)
+            sender.delivery_workers = delivery_workers
+            keyed_components.append((key, sender))
             senders_.append(sender)
 
         static_filters_ = []
@@ -96,6 +345,12 @@ class Handler:
         dynamic_filters_ = []
         all_dynamic_filters_settings = config.get('dynamic_filters', [])
         for dynamic_filter_settings in all_dynamic_filters_settings:
+            key, filter_ = reuse(dynamic_filter_settings)
+            if filter_ is not None:
+                logger.info(f'{filter_.__class__.__name__} reused')
+                keyed_components.append((key, filter_))
+                dynamic_filters_.append(filter_)
+                continue
             filter_cls_name = dynamic_filter_settings.pop('class')
             try:
                 filter_cls: Type[AbstractDynamicFilter] = getattr(
@@ -105,10 +360,116 @@ class Handler:
                                 f'does not exist')
                 raise
             filter_ = filter_cls.from_dict(dynamic_filter_settings)
+            keyed_components.append((key, filter_))
             dynamic_filters_.append(filter_)
 
         name = config.get('name')
         logger.debug(f'Handler name: {name}')
         consumer_specification = config.get('consumer_specification')
-        return cls(static_filters_, dynamic_filters_, formatter, senders_,
-                   consumer_specification, name)
+        decoding = config.get('decoding', 'full')
+
+        filter_chain = None
+        adaptive_settings = config.get('adaptive_static_filters', False)
+        if adaptive_settings:
+            if not isinstance(adaptive_settings, dict):
+                adaptive_settings = {}
+            filter_chain = AdaptiveFilterChain(static_filters_,
+                                               **adaptive_settings)
+        delivery = config.get('delivery')
+        handler = cls(static_filters_, dynamic_filters_, formatter, senders_,
+                      consumer_specification, name, decoding, filter_chain,
+                      delivery)
+        handler.keyed_components = keyed_components
+        handler.shared = shared
+        return handler
+
+
+class HandlerGroup:
+    def __init__(self, handlers: List[Handler], name: str = None,
+                 consumer_specification: Optional[str] = None):
+        """
+        Handlers sharing one consumer: messages are consumed and decoded
+        once and then passed to every handler
+        :param handlers: handlers with the same consumer_specification
+        :param name: used for consumer group instead of handler name
+        :param consumer_specification: if set, handlers may have other
+        ones, for consumers ignoring topics (e.g. file replay)
+        """
+        self.handlers = handlers
+        if consumer_specification is None:
+            specifications = {handler.consumer_specification
+                              for handler in handlers}
+            if len(specifications) != 1:
+                raise ValueError('Grouped handlers must share '
+                                 'consumer_specification')
+            consumer_specification = specifications.pop()
+        self.consumer_specification = consumer_specification
+        self.name = name or self.consumer_specification
+        decodings = {handler.decoding for handler in handlers}
+        # every handler can work with fully decoded messages
+        self.decoding = decodings.pop() if len(decodings) == 1 else 'full'
+        self.decoder = get_decoder(self.decoding, self.required_fields)
+        handler_names = ', '.join(str(handler.name) for handler in handlers)
+        logger.info(f'{self.name} handler group has been set: '
+                    f'{handler_names}')
+
+    @property
+    def required_fields(self) -> Optional[FrozenSet[str]]:
+        fields = set()
+        for handler in self.handlers:
+            if handler.required_fields is None:
+                return None
+            fields.update(handler.required_fields)
+        return frozenset(fields)
+
+    async def start(self) -> None:
+        for handler in self.handlers:
+            await handler.start()
+
+    @property
+    def components(self) -> List[Any]:
+        return [component for handler in self.handlers
+                for component in handler.components]
+
+    async def stop(self, keep: Collection[Any] = ()) -> None:
+        for handler in self.handlers:
+            await handler.stop(keep)
+
+    def stats(self) -> List[dict]:
+        return [handler.stats() for handler in self.handlers]
+
+    @property
+    def saturated(self) -> bool:
+        return any(handler.saturated for handler in self.handlers)
+
+    async def wait_drained(self, timeout: Optional[float] = None) -> bool:
+        results = await asyncio.gather(
+            *(handler.wait_drained(timeout) for handler in self.handlers))
+        return all(results)
+
+    async def handle(self, obj: GELFMessage, ack: Optional[Ack] = None
+                     ) -> None:
+        await self.handle_batch([obj], None if ack is None else [ack])
+
+    async def handle_batch(self, objs: List[GELFMessage],
+                           acks: Optional[List[Ack]] = None) -> None:
+        """
+        Message is acknowledged once every handler is done with it
+        A failing handler doesn't affect the rest, its part is done
+        """
+        if acks is not None:
+            acks = [Acknowledgement(ack, len(self.handlers)) for ack in acks]
+        for handler in self.handlers:
+            # handler's part of each message is done once, even if failed
+            # handler acknowledged some of them already
+            shares = None
+            if acks is not None:
+                shares = [Acknowledgement(ack, 1) for ack in acks]
+            try:
+                await handler.handle_batch(objs, shares)
+            except Exception as e:
+                error_text = e.__class__.__name__ + ': ' + str(e)
+                logger.error(f'{handler.name}: batch dropped, {error_text}')
+                for share in shares or []:
+                    if share.remaining > 0:
+                        share()
@@ -1,4 +1,5 @@
 import logging
+import logging.handlers
 from rich.logging import RichHandler, Console
 
 FORMAT = '<%(name)s> %(message)s'
@@ -12,6 +13,34 @@ def customize_logger(level_name: str = 'WARN', format_: str = FORMAT) -> None:
     logging.getLogger('critical').setLevel(level_name)
 
 
+class WorkerFilter(logging.Filter):
+    def __init__(self, worker: int):
+        super().__init__()
+        self.suffix = f'#{worker}'
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not record.name.endswith(self.suffix):
+            record.name += self.suffix
+        return True
+
+
+def customize_worker_logger(queue, level_name: str = 'WARN',
+                            worker: int = 0) -> None:
+    """
+    Send records to supervisor process, logger names get worker number
+    :param queue: multiprocessing queue read by supervisor
+    :param level_name: logging level
+    :param worker: worker number
+    :return: None
+    """
+    handler = logging.handlers.QueueHandler(queue)
+    handler.addFilter(WorkerFilter(worker))
+    # record is formatted once more by supervisor handlers
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(handlers=[handler], force=True)
+    logging.getLogger('critical').setLevel(level_name)
+
+
 consumers_logger = logging.getLogger('critical.consumer')
 filters_logger = logging.getLogger('critical.filter')
 formatters_logger = logging.getLogger('critical.formatter')
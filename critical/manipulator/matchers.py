@@ -0,0 +1,109 @@
+import re
+from typing import Iterable, List, Optional
+
+
+class LiteralMatcher:
+    """
+    Multi-pattern substring matcher
+    Patterns are merged into one regular expression shaped as prefix tree,
+    so at every position of text only branches matching it are tried
+    """
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns = list(dict.fromkeys(patterns))
+        self.regexp: Optional[re.Pattern] = None
+        if len(self.patterns) > 1:
+            self.regexp = re.compile(self.tree_expression(self.patterns))
+
+    @classmethod
+    def tree_expression(cls, patterns: List[str]) -> str:
+        tree: dict = {}
+        for pattern in patterns:
+            node = tree
+            for char in pattern:
+                node = node.setdefault(char, {})
+            node[''] = {}
+        return cls.node_expression(tree)
+
+    @classmethod
+    def node_expression(cls, node: dict) -> str:
+        expression = ''
+        # chains without branching are plain literals
+        while len(node) == 1 and '' not in node:
+            char, node = next(iter(node.items()))
+            expression += re.escape(char)
+        if '' in node:
+            # pattern ends here, longer ones sharing its prefix are redundant
+            return expression
+        branches = []
+        chars = []
+        for char, child in node.items():
+            rest = cls.node_expression(child)
+            if rest:
+                branches.append(re.escape(char) + rest)
+            else:
+                chars.append(re.escape(char))
+        if len(chars) == 1:
+            branches.append(chars[0])
+        elif chars:
+            branches.append(f'[{"".join(chars)}]')
+        return f'{expression}(?:{"|".join(branches)})'
+
+    def find(self, text: str) -> Optional[str]:
+        """Return leftmost pattern found in text or None"""
+        if self.regexp is not None:
+            match = self.regexp.search(text)
+            return None if match is None else match.group()
+        if self.patterns and self.patterns[0] in text:
+            return self.patterns[0]
+        return None
+
+    def search(self, text: str) -> bool:
+        """Check if any of patterns is present in text"""
+        if self.regexp is not None:
+            return self.regexp.search(text) is not None
+        return bool(self.patterns) and self.patterns[0] in text
+
+
+# patterns that can not be safely merged into one alternation
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+GLOBAL_FLAGS = re.compile(r'^\(\?[aiLmsux]+\)')
+
+
+class RegexpRuleset:
+    """
+    Set of regular expressions searched as a whole
+    Valid expressions are merged into one alternation where possible,
+    invalid ones are searched as plain substrings
+    """
+    def __init__(self, patterns: Iterable[str]):
+        mergeable = []
+        self.regexps: List[re.Pattern] = []
+        literals = []
+        for pattern in patterns:
+            try:
+                regexp = re.compile(pattern)
+            except re.error:
+                literals.append(pattern)
+                continue
+            if regexp.groupindex or BACKREFERENCE.search(pattern) \
+                    or GLOBAL_FLAGS.match(pattern):
+                self.regexps.append(regexp)
+            else:
+                mergeable.append(pattern)
+        self.combined: Optional[re.Pattern] = None
+        if mergeable:
+            try:
+                self.combined = re.compile(
+                    '|'.join(f'(?:{pattern})' for pattern in mergeable))
+            except re.error:
+                self.regexps.extend(map(re.compile, mergeable))
+        self.literals = LiteralMatcher(literals)
+
+    def search(self, text: str) -> bool:
+        """Check if any of expressions matches text"""
+        if self.combined is not None and self.combined.search(text):
+            return True
+        for regexp in self.regexps:
+            if regexp.search(text):
+                return True
+        return self.literals.search(text)
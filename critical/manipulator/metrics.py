@@ -0,0 +1,208 @@
+import asyncio
+import functools
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .loggers import main_logger as logger
+
+# per-message stage latencies are usually microseconds
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01,
+                   0.05, 0.1, 0.5, 1, 5)
+
+
+def format_labels(names: Sequence[str], values: Sequence[str],
+                  extra: str = '') -> str:
+    pairs = [f'{name}="{escape(value)}"'
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = ()):
+        """
+        :param name: metric name
+        :param documentation: HELP line
+        :param labels: label names, values are passed positionally
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    def samples(self) -> List[str]:  # pragma: no cover
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{format_labels(self.labels, labels)} '
+                f'{format_value(value)}'
+                for labels, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float, *labels) -> None:
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # per label set: observations in each bucket (not cumulative), sum
+        self.values: Dict[Tuple, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels, count: int = 1) -> None:
+        """
+        :param value: observed value
+        :param labels: label values
+        :param count: number of observations with that value, lets batch
+        average be recorded for every message of the batch at once
+        """
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = ([0] * len(self.buckets), [0.0])
+        counts, total = entry
+        counts[bisect_left(self.buckets, value)] += count
+        total[0] += value * count
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{format_value(float(bound))}"'
+                lines.append(f'{self.name}_bucket'
+                             f'{format_labels(self.labels, labels, le)} '
+                             f'{cumulative}')
+            label_text = format_labels(self.labels, labels)
+            lines.append(f'{self.name}_sum{label_text} '
+                         f'{format_value(total[0])}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        """
+        All metrics of the process
+        Instrumented code checks `enabled` before measuring anything,
+        so disabled metrics cost one attribute lookup
+        """
+        self.enabled = False
+        self.consumed = Counter('critical_messages_consumed_total',
+                                'Messages passed to handler', ['handler'])
+        self.filtered = Counter('critical_messages_filtered_total',
+                                'Messages rejected by static filters',
+                                ['handler'])
+        self.queued = Counter('critical_messages_queued_total',
+                              'Messages formatted and queued for senders',
+                              ['handler'])
+        self.static_rejections = Counter(
+            'critical_static_filter_rejections_total',
+            'Messages rejected by static filter', ['handler', 'filter'])
+        self.dynamic_rejections = Counter(
+            'critical_dynamic_filter_rejections_total',
+            'Receivers skipped by dynamic filter', ['sender', 'filter'])
+        self.latency = Histogram('critical_stage_latency_seconds',
+                                 'Per-message latency of pipeline stages',
+                                 ['stage'])
+        self.sender_errors = Counter('critical_sender_errors_total',
+                                     'Failed deliveries', ['sender'])
+        self.sender_retries = Counter('critical_sender_retries_total',
+                                      'Retried deliveries', ['sender'])
+        self.lag = Gauge('critical_consumer_lag',
+                         'Records behind partition end',
+                         ['topic', 'partition'])
+        self.all = [self.consumed, self.filtered, self.queued,
+                    self.static_rejections, self.dynamic_rejections,
+                    self.latency, self.sender_errors, self.sender_retries,
+                    self.lag]
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        return '\n'.join(metric.render() for metric in self.all) + '\n'
+
+
+METRICS = Metrics()
+
+
+async def handle_request(reader: asyncio.StreamReader,
+                         writer: asyncio.StreamWriter,
+                         metrics: Metrics = METRICS) -> None:
+    try:
+        request = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        parts = request.split()
+        path = parts[1].split(b'?')[0] if len(parts) > 1 else b''
+        if path == b'/metrics':
+            status = '200 OK'
+            body = metrics.render().encode('utf-8')
+        else:
+            status = '404 Not Found'
+            body = b'Not Found\n'
+        writer.write(f'HTTP/1.1 {status}\r\n'
+                     f'Content-Type: text/plain; version=0.0.4; '
+                     f'charset=utf-8\r\n'
+                     f'Content-Length: {len(body)}\r\n'
+                     f'Connection: close\r\n\r\n'.encode('ascii') + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_metrics(host: str = '127.0.0.1', port: int = 9108,
+                        metrics: Optional[Metrics] = None
+                        ) -> asyncio.AbstractServer:
+    """
+    Enable metrics and expose them at http://host:port/metrics
+    :param metrics: metrics to serve, global METRICS by default
+    :return: server, close it to stop serving
+    """
+    metrics = metrics or METRICS
+    metrics.enabled = True
+    server = await asyncio.start_server(
+        functools.partial(handle_request, metrics=metrics), host, port)
+    logger.error(f'Metrics are served at http://{host}:{port}/metrics')
+    return server
@@ -1,8 +1,11 @@
 import datetime
 import ipaddress
+import socket
+from typing import Any, Callable, Tuple, Union
 import uuid
 
-from pydantic import BaseModel, Field, Extra
+from pydantic import BaseModel, Field, Extra, IPvAnyAddress, ValidationError
+from pydantic.datetime_parse import parse_datetime
 
 
 class GELFMessage(BaseModel):
@@ -13,7 +16,7 @@ class GELFMessage(BaseModel):
     level: int
     full_message: str
     level_: int = Field(..., alias='_level')
-    gl2_remote_ip_: ipaddress.IPv4Address = Field(..., alias='_gl2_remote_ip')
+    gl2_remote_ip_: IPvAnyAddress = Field(..., alias='_gl2_remote_ip')
     gl2_remote_port_: int = Field(..., alias='_gl2_remote_port')
     gl2_message_id_: str = Field(..., alias='_gl2_message_id')
     kafka_topic_: str = Field(..., alias='_kafka_topic')
@@ -30,3 +33,191 @@ class GELFMessage(BaseModel):
 
     class Config:
         extra = Extra.allow
+
+
+GELF_FIELDS = {field.alias: field for field in GELFMessage.__fields__.values()}
+ATTRIBUTE_ALIASES = {name: field.alias
+                     for name, field in GELFMessage.__fields__.items()}
+ALIAS_ATTRIBUTES = {alias: name for name, alias in ATTRIBUTE_ALIASES.items()}
+
+
+def to_alias(field: str) -> str:
+    """Turn GELF field name (`full_message_` or `_full_message`) into key"""
+    if field.endswith('_'):
+        field = '_' + field[:-1]
+    return field
+
+
+def to_attribute(field: str) -> str:
+    """Turn GELF field name into message attribute name"""
+    return ALIAS_ATTRIBUTES.get(to_alias(field), field)
+
+
+def field_getter(field: str) -> Callable[[Any], Any]:
+    """
+    Build function reading GELF field from message directly,
+    without dumping whole message into dict
+    Missing fields (e.g. absent extra fields) are read as None
+    """
+    attribute = to_attribute(field)
+
+    def getter(obj):
+        return getattr(obj, attribute, None)
+    return getter
+
+
+class LazyGELFMessage:
+    """
+    GELF message that validates each field on first access only
+    Raw values may contain only part of the fields (projection)
+    """
+    __slots__ = ('_raw', '_values')
+
+    def __init__(self, raw: dict):
+        self._raw = raw
+        self._values = {}
+
+    def _get(self, alias: str):
+        try:
+            return self._values[alias]
+        except KeyError:
+            pass
+        try:
+            value = self._raw[alias]
+        except KeyError:
+            raise AttributeError(f'GELF message has no field {alias}') \
+                from None
+        field = GELF_FIELDS.get(alias)
+        if field is not None:
+            value, error = field.validate(value, {}, loc=alias,
+                                          cls=GELFMessage)
+            if error:
+                raise ValidationError([error], GELFMessage)
+        self._values[alias] = value
+        return value
+
+    def __getattr__(self, name: str):
+        # called for own slots before they are set (e.g. by copy or
+        # pickle), extra GELF fields start with one underscore only
+        if name in self.__slots__ or name.startswith('__'):
+            raise AttributeError(name)
+        return self._get(ATTRIBUTE_ALIASES.get(name, name))
+
+    def dict(self, by_alias: bool = False) -> dict:
+        result = {}
+        for alias in self._raw:
+            key = alias if by_alias else ALIAS_ATTRIBUTES.get(alias, alias)
+            result[key] = self._get(alias)
+        return result
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({self._raw!r})'
+
+
+def ip_to_int(address: str) -> Tuple[int, int]:
+    """Turn IPv4/IPv6 address into (version, integer) pair"""
+    try:
+        if ':' in address:
+            packed = socket.inet_pton(socket.AF_INET6, address)
+            return 6, int.from_bytes(packed, 'big')
+        packed = socket.inet_pton(socket.AF_INET, address)
+        return 4, int.from_bytes(packed, 'big')
+    except (OSError, TypeError):
+        raise ValueError(f'{address!r} is not a valid IP address') from None
+
+
+def parse_timestamp(value) -> datetime.datetime:
+    """Same parsing as GELFMessage fields get, e.g. `Z` suffix is valid"""
+    return parse_datetime(value)
+
+
+class CompactGELFMessage:
+    """
+    Memory-friendly GELF message with the same attributes as GELFMessage
+    Source IP is stored as int (plus version), timestamps and UUIDs are
+    converted on access
+    """
+    __slots__ = ('version', 'host', 'short_message', 'level', 'full_message',
+                 'level_', 'gl2_remote_port_', 'gl2_message_id_',
+                 'kafka_topic_', 'source_', 'message_', 'gl2_source_input_',
+                 'full_message_', 'facility_num_', 'forwarder_', 'facility_',
+                 'gl2_remote_ip_int', 'gl2_remote_ip_version',
+                 '_raw_timestamp', '_raw_timestamp_iso',
+                 '_raw_gl2_source_node', '_raw_id', 'extra')
+
+    def __init__(self, data: dict):
+        try:
+            self.version = data['version']
+            self._raw_timestamp = data['timestamp']
+            self.host = data['host']
+            self.short_message = data['short_message']
+            self.level = int(data['level'])
+            self.full_message = data['full_message']
+            self.level_ = int(data['_level'])
+            self.gl2_remote_ip_version, self.gl2_remote_ip_int = \
+                ip_to_int(data['_gl2_remote_ip'])
+            self.gl2_remote_port_ = int(data['_gl2_remote_port'])
+            self.gl2_message_id_ = data['_gl2_message_id']
+            self.kafka_topic_ = data['_kafka_topic']
+            self.source_ = data['_source']
+            self.message_ = data['_message']
+            self.gl2_source_input_ = data['_gl2_source_input']
+            self.full_message_ = data['_full_message']
+            self.facility_num_ = int(data['_facility_num'])
+            self.forwarder_ = data['_forwarder']
+            self._raw_gl2_source_node = data['_gl2_source_node']
+            self._raw_id = data['_id']
+            self.facility_ = data['_facility']
+            self._raw_timestamp_iso = data['_timestamp']
+        except KeyError as e:
+            raise ValueError(f'GELF field {e.args[0]} is missing') from None
+        if len(data) > len(GELF_FIELDS):
+            self.extra = {key: value for key, value in data.items()
+                          if key not in GELF_FIELDS}
+        else:
+            self.extra = None
+
+    @property
+    def gl2_remote_ip_(self) -> Union[ipaddress.IPv4Address,
+                                      ipaddress.IPv6Address]:
+        if self.gl2_remote_ip_version == 6:
+            return ipaddress.IPv6Address(self.gl2_remote_ip_int)
+        return ipaddress.IPv4Address(self.gl2_remote_ip_int)
+
+    @property
+    def timestamp(self) -> datetime.datetime:
+        return parse_timestamp(self._raw_timestamp)
+
+    @property
+    def timestamp_(self) -> datetime.datetime:
+        return parse_timestamp(self._raw_timestamp_iso)
+
+    @property
+    def gl2_source_node_(self) -> uuid.UUID:
+        return uuid.UUID(self._raw_gl2_source_node)
+
+    @property
+    def id_(self) -> uuid.UUID:
+        return uuid.UUID(self._raw_id)
+
+    def __getattr__(self, name: str):
+        # called only for names that are not slots or properties
+        if name == 'extra':
+            raise AttributeError(name)
+        attribute = ALIAS_ATTRIBUTES.get(name, name)
+        if attribute != name:
+            return getattr(self, attribute)
+        extra = self.extra
+        if extra is None or name not in extra:
+            raise AttributeError(f'GELF message has no field {name}')
+        return extra[name]
+
+    def dict(self, by_alias: bool = False) -> dict:
+        result = {alias if by_alias else name: getattr(self, name)
+                  for name, alias in ATTRIBUTE_ALIASES.items()}
+        if self.extra:
+            result.update(self.extra)
+        return result
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({self.dict(by_alias=True)!r})'
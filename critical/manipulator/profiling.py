@@ -0,0 +1,152 @@
+import asyncio
+import copy
+import cProfile
+import pathlib
+import time
+from typing import List, Optional
+
+from .consumers import FileAsyncConsumer
+from .handler import Handler
+from .static_filters import FilterStats
+
+
+def load_values(path: pathlib.Path, limit: int = 0) -> List[bytes]:
+    """
+    Raw messages of captured sample (NDJSON or \\x00-delimited GELF)
+    :param limit: read only that many messages, 0 reads all of them
+    """
+    values = []
+    records = FileAsyncConsumer([path]).read_records()
+    for value in records:
+        values.append(value)
+        if len(values) == limit:
+            records.close()
+            break
+    return values
+
+
+def stub_config(config: dict, keep_dynamic_filters: bool = False) -> dict:
+    """
+    Handler config with senders replaced by DummySender keeping
+    receivers, so nothing is sent
+    :param keep_dynamic_filters: dynamic filters need their services
+    (e.g. Redis), they are removed by default
+    """
+    config = copy.deepcopy(config)
+    config['senders'] = [{'class': 'DummySender',
+                          'receivers': settings.get('receivers', [None])}
+                         for settings in config.get('senders', [])]
+    if not keep_dynamic_filters:
+        config['dynamic_filters'] = []
+    return config
+
+
+def profile_stages(handler: Handler, values: List[bytes]
+                   ) -> List[FilterStats]:
+    """
+    Measure every stage separately: decoding, every static filter against
+    every decoded message, formatting of messages passing all filters
+    :return: stats per stage, `passed` of decoding counts valid messages
+    """
+    decode = FilterStats('decode')
+    messages = []
+    for value in values:
+        start = time.perf_counter()
+        try:
+            messages.append(handler.decoder(value))
+            decode.passed += 1
+        except Exception:
+            pass
+        decode.elapsed += time.perf_counter() - start
+        decode.calls += 1
+
+    result = [decode]
+    passing = [True] * len(messages)
+    for index, filter_ in enumerate(handler.static_filters):
+        stats = FilterStats(f'{filter_.__class__.__name__}#{index}')
+        for number, message in enumerate(messages):
+            start = time.perf_counter()
+            passed = filter_.filter(message)
+            stats.elapsed += time.perf_counter() - start
+            stats.calls += 1
+            if passed:
+                stats.passed += 1
+            else:
+                passing[number] = False
+        result.append(stats)
+
+    format_ = FilterStats('format')
+    for message, passed in zip(messages, passing):
+        if not passed:
+            continue
+        start = time.perf_counter()
+        handler.formatter.format(message)
+        format_.elapsed += time.perf_counter() - start
+        format_.calls += 1
+        format_.passed += 1
+    result.append(format_)
+    return result
+
+
+async def run_end_to_end(config: dict, values: List[bytes],
+                         batch_size: int = 500) -> float:
+    """
+    Pass sample through handler in batches, like consumer does
+    :param config: handler config, handler is built within running loop,
+    as its queues and events are bound to it
+    :return: seconds until senders are done
+    """
+    handler = Handler.from_dict(copy.deepcopy(config))
+    await handler.start()
+    start = time.perf_counter()
+    for index in range(0, len(values), batch_size):
+        batch = []
+        for value in values[index:index + batch_size]:
+            try:
+                batch.append(handler.decoder(value))
+            except Exception:
+                pass
+        await handler.handle_batch(batch)
+    await handler.stop()
+    return time.perf_counter() - start
+
+
+def end_to_end(config: dict, values: List[bytes], batch_size: int = 500,
+               profile_path: Optional[pathlib.Path] = None) -> float:
+    """
+    :param config: handler config
+    :param profile_path: if set, cProfile stats are dumped there
+    :return: seconds spent
+    """
+    if profile_path is None:
+        return asyncio.run(run_end_to_end(config, values, batch_size))
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return asyncio.run(run_end_to_end(config, values, batch_size))
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+
+
+def format_report(stages: List[FilterStats], elapsed: float,
+                  count: int) -> str:
+    lines = [f'{"stage":<32}{"calls":>10}{"pass rate":>11}'
+             f'{"total ms":>11}{"mean us":>10}']
+    for stats in stages:
+        lines.append(f'{stats.name:<32}{round(stats.calls):>10}'
+                     f'{stats.pass_rate:>11.2%}'
+                     f'{stats.elapsed * 1e3:>11.1f}'
+                     f'{stats.mean_cost * 1e6:>10.2f}')
+    filters = stages[1:-1]
+    if len(filters) > 1:
+        # the same order AdaptiveFilterChain converges to
+        order = sorted(filters, key=lambda stats: stats.rank)
+        lines.append('')
+        lines.append('Cheapest static filters order: '
+                     + ', '.join(stats.name for stats in order))
+    lines.append('')
+    rate = count / elapsed if elapsed else 0
+    lines.append(f'Handler end to end: {count} messages in '
+                 f'{elapsed * 1e3:.1f} ms, {rate:.0f} msg/s')
+    return '\n'.join(lines)
@@ -0,0 +1,244 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from .loggers import senders_logger as logger
+
+
+class RetryLater(Exception):
+    def __init__(self, retry_after: float):
+        """Raised by delivery function when destination asks to slow down"""
+        super().__init__(f'Retry in {retry_after} seconds')
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1):
+        """
+        :param rate: tokens added per second
+        :param capacity: maximum number of tokens (allowed burst)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Seconds to wait until token is available"""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> bool:
+        """Take token if available"""
+        if self.delay() > 0:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def acquire(self) -> None:
+        """Wait for token and take it"""
+        while not self.take():
+            await asyncio.sleep(self.delay())
+
+    def block(self, seconds: float) -> None:
+        """Give no tokens for some time, e.g. after 429 response"""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens = 0
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def drain(self) -> None:
+        """Throw away accumulated tokens"""
+        self._refill(time.monotonic())
+        self.tokens = 0
+
+
+def split_message(text: str, limit: int) -> List[str]:
+    """Split text into parts not longer than limit, on line or word breaks
+    where possible"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit + 1)
+        if cut <= 0:
+            cut = text.rfind(' ', 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:]
+        if text[:1] in ('\n', ' '):
+            text = text[1:]
+    parts.append(text)
+    return parts
+
+
+def pack_messages(messages: List[str], limit: int,
+                  separator: str = '\n\n') -> List[str]:
+    """Join messages into as few texts not longer than limit as possible"""
+    packed = []
+    current = None
+    for message in messages:
+        for part in split_message(message, limit):
+            if current is None:
+                current = part
+            elif len(current) + len(separator) + len(part) <= limit:
+                current += separator + part
+            else:
+                packed.append(current)
+                current = part
+    if current is not None:
+        packed.append(current)
+    return packed
+
+
+class DeliveryScheduler:
+    def __init__(self, deliver: Callable[[Any, str], Awaitable[Any]],
+                 global_bucket: TokenBucket,
+                 bucket_for: Callable[[Any], TokenBucket],
+                 queue_size: int = 1000,
+                 linger: float = 0,
+                 pack: Optional[Callable[[List[str]], List[str]]] = None,
+                 close_timeout: Optional[float] = 10):
+        """
+        Delivers messages at the highest rate that stays under the limits
+        Every destination has own queue and worker, so destination that
+        hits its limit doesn't slow down the other ones
+        :param deliver: coroutine function sending message to destination,
+        raises RetryLater when destination asks to slow down
+        :param global_bucket: limit shared by all destinations
+        :param bucket_for: creates limit of specific destination
+        :param queue_size: capacity of each destination queue, the oldest
+        message is dropped to make room for a new one
+        :param linger: if set, wait that many seconds for more messages to
+        the same destination and deliver them together
+        :param pack: turns messages collected within linger window into
+        messages to deliver
+        :param close_timeout: seconds close waits for delivery, messages
+        left are dropped, None waits until everything is delivered
+        """
+        self.deliver = deliver
+        self.global_bucket = global_bucket
+        self.bucket_for = bucket_for
+        self.queue_size = queue_size
+        self.linger = linger
+        self.pack = pack
+        self.close_timeout = close_timeout
+        self.queues: Dict[Any, asyncio.Queue] = {}
+        self.buckets: Dict[Any, TokenBucket] = {}
+        self.tasks: Dict[Any, asyncio.Task] = {}
+
+    async def submit(self, destination: Any, message: str) -> asyncio.Future:
+        """
+        Queue message for delivery, never waits: if destination queue is
+        full, its oldest message is dropped, so flooded destination can't
+        block callers delivering to the other ones
+        :return: future resolved once message is delivered or dropped
+        """
+        queue = self.queues.get(destination)
+        if queue is None:
+            queue = self.queues[destination] = asyncio.Queue(self.queue_size)
+            self.buckets[destination] = self.bucket_for(destination)
+            self.tasks[destination] = asyncio.create_task(
+                self.work(destination))
+        future = asyncio.get_running_loop().create_future()
+        if queue.full():
+            _, dropped = queue.get_nowait()
+            queue.task_done()
+            if not dropped.done():
+                dropped.set_result(None)
+            logger.warning(f'{destination}: queue is full, oldest message '
+                           f'dropped')
+        queue.put_nowait((message, future))
+        return future
+
+    async def work(self, destination: Any) -> None:
+        queue = self.queues[destination]
+        bucket = self.buckets[destination]
+        while True:
+            items = [await queue.get()]
+            result = None
+            try:
+                if self.linger:
+                    await asyncio.sleep(self.linger)
+                    while not queue.empty():
+                        items.append(queue.get_nowait())
+                # nobody waits for cancelled deliveries, they are dropped
+                messages = [message for message, future in items
+                            if not future.done()]
+                if not messages:
+                    continue
+                if self.pack is not None:
+                    messages = self.pack(messages)
+                    logger.debug(f'{destination}: {len(items)} message(s) '
+                                 f'packed into {len(messages)}')
+                outcome = True
+                for message in messages:
+                    delivered = await self.deliver_one(destination, bucket,
+                                                       message)
+                    outcome = outcome and delivered
+                result = outcome
+            except Exception as e:
+                error_text = e.__class__.__name__ + ': ' + str(e)
+                logger.error(f'{destination}: {error_text}')
+                result = None
+            finally:
+                for _, future in items:
+                    queue.task_done()
+                    if not future.done():
+                        future.set_result(result)
+
+    async def deliver_one(self, destination: Any, bucket: TokenBucket,
+                          message: str) -> Any:
+        while True:
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await self.deliver(destination, message)
+            except RetryLater as e:
+                logger.warning(f'{destination}: {e}')
+                bucket.block(e.retry_after)
+                self.global_bucket.drain()
+
+    @property
+    def depth(self) -> Dict[Any, int]:
+        return {destination: queue.qsize()
+                for destination, queue in self.queues.items()}
+
+    async def join(self) -> None:
+        """Wait until everything queued is delivered"""
+        for queue in self.queues.values():
+            await queue.join()
+
+    async def close(self) -> None:
+        """
+        Deliver everything queued, then stop workers
+        Messages not delivered within close_timeout are dropped, their
+        futures are resolved with None
+        """
+        try:
+            await asyncio.wait_for(self.join(), self.close_timeout)
+        except asyncio.TimeoutError:
+            logger.error(f'{sum(self.depth.values())} message(s) not '
+                         f'delivered within {self.close_timeout} seconds, '
+                         f'dropped')
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        for queue in self.queues.values():
+            while not queue.empty():
+                _, future = queue.get_nowait()
+                if not future.done():
+                    future.set_result(None)
+        self.queues.clear()
+        self.buckets.clear()
+        self.tasks.clear()
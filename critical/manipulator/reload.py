@@ -0,0 +1,132 @@
+import asyncio
+import pathlib
+from typing import Any, Callable, Collection, Dict, List, Optional, Union
+
+from .delivery import Ack
+from .handler import Handler, HandlerGroup
+from .loggers import main_logger as logger
+from .models import GELFMessage
+
+AnyTarget = Union[Handler, HandlerGroup]
+
+
+class ReloadableHandler:
+    def __init__(self, target: AnyTarget):
+        """
+        Handler or HandlerGroup that can be replaced while its consumer
+        keeps running
+        Consumers decode messages and pass them to handler without
+        yielding to event loop in between, so every message is decoded
+        and handled by the same target
+        :param target: initial Handler or HandlerGroup
+        """
+        self.target = target
+        self.consumer_specification = target.consumer_specification
+        self.name = target.name
+        # components left running on stop, another target uses them
+        self.keep: Collection[Any] = ()
+        # handle calls in progress per target, old target is stopped only
+        # once they are done
+        self.calls: Dict[AnyTarget, int] = {}
+        self.idle: Dict[AnyTarget, asyncio.Future] = {}
+
+    def decoder(self, value: bytes) -> GELFMessage:
+        return self.target.decoder(value)
+
+    @property
+    def saturated(self) -> bool:
+        return self.target.saturated
+
+    async def wait_drained(self, timeout: Optional[float] = None) -> bool:
+        return await self.target.wait_drained(timeout)
+
+    def stats(self) -> Union[dict, List[dict]]:
+        return self.target.stats()
+
+    async def start(self) -> None:
+        await self.target.start()
+
+    async def stop(self) -> None:
+        await self.target.stop(keep=self.keep)
+
+    def enter(self) -> AnyTarget:
+        target = self.target
+        self.calls[target] = self.calls.get(target, 0) + 1
+        return target
+
+    def leave(self, target: AnyTarget) -> None:
+        self.calls[target] -= 1
+        if self.calls[target]:
+            return
+        del self.calls[target]
+        idle = self.idle.pop(target, None)
+        if idle is not None and not idle.done():
+            idle.set_result(None)
+
+    async def handle(self, obj: GELFMessage, ack: Optional[Ack] = None
+                     ) -> None:
+        target = self.enter()
+        try:
+            await target.handle(obj, ack)
+        finally:
+            self.leave(target)
+
+    async def handle_batch(self, objs: List[GELFMessage],
+                           acks: Optional[List[Ack]] = None) -> None:
+        target = self.enter()
+        try:
+            await target.handle_batch(objs, acks)
+        finally:
+            self.leave(target)
+
+    async def swap(self, target: AnyTarget,
+                   keep: Optional[Collection[Any]] = None) -> None:
+        """
+        Start new target, pass next messages to it, then stop old one
+        once calls still in progress on it (e.g. waiting for room in full
+        outbound queues) are done and it has delivered what it got
+        :param target: new Handler or HandlerGroup
+        :param keep: components of old target left running, the ones new
+        target took over by default
+        """
+        await target.start()
+        old, self.target = self.target, target
+        if old in self.calls:
+            idle = asyncio.get_running_loop().create_future()
+            self.idle[old] = idle
+            await idle
+        await old.stop(keep=target.components if keep is None else keep)
+
+
+class ConfigWatcher:
+    def __init__(self, list_files: Callable[[], List[pathlib.Path]]):
+        """
+        Detect config changes by modification times
+        :param list_files: returns config files, added and removed files
+        are changes too
+        """
+        self.list_files = list_files
+        self.mtimes = self.snapshot()
+
+    def snapshot(self) -> Dict[pathlib.Path, Any]:
+        mtimes = {}
+        for path in self.list_files():
+            try:
+                mtimes[path] = path.stat().st_mtime_ns
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def changed(self) -> bool:
+        mtimes = self.snapshot()
+        changed = mtimes != self.mtimes
+        self.mtimes = mtimes
+        return changed
+
+    async def watch(self, interval: float,
+                    on_change: Callable[[], None]) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            if self.changed():
+                logger.error('Config change detected')
+                on_change()
@@ -1,17 +1,26 @@
 from abc import ABC, abstractmethod
-from typing import List, Union, Any
+from typing import Any, Dict, List, Optional, Tuple, Union
 from aiogram import Bot
 from aiogram.exceptions import TelegramRetryAfter, AiogramError
 import asyncio
+import time
 from aiosmtplib import SMTP
-from aiosmtplib import SMTPResponseException
+from aiosmtplib import SMTPRecipientsRefused, SMTPResponseException
 
 from .loggers import senders_logger as logger
 from .dynamic_filters import AbstractDynamicFilter
+from .metrics import METRICS
+from .ratelimit import (DeliveryScheduler, RetryLater, TokenBucket,
+                        pack_messages)
+from .smtp_pool import CONNECTION_ERRORS, SMTPPool
 
 
 class AbstractAsyncSender(ABC):
     prefix: str
+    # number of background workers delivering queued messages
+    delivery_workers: int = 1
+    # senders queueing messages record send latency on actual delivery
+    measures_send: bool = False
 
     def __init__(self, receivers: List[Any], **kwargs):
         """
@@ -25,25 +34,81 @@ class AbstractAsyncSender(ABC):
         logger.debug(f'Receivers: {receivers_list}')
 
     async def send(self, message: str,
-                   dynamic_filters: List[AbstractDynamicFilter] = None):
+                   dynamic_filters: List[AbstractDynamicFilter] = None
+                   ) -> List[asyncio.Future]:
         """
         :param message:
         :param dynamic_filters:
-        :return:
+        :return: futures of deliveries still in progress (send_one may
+        queue message and return future instead of waiting)
+        """
+        receivers = await self.unfiltered_receivers(message, dynamic_filters)
+        send_tasks = [self.send_one(message, receiver)
+                      for receiver in receivers]
+        if METRICS.enabled and not self.measures_send and send_tasks:
+            started = time.perf_counter()
+            results = await asyncio.gather(*send_tasks)
+            METRICS.latency.observe(time.perf_counter() - started, 'send')
+        else:
+            results = await asyncio.gather(*send_tasks)
+        return [result for result in results
+                if isinstance(result, asyncio.Future)]
+
+    async def unfiltered_receivers(
+            self, message: str,
+            dynamic_filters: List[AbstractDynamicFilter] = None) -> List[Any]:
+        """
+        Check message against dynamic filters for all receivers at once,
+        filters are evaluated concurrently
+        :return: receivers message should be sent to
         """
         if not dynamic_filters:
-            dynamic_filters = []
-        send_tasks = []
-        for receiver in self.receivers:
-            filtered = False
-            for dynamic_filter in dynamic_filters:
-                if await dynamic_filter.filter(message,
-                                               self.prefix + str(receiver)):
-                    filtered = True
-                    break
-            if not filtered:
-                send_tasks.append(self.send_one(message, receiver))
-        await asyncio.gather(*send_tasks)
+            return list(self.receivers)
+        keys = [self.prefix + str(receiver) for receiver in self.receivers]
+        if METRICS.enabled:
+            started = time.perf_counter()
+        results = await asyncio.gather(
+            *(dynamic_filter.filter_many(message, keys)
+              for dynamic_filter in dynamic_filters))
+        if METRICS.enabled:
+            self.record_dynamic_filters(dynamic_filters, results,
+                                        time.perf_counter() - started)
+        return [receiver
+                for receiver, hits in zip(self.receivers, zip(*results))
+                if not any(hits)]
+
+    def record_dynamic_filters(self,
+                               dynamic_filters: List[AbstractDynamicFilter],
+                               results: List[List[bool]],
+                               elapsed: float) -> None:
+        sender_name = self.__class__.__name__
+        METRICS.latency.observe(elapsed, 'dynamic_filter')
+        for dynamic_filter, hits in zip(dynamic_filters, results):
+            rejected = sum(map(bool, hits))
+            if rejected:
+                METRICS.dynamic_rejections.inc(
+                    sender_name, dynamic_filter.__class__.__name__,
+                    amount=rejected)
+
+    def record_error(self) -> None:
+        if METRICS.enabled:
+            METRICS.sender_errors.inc(self.__class__.__name__)
+
+    def record_retry(self) -> None:
+        if METRICS.enabled:
+            METRICS.sender_retries.inc(self.__class__.__name__)
+
+    async def send_batch(self, messages: List[str],
+                         dynamic_filters: List[AbstractDynamicFilter] = None
+                         ) -> List[List[asyncio.Future]]:
+        """
+        Send several messages keeping their order
+        :param messages: list of formatted messages
+        :param dynamic_filters: same as for send
+        :return: futures of deliveries still in progress, per message
+        """
+        return [await self.send(message, dynamic_filters)
+                for message in messages]
 
     @abstractmethod
     async def send_one(self, message: str, receiver: Any):  # pragma: no cover
@@ -63,90 +128,288 @@ class AbstractAsyncSender(ABC):
 
 class TelegramSender(AbstractAsyncSender):
     prefix: str = 'tg_'
-
-    def __init__(self, bot: Bot, receivers: List[Union[int, str]]):
+    measures_send: bool = True
+
+    def __init__(self, bot: Bot, receivers: List[Union[int, str]],
+                 global_per_second: float = 30,
+                 private_per_second: float = 1,
+                 group_per_minute: float = 20,
+                 chat_queue_size: int = 1000,
+                 coalesce_window: float = 0,
+                 max_message_length: int = 4096,
+                 stop_timeout: float = 10):
         """
 
-        :param token:
-        :param receivers:
+        :param bot: aiogram Bot instance
+        :param receivers: list of chat_ids
+        :param global_per_second: bot-wide limit
+        :param private_per_second: limit for each private chat
+        :param group_per_minute: limit for each group or channel
+        :param chat_queue_size: capacity of each chat queue
+        :param coalesce_window: seconds to wait for more alerts to the same
+        chat and send them as one message, 0 disables coalescing
+        :param max_message_length: coalesced messages are split to fit
+        :param stop_timeout: seconds to deliver queued messages on stop
         """
         logger.debug('Telegram sender initializing...')
         self.bot = bot
+        self.private_per_second = private_per_second
+        self.group_per_minute = group_per_minute
+        self.max_message_length = max_message_length
+        self.scheduler = DeliveryScheduler(
+            self.deliver,
+            TokenBucket(global_per_second, global_per_second),
+            self.chat_bucket,
+            chat_queue_size,
+            linger=coalesce_window,
+            pack=self.pack if coalesce_window else None,
+            close_timeout=stop_timeout)
         super().__init__(receivers)
         logger.info('Telegram sender has been set')
 
+    def chat_bucket(self, chat_id: Union[str, int]) -> TokenBucket:
+        """Private chats have positive IDs, groups and channels don't"""
+        if isinstance(chat_id, int) and chat_id > 0:
+            return TokenBucket(self.private_per_second)
+        return TokenBucket(self.group_per_minute / 60)
+
+    def pack(self, messages: List[str]) -> List[str]:
+        """Coalesce alerts into messages Telegram accepts"""
+        return pack_messages(messages, self.max_message_length)
+
     async def stop(self) -> None:
         """
-        Close bot session and dispose bot
+        Deliver queued messages, close bot session and dispose bot
         :return: None
         """
+        await self.scheduler.close()
         await self.bot.session.close()
 
-    async def send_one(self, message: str, receiver: Union[str, int]) -> None:
+    async def deliver(self, receiver: Union[str, int], message: str) -> bool:
         """
         Send message to specified chat
-        Wait on timeout error, exit on other errors
+        Ask scheduler to retry on timeout error, drop message on other errors
+        :param receiver: chat_id
+        :param message: text to send
+        :return: True if message was sent
+        """
+        started = time.perf_counter()
+        try:
+            await self.bot.send_message(receiver, message)
+            if METRICS.enabled:
+                METRICS.latency.observe(time.perf_counter() - started,
+                                        'send')
+            return True
+        except TelegramRetryAfter as e:
+            self.record_retry()
+            raise RetryLater(e.retry_after) from e
+        except AiogramError as e:
+            logger.error(str(e))
+            self.record_error()
+            return False
+
+    async def send_one(self, message: str,
+                       receiver: Union[str, int]) -> asyncio.Future:
+        """
+        Queue message for specified chat, don't wait for actual sending
         :param message: text to send
         :param receiver: chat_id
-        :return: None
+        :return: future resolved once message is sent or dropped
         """
-        while True:
-            try:
-                await self.bot.send_message(receiver, message)
-                return
-            except TelegramRetryAfter as e:
-                logger.warning(str(e))
-                await asyncio.sleep(e.retry_after)
-            except AiogramError as e:
-                logger.error(str(e))
-                return
+        return await self.scheduler.submit(receiver, message)
 
     @classmethod
     def from_dict(cls, settings: dict):
         token = settings.get('token')
         receivers = settings.get('receivers')
         bot = Bot(token=token)
-        return cls(bot, receivers)
+        limits = {key: settings[key] for key in ('global_per_second',
+                                                 'private_per_second',
+                                                 'group_per_minute',
+                                                 'chat_queue_size',
+                                                 'coalesce_window',
+                                                 'max_message_length',
+                                                 'stop_timeout')
+                  if key in settings}
+        return cls(bot, receivers, **limits)
 
 
 class MailSender(AbstractAsyncSender):
+    prefix: str = 'mail_'
+    measures_send: bool = True
+
     def __init__(self, smtp: SMTP,
                  sender: str,
                  receivers: list[str],
                  subject: str = None,
                  settings: dict = None,
+                 pool_size: int = 1,
+                 keepalive: float = 30,
+                 digest_window: float = 0,
                  **kwargs):
+        """
+
+        :param smtp: SMTP client
+        :param sender: From address
+        :param receivers: list of e-mails
+        :param subject: used if message has no Subject header
+        :param settings: SMTP settings used to open more connections
+        :param pool_size: number of SMTP connections, requires settings
+        :param keepalive: idle connections older than that are checked with
+        NOOP before sending
+        :param digest_window: if set, alerts are collected for that many
+        seconds and sent as one digest per recipient
+        """
         self.smtp = smtp
         self.sender = sender
         self.subject = subject or 'Critical Bot Message'
         self.settings = settings
+        clients = [smtp]
+        if settings:
+            clients += [self.smtp_from_dict(settings)
+                        for _ in range(pool_size - 1)]
+        self.pool = SMTPPool(clients, keepalive)
+        self.digest_window = digest_window
+        self.digests: Dict[str, List[str]] = {}
+        self.digest_task: Optional[asyncio.Task] = None
+        # resolved once collected digests are sent
+        self.digest_sent: Optional[asyncio.Future] = None
         super().__init__(receivers, **kwargs)
+        logger.debug(f'SMTP connections: {self.pool.size}')
 
     async def start(self):
-        await self.smtp.connect()
+        await self.pool.start()
+        if self.digest_window:
+            self.digest_task = asyncio.create_task(self.digest_loop())
 
     async def stop(self):
-        if self.smtp.is_connected:
-            self.smtp.close()
+        if self.digest_task is not None:
+            # interrupted flush puts unsent digests back, they are sent below
+            self.digest_task.cancel()
+            await asyncio.gather(self.digest_task, return_exceptions=True)
+            self.digest_task = None
+        await self.flush_digests()
+        await self.pool.close()
+
+    async def send(self, message: str,
+                   dynamic_filters: List[AbstractDynamicFilter] = None
+                   ) -> List[asyncio.Future]:
+        """
+        Send message to all unfiltered receivers in one SMTP transaction,
+        or add it to their digests
+        :return: future of digest delivery in digest mode
+        """
+        receivers = await self.unfiltered_receivers(message, dynamic_filters)
+        if not receivers:
+            return []
+        if self.digest_window:
+            for receiver in receivers:
+                self.digests.setdefault(receiver, []).append(message)
+            if self.digest_sent is None:
+                self.digest_sent = asyncio.get_running_loop().create_future()
+            return [self.digest_sent]
+        await self.send_many(message, receivers)
+        return []
+
+    async def digest_loop(self):
+        while True:
+            await asyncio.sleep(self.digest_window)
+            try:
+                await self.flush_digests()
+            except Exception as e:
+                error_text = e.__class__.__name__ + ': ' + str(e)
+                logger.error(f'Digest not sent: {error_text}')
+
+    async def flush_digests(self):
+        """
+        Send collected digests, recipients with the same alerts share
+        one transaction
+        If interrupted, digests not handed to SMTP yet are put back to be
+        sent by the next flush
+        :return: None
+        """
+        digests, self.digests = self.digests, {}
+        digest_sent, self.digest_sent = self.digest_sent, None
+        groups: Dict[Tuple[str, ...], List[str]] = {}
+        for receiver, messages in digests.items():
+            groups.setdefault(tuple(messages), []).append(receiver)
+        unsent = list(groups.items())
+        try:
+            while unsent:
+                messages, receivers = unsent[0]
+                logger.debug(f'Digest of {len(messages)} alert(s) '
+                             f'for {len(receivers)} receiver(s)')
+                await self.send_many(self.digest(messages), receivers)
+                del unsent[0]
+        except BaseException:
+            self.restore_digests(unsent, digest_sent)
+            raise
+        if digest_sent is not None and not digest_sent.done():
+            digest_sent.set_result(True)
+
+    def restore_digests(self, groups: List[Tuple[Tuple[str, ...],
+                                                 List[str]]],
+                        digest_sent: Optional[asyncio.Future]) -> None:
+        """Put unsent digests back before alerts collected since then"""
+        for messages, receivers in groups:
+            for receiver in receivers:
+                self.digests[receiver] = (list(messages)
+                                          + self.digests.get(receiver, []))
+        if digest_sent is None:
+            return
+        if self.digest_sent is None:
+            self.digest_sent = digest_sent
+            return
+
+        def resolve(_):
+            if not digest_sent.done():
+                digest_sent.set_result(True)
+        self.digest_sent.add_done_callback(resolve)
+
+    def digest(self, messages: Tuple[str, ...]) -> str:
+        subject = f'{self.subject}: {len(messages)} alert(s)'
+        body = '\n\n----------\n\n'.join(messages)
+        return f'Subject: {subject}\n\n{body}'
 
     async def send_one(self, message: str, receiver: Any):
-        if self.settings:
-            current_smtp = self.smtp_from_dict(self.settings)
-        else:
-            current_smtp = self.smtp
+        await self.send_many(message, [receiver])
+
+    async def send_many(self, message: str, receivers: List[str]):
+        """
+        Send message to several receivers in one SMTP transaction
+        :param message: text, optionally starting with Subject header
+        :param receivers: list of e-mails
+        :return: None
+        """
         headers = f'From: {self.sender}\n'
         if 'Subject: ' not in message:
             headers += f'Subject: {self.subject}\n'
         message_to_send = headers + message
-        if not current_smtp.is_connected:
-            await current_smtp.connect()
-        try:
-            await self.smtp.sendmail(self.sender, receiver, message_to_send)
-        except SMTPResponseException as e:
-            logger.error(str(e))
-        finally:
-            if self.settings:
-                current_smtp.close()
+        # connection could be dropped by server between checks,
+        # so broken connection is reopened and sending is retried once
+        started = time.perf_counter()
+        for attempt in range(2):
+            try:
+                async with self.pool.connection() as smtp:
+                    errors, _ = await smtp.sendmail(self.sender, receivers,
+                                                    message_to_send)
+                if METRICS.enabled:
+                    METRICS.latency.observe(time.perf_counter() - started,
+                                            'send')
+                for receiver, (code, text) in errors.items():
+                    logger.error(f'{receiver}: {code} {text}')
+                    self.record_error()
+                return
+            except (SMTPResponseException, SMTPRecipientsRefused) as e:
+                logger.error(str(e))
+                self.record_error()
+                return
+            except CONNECTION_ERRORS as e:
+                if attempt:
+                    logger.error(f'{", ".join(receivers)}: {e}')
+                    self.record_error()
+                else:
+                    self.record_retry()
 
     @classmethod
     def smtp_from_dict(cls, settings: dict):
@@ -165,7 +428,12 @@ class MailSender(AbstractAsyncSender):
         sender: str = settings.pop('sender')
         subject: str = settings.pop('subject', 'Critical Bot Message')
         receivers: list = settings.pop('receivers')
-        return cls(smtp, sender, receivers, subject, settings)
+        pool_size: int = settings.pop('pool_size', 1)
+        keepalive: float = settings.pop('keepalive', 30)
+        digest_window: float = settings.pop('digest_window', 0)
+        return cls(smtp, sender, receivers, subject, settings,
+                   pool_size=pool_size, keepalive=keepalive,
+                   digest_window=digest_window)
 
 
 class TerminalSender(AbstractAsyncSender):  # pragma: no cover
@@ -191,4 +459,4 @@ class DummySender(AbstractAsyncSender):  # pragma: no cover
 
     @classmethod
     def from_dict(cls, settings: dict):
-        return DummySender([])
+        return DummySender(settings.get('receivers', []))
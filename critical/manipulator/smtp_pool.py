@@ -0,0 +1,104 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List
+
+from aiosmtplib import SMTP, SMTPException, SMTPServerDisconnected
+
+from .loggers import senders_logger as logger
+
+# errors after which connection can't be trusted anymore
+CONNECTION_ERRORS = (SMTPServerDisconnected, ConnectionError,
+                     asyncio.TimeoutError)
+
+
+class SMTPPool:
+    def __init__(self, clients: List[SMTP], keepalive: float = 30):
+        """
+        Fixed set of SMTP connections shared by concurrent deliveries
+        :param clients: SMTP clients, connected lazily
+        :param keepalive: connections idle for longer are checked with NOOP
+        before use
+        """
+        self.clients = clients
+        self.keepalive = keepalive
+        self.idle: asyncio.Queue = asyncio.Queue()
+        self.last_used: Dict[int, float] = {}
+        for client in clients:
+            self.idle.put_nowait(client)
+
+    @property
+    def size(self) -> int:
+        return len(self.clients)
+
+    async def start(self) -> None:
+        """
+        Connect all clients
+        :return: None
+        """
+        await asyncio.gather(*(self.ensure(client)
+                               for client in self.clients))
+
+    async def ensure(self, client: SMTP) -> None:
+        """
+        Make sure client is connected and server still talks to it
+        :param client: SMTP client
+        :return: None
+        """
+        if client.is_connected:
+            idle = time.monotonic() - self.last_used.get(id(client), 0)
+            if idle > self.keepalive:
+                try:
+                    await client.noop()
+                except (SMTPException,) + CONNECTION_ERRORS as e:
+                    logger.info(f'Stale SMTP connection dropped: {e}')
+                    client.close()
+        if not client.is_connected:
+            await client.connect()
+        self.last_used[id(client)] = time.monotonic()
+
+    async def checkout(self) -> SMTP:
+        """
+        Wait for idle client and make it ready to send
+        :return: connected SMTP client
+        """
+        client = await self.idle.get()
+        try:
+            await self.ensure(client)
+        except BaseException:
+            self.checkin(client, broken=True)
+            raise
+        return client
+
+    def checkin(self, client: SMTP, broken: bool = False) -> None:
+        """
+        Return client to pool
+        :param client: SMTP client
+        :param broken: close connection, it will be reopened on next checkout
+        :return: None
+        """
+        if broken and client.is_connected:
+            client.close()
+        self.last_used[id(client)] = time.monotonic()
+        self.idle.put_nowait(client)
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[SMTP]:
+        client = await self.checkout()
+        broken = False
+        try:
+            yield client
+        except CONNECTION_ERRORS:
+            broken = True
+            raise
+        finally:
+            self.checkin(client, broken)
+
+    async def close(self) -> None:
+        """
+        Close all connections
+        :return: None
+        """
+        for client in self.clients:
+            if client.is_connected:
+                client.close()
@@ -1,12 +1,18 @@
+import bisect
 import ipaddress
+import time
 from abc import ABC, abstractmethod
-from typing import List, Optional, Union
-from ipaddress import IPv4Address, IPv4Network
-from .models import GELFMessage
+from typing import Dict, FrozenSet, List, Optional, Tuple, Union
+from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network
+from .matchers import LiteralMatcher
+from .models import CompactGELFMessage, GELFMessage, to_alias, to_attribute
 from .loggers import filters_logger as logger
 
 
 class AbstractStaticFilter(ABC):
+    # GELF keys used by filter, None means filter may use any field
+    required_fields: Optional[FrozenSet[str]] = None
+
     @abstractmethod  # pragma: no cover
     def __init__(self, **kwargs):
         raise NotImplementedError
@@ -22,6 +28,8 @@ class AbstractStaticFilter(ABC):
 
 
 class SourceIPFilter(AbstractStaticFilter):
+    required_fields = frozenset({'_gl2_remote_ip'})
+
     @classmethod
     def from_dict(cls, settings: dict):
         prefixes = settings.get('prefixes', [])
@@ -29,42 +37,63 @@ class SourceIPFilter(AbstractStaticFilter):
         exclude = settings.get('exclude', False)
         return SourceIPFilter(prefixes, ips, exclude)
 
-    def __init__(self, prefixes: Optional[List[Union[IPv4Network, str]]] = None,
-                 ips: Optional[List[Union[IPv4Address, str]]] = None,
+    def __init__(self, prefixes: Optional[List[Union[IPv4Network,
+                                                     IPv6Network,
+                                                     str]]] = None,
+                 ips: Optional[List[Union[IPv4Address, IPv6Address,
+                                          str]]] = None,
                  exclude: bool = False):
         logger.debug('SourceIP filter initializing...')
         self.prefixes = prefixes or []
-        self.prefixes = list(map(ipaddress.IPv4Network, self.prefixes))
+        self.prefixes = list(map(ipaddress.ip_network, self.prefixes))
         logger.debug(f'Prefixes: {self.prefixes}')
         self.ips = ips or []
-        self.ips = list(map(ipaddress.IPv4Address, self.ips))
+        self.ips = list(map(ipaddress.ip_address, self.ips))
         logger.debug(f'IPs: {self.ips}')
         self.exclude = exclude
         logger.debug(f'Exclude: {self.exclude}')
+        self.index = self.build_index(self.prefixes, self.ips)
         logger.info('SourceIP filter has been set')
 
+    @staticmethod
+    def build_index(prefixes: List[Union[IPv4Network, IPv6Network]],
+                    ips: List[Union[IPv4Address, IPv6Address]]
+                    ) -> Dict[int, Tuple[List[int], List[int]]]:
+        """
+        Compile prefixes and IPs into sorted non-overlapping intervals
+        :return: {IP version: (interval starts, interval ends)}
+        """
+        intervals = {4: [], 6: []}
+        for prefix in prefixes:
+            intervals[prefix.version].append(
+                (int(prefix.network_address), int(prefix.broadcast_address)))
+        for ip in ips:
+            intervals[ip.version].append((int(ip), int(ip)))
+        index = {}
+        for version, version_intervals in intervals.items():
+            starts, ends = [], []
+            for first, last in sorted(version_intervals):
+                if ends and first <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], last)
+                else:
+                    starts.append(first)
+                    ends.append(last)
+            index[version] = (starts, ends)
+            logger.debug(f'IPv{version} intervals: {len(starts)}')
+        return index
+
     def filter(self, obj: GELFMessage) -> bool:
-        logger.debug('Start IP source filter process')
-        present_in_prefixes = False
-        if self.prefixes:
-            prefixes = map(lambda x: x.exploded, self.prefixes)
-            prefixes = ', '.join(prefixes)
-            logger.debug(f'Prefixes: {prefixes}')
-            for prefix in self.prefixes:
-                if obj.gl2_remote_ip_ in prefix:
-                    logger.debug(f'Present in prefix {prefix}')
-                    present_in_prefixes = True
-        present_in_ip_list = False
-        if self.ips:
-            ips = map(lambda x: x.exploded, self.ips)
-            ips = ', '.join(ips)
-            logger.debug(f'IPs: {ips}')
-            for ip in self.ips:
-                if obj.gl2_remote_ip_ == ip:
-                    logger.debug(f'Equal to IP {ip}')
-                    present_in_prefixes = True
-        logger.debug(f'Exclude: {self.exclude}')
-        result = (present_in_prefixes or present_in_ip_list) != self.exclude
+        if isinstance(obj, CompactGELFMessage):
+            version = obj.gl2_remote_ip_version
+            value = obj.gl2_remote_ip_int
+        else:
+            ip = obj.gl2_remote_ip_
+            version = ip.version
+            value = int(ip)
+        starts, ends = self.index[version]
+        position = bisect.bisect_right(starts, value) - 1
+        present = position >= 0 and value <= ends[position]
+        result = present != self.exclude
         if result:
             logger.debug('Filter passed')
         else:
@@ -77,23 +106,27 @@ class MessageBodyFilter(AbstractStaticFilter):
     def from_dict(cls, settings: dict):
         pattern = settings.pop('pattern')
         exclude = settings.get('exclude', False)
-        return MessageBodyFilter(pattern, exclude)
+        field = settings.get('field', 'short_message')
+        return MessageBodyFilter(pattern, exclude, field)
 
-    def __init__(self, pattern: str, exclude: bool = False):
+    def __init__(self, pattern: str, exclude: bool = False,
+                 field: str = 'short_message'):
         logger.debug('MessageBody filter initializing...')
         self.pattern = pattern
         logger.debug(f'Pattern: {self.pattern}')
         self.exclude = exclude
         logger.debug(f'Exclude: {self.exclude}')
+        self.field = to_attribute(field)
+        self.required_fields = frozenset({to_alias(field)})
+        logger.debug(f'Field: {self.field}')
+        self.matcher = LiteralMatcher([pattern])
         logger.info('MessageBody filter has been set')
 
     def filter(self, obj: GELFMessage) -> bool:
-        logger.debug('Start message body filter process')
-        logger.debug(f'Pattern: {self.pattern}')
-        present_in_message = self.pattern in obj.short_message
-        if present_in_message:
-            logger.debug(f'Pattern {self.pattern} found')
-        logger.debug(f'Exclude: {self.exclude}')
+        value = getattr(obj, self.field)
+        if not isinstance(value, str):
+            value = str(value)
+        present_in_message = self.matcher.search(value)
         result = present_in_message != self.exclude
         if result:
             logger.debug('Filter passed')
@@ -107,23 +140,27 @@ class MessageBodyAnyFilter(AbstractStaticFilter):
     def from_dict(cls, settings: dict):
         patterns = settings.pop('patterns')
         exclude = settings.get('exclude', False)
-        return MessageBodyAnyFilter(patterns, exclude)
+        field = settings.get('field', 'short_message')
+        return MessageBodyAnyFilter(patterns, exclude, field)
 
-    def __init__(self, patterns: List[str], exclude: bool = False):
+    def __init__(self, patterns: List[str], exclude: bool = False,
+                 field: str = 'short_message'):
+        logger.debug('MessageBodyAny filter initializing...')
         self.patterns = patterns
+        logger.debug(f'Patterns: {len(self.patterns)}')
         self.exclude = exclude
+        logger.debug(f'Exclude: {self.exclude}')
+        self.field = to_attribute(field)
+        self.required_fields = frozenset({to_alias(field)})
+        logger.debug(f'Field: {self.field}')
+        self.matcher = LiteralMatcher(patterns)
+        logger.info('MessageBodyAny filter has been set')
 
     def filter(self, obj: GELFMessage) -> bool:
-        logger.debug('Start message body filter process')
-        present_in_message = False
-        for pattern in self.patterns:
-            logger.debug(f'Pattern: {pattern}')
-            present_in_message = pattern in obj.short_message
-            if present_in_message:
-                logger.debug(f'Pattern {pattern} found')
-                present_in_message = True
-                break
-        logger.debug(f'Exclude: {self.exclude}')
+        value = getattr(obj, self.field)
+        if not isinstance(value, str):
+            value = str(value)
+        present_in_message = self.matcher.search(value)
         result = present_in_message != self.exclude
         if result:
             logger.debug('Filter passed')
@@ -133,6 +170,8 @@ class MessageBodyAnyFilter(AbstractStaticFilter):
 
 
 class DummyStaticFilter(AbstractStaticFilter):  # pragma: no cover
+    required_fields = frozenset()
+
     @classmethod
     def from_dict(cls, settings: dict):
         valid = settings.get('valid', True)
@@ -143,3 +182,108 @@ class DummyStaticFilter(AbstractStaticFilter):  # pragma: no cover
 
     def filter(self, obj: GELFMessage) -> bool:
         return self.valid
+
+
+class FilterStats:
+    __slots__ = ('name', 'calls', 'passed', 'elapsed')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0.0
+        self.passed = 0.0
+        self.elapsed = 0.0
+
+    @property
+    def pass_rate(self) -> float:
+        return self.passed / self.calls if self.calls else 1.0
+
+    @property
+    def mean_cost(self) -> float:
+        return self.elapsed / self.calls if self.calls else 0.0
+
+    @property
+    def rank(self) -> float:
+        """
+        Expected cost of filter per rejected message
+        Chain of AND-ed filters is cheapest when sorted by this value
+        """
+        if not self.calls:
+            # never evaluated yet, try it as soon as possible
+            return 0.0
+        rejection_rate = 1.0 - self.pass_rate
+        if not rejection_rate:
+            return float('inf')
+        return self.mean_cost / rejection_rate
+
+    def decay(self, factor: float) -> None:
+        self.calls *= factor
+        self.passed *= factor
+        self.elapsed *= factor
+
+    def dump(self) -> dict:
+        return {'filter': self.name,
+                'calls': round(self.calls),
+                'pass_rate': round(self.pass_rate, 4),
+                'mean_cost_us': round(self.mean_cost * 1e6, 3)}
+
+
+class AdaptiveFilterChain:
+    def __init__(self, filters: List[AbstractStaticFilter],
+                 interval: int = 1000,
+                 decay: float = 0.5):
+        """
+        Static filters chain that reorders itself to reject messages cheaper
+        Static filters order doesn't matter, so it is always safe
+        :param filters: static filters in configured order
+        :param interval: reorder filters every `interval` messages
+        :param decay: stats multiplier applied after reorder, lets chain
+        adapt when traffic changes
+        """
+        logger.debug('Adaptive filter chain initializing...')
+        self.chain = [(filter_, FilterStats(f'{filter_.__class__.__name__}'
+                                            f'#{index}'))
+                      for index, filter_ in enumerate(filters)]
+        self.interval = interval
+        logger.debug(f'Interval: {self.interval}')
+        self.decay = decay
+        logger.debug(f'Decay: {self.decay}')
+        self.messages = 0
+        # stats name of filter that rejected last message
+        self.rejected_by: Optional[str] = None
+        logger.info('Adaptive filter chain has been set')
+
+    @property
+    def filters(self) -> List[AbstractStaticFilter]:
+        return [filter_ for filter_, _ in self.chain]
+
+    def filter(self, obj: GELFMessage) -> bool:
+        result = True
+        for filter_, stats in self.chain:
+            start = time.perf_counter()
+            result = filter_.filter(obj)
+            stats.elapsed += time.perf_counter() - start
+            stats.calls += 1
+            if not result:
+                self.rejected_by = stats.name
+                break
+            stats.passed += 1
+        self.messages += 1
+        if self.messages >= self.interval:
+            self.reorder()
+        return result
+
+    def reorder(self) -> None:
+        self.messages = 0
+        old_order = [stats.name for _, stats in self.chain]
+        self.chain.sort(key=lambda item: (item[1].rank, item[1].mean_cost))
+        new_order = [stats.name for _, stats in self.chain]
+        if new_order != old_order:
+            logger.info(f'Static filters reordered: {", ".join(new_order)}')
+            for stats in self.dump():
+                logger.info(f'{stats}')
+        for _, stats in self.chain:
+            stats.decay(self.decay)
+
+    def dump(self) -> List[dict]:
+        """Stats of filters in current order"""
+        return [stats.dump() for _, stats in self.chain]
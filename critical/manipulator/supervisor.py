@@ -0,0 +1,233 @@
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from .loggers import customize_worker_logger, main_logger as logger
+
+
+def stop_worker(signum, frame):
+    """Turn first SIGTERM/SIGINT into graceful stop, ignore repeated ones"""
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+def run_worker(target: Callable[..., None], args: tuple, index: int,
+               log_queue: multiprocessing.Queue,
+               stats_queue: multiprocessing.Queue,
+               level_name: str) -> None:
+    """
+    Worker process entry point
+    :param target: function running the actual work, gets `on_stats`
+    callback and `worker` index as keyword arguments
+    :param args: positional arguments for target
+    :param index: worker number, added to logger names
+    :param log_queue: records are sent to supervisor through it
+    :param stats_queue: stats reports are sent to supervisor through it
+    :param level_name: logging level
+    :return: None
+    """
+    signal.signal(signal.SIGTERM, stop_worker)
+    signal.signal(signal.SIGINT, stop_worker)
+    # target handles reload requests once it is ready
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    customize_worker_logger(log_queue, level_name, index)
+
+    def on_stats(stats: List[dict]) -> None:
+        stats_queue.put((index, stats))
+
+    try:
+        target(*args, on_stats=on_stats, worker=index)
+    except Exception as e:
+        # traceback goes to combined logs instead of worker's stderr
+        logger.exception(f'Worker crashed: {e.__class__.__name__}: {e}')
+        raise SystemExit(1)
+
+
+def merge_stats(reports: Iterable[List[dict]]) -> List[dict]:
+    """
+    Combine handler stats reported by several workers
+    :param reports: lists of Handler.stats() results
+    :return: one stats entry per handler name
+    """
+    merged: Dict[str, dict] = {}
+    for report in reports:
+        for stats in report:
+            entry = merged.setdefault(stats['handler'], {
+                'handler': stats['handler'], 'workers': 0,
+                'static_filters': {}, 'queue_depth': {}})
+            entry['workers'] += 1
+            for name, depth in stats['queue_depth'].items():
+                entry['queue_depth'][name] = \
+                    entry['queue_depth'].get(name, 0) + depth
+            for filter_stats in stats['static_filters']:
+                totals = entry['static_filters'].setdefault(
+                    filter_stats['filter'],
+                    {'calls': 0, 'passed': 0.0, 'cost_us': 0.0})
+                calls = filter_stats['calls']
+                totals['calls'] += calls
+                totals['passed'] += calls * filter_stats['pass_rate']
+                totals['cost_us'] += calls * filter_stats['mean_cost_us']
+    result = []
+    for entry in merged.values():
+        static_filters = []
+        for name, totals in entry['static_filters'].items():
+            calls = totals['calls']
+            static_filters.append({
+                'filter': name,
+                'calls': calls,
+                'pass_rate': round(totals['passed'] / calls, 4)
+                if calls else 0,
+                'mean_cost_us': round(totals['cost_us'] / calls, 3)
+                if calls else 0})
+        entry['static_filters'] = static_filters
+        result.append(entry)
+    return result
+
+
+class Supervisor:
+    def __init__(self, target: Callable[..., None], args: tuple,
+                 workers: int,
+                 level_name: str = 'WARN',
+                 restart_delay: float = 1,
+                 max_restart_delay: float = 60,
+                 stats_interval: float = 60,
+                 shutdown_timeout: float = 30,
+                 handlers: Optional[List[logging.Handler]] = None):
+        """
+        Run target in several processes, restart crashed ones
+        :param target: picklable function running the actual work
+        :param args: positional arguments for target
+        :param workers: number of worker processes
+        :param level_name: workers logging level
+        :param restart_delay: delay before restarting crashed worker,
+        doubled for workers that keep crashing
+        :param max_restart_delay: restart delay limit, workers that ran
+        longer than that are restarted with initial delay again
+        :param stats_interval: seconds between combined stats records
+        :param shutdown_timeout: seconds to wait for workers on stop
+        :param handlers: handlers for workers' records, root logger
+        handlers by default
+        """
+        self.target = target
+        self.args = args
+        self.workers = workers
+        self.level_name = level_name
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stats_interval = stats_interval
+        self.shutdown_timeout = shutdown_timeout
+        self.handlers = handlers
+        self.context = multiprocessing.get_context('spawn')
+        self.log_queue = self.context.Queue()
+        self.stats_queue = self.context.Queue()
+        self.processes: Dict[int, Any] = {}
+        self.started_at: Dict[int, float] = {}
+        self.delays: Dict[int, float] = {}
+        self.restart_at: Dict[int, float] = {}
+        self.restarts = 0
+        self.stats: Dict[int, List[dict]] = {}
+        self.stopped = threading.Event()
+
+    def spawn(self, index: int) -> None:
+        process = self.context.Process(
+            target=run_worker, name=f'critical-worker-{index}',
+            args=(self.target, self.args, index, self.log_queue,
+                  self.stats_queue, self.level_name))
+        process.start()
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+        logger.error(f'Worker #{index} started, pid {process.pid}')
+
+    def check(self) -> None:
+        """Schedule restart of exited workers and start due ones"""
+        now = time.monotonic()
+        for index, process in self.processes.items():
+            if process.exitcode is None or index in self.restart_at:
+                continue
+            delay = self.delays.get(index, self.restart_delay)
+            if now - self.started_at[index] > self.max_restart_delay:
+                delay = self.restart_delay
+            self.delays[index] = min(delay * 2, self.max_restart_delay)
+            self.restart_at[index] = now + delay
+            self.stats.pop(index, None)
+            logger.error(f'Worker #{index} exited with code '
+                         f'{process.exitcode}, restart in {delay:.1f}s')
+        for index, restart_at in list(self.restart_at.items()):
+            if restart_at <= now:
+                del self.restart_at[index]
+                self.restarts += 1
+                self.spawn(index)
+
+    def collect(self, timeout: float) -> None:
+        """Wait for stats reports"""
+        try:
+            index, stats = self.stats_queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        self.stats[index] = stats
+
+    def run(self) -> None:
+        """
+        Start workers and keep them running until stop or KeyboardInterrupt
+        :return: None
+        """
+        handlers = self.handlers
+        if handlers is None:
+            handlers = logging.getLogger().handlers
+        listener = logging.handlers.QueueListener(
+            self.log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        signal_handled = threading.current_thread() is \
+            threading.main_thread()
+        if signal_handled:
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            signal.signal(signal.SIGHUP, self.forward_signal)
+        try:
+            for index in range(self.workers):
+                self.spawn(index)
+            reported_at = time.monotonic()
+            while not self.stopped.is_set():
+                self.check()
+                self.collect(timeout=0.1)
+                if time.monotonic() - reported_at >= self.stats_interval:
+                    reported_at = time.monotonic()
+                    logger.info(f'Stats: '
+                                f'{merge_stats(self.stats.values())}')
+        except KeyboardInterrupt:
+            logger.error('Stopping workers...')
+        finally:
+            self.shutdown()
+            listener.stop()
+            if signal_handled:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+    def forward_signal(self, signum, frame) -> None:
+        """Pass signal (SIGHUP asking to reload configs) to workers"""
+        for process in self.processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def shutdown(self) -> None:
+        processes = [process for process in self.processes.values()
+                     if process.is_alive()]
+        for process in processes:
+            process.terminate()
+        deadline = time.monotonic() + self.shutdown_timeout
+        for process in processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.error(f'{process.name} did not stop, killing')
+                process.kill()
+                process.join()
+        logger.error('Workers stopped')
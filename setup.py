@@ -47,6 +47,7 @@ setup(
     python_requires='>=3.9',
     packages=find_packages(exclude=['tests']),
     install_requires=load_requirements('requirements.txt'),
+    extras_require={'fast': ['orjson']},
     entry_points={
         'console_scripts': [
             'critical = critical.manipulator.__main__:typer_main',
@@ -1,11 +1,17 @@
 import asyncio
+import gzip
+import json
 import logging
+import time
 
 import aiokafka
 import pytest
 
 from critical.manipulator.consumers import AbstractAsyncConsumer
+from critical.manipulator.consumers import FileAsyncConsumer
+from critical.manipulator.consumers import GELFAsyncConsumer
 from critical.manipulator.consumers import KafkaAsyncConsumer
+from critical.manipulator.consumers import OffsetTracker
 from critical.manipulator.models import GELFMessage
 
 
@@ -15,16 +21,297 @@ async def test_abstract():
         consumer = AbstractAsyncConsumer()
     AbstractAsyncConsumer.__abstractmethods__ = set()
     consumer = AbstractAsyncConsumer()
-    count = await consumer.consumer_target_count()
-    assert isinstance(count, int)
-    assert count > 0
-    assert isinstance(await consumer.fork(), AbstractAsyncConsumer)
 
     await consumer.start()
     await consumer.stop()
 
     with pytest.raises(NotImplementedError):
         msg = await consumer.consume()
+    with pytest.raises(NotImplementedError):
+        msgs = await consumer.consume_batch()
+
+
+def record(partition, offset, value):
+    return aiokafka.ConsumerRecord('topic', partition, offset, 0, 0, None,
+                                   value, None, 0, len(value), ())
+
+
+class FakeKafkaConsumer:
+    def __init__(self, values, partitions=1):
+        self.partitions = [aiokafka.TopicPartition('topic', index)
+                           for index in range(partitions)]
+        # values are spread among partitions round-robin
+        self.values = {tp: values[tp.partition::partitions]
+                       for tp in self.partitions}
+        self.offsets = {tp: 0 for tp in self.partitions}
+        self.listener = None
+        self.paused_partitions = set()
+        self.commits = []
+
+    def subscribe(self, topics, listener=None):
+        self.listener = listener
+
+    async def start(self):
+        await self.listener.on_partitions_assigned(self.partitions)
+
+    async def stop(self):
+        pass
+
+    async def commit(self, offsets):
+        self.commits.append({tp.partition: offset
+                             for tp, offset in offsets.items()})
+
+    def pause(self, *partitions):
+        self.paused_partitions.update(partitions)
+
+    def resume(self, *partitions):
+        self.paused_partitions.difference_update(partitions)
+
+    def highwater(self, tp):
+        return self.offsets[tp] + len(self.values[tp])
+
+    async def getmany(self, timeout_ms=0, max_records=None):
+        batch = {}
+        for tp in self.partitions:
+            values = self.values[tp][:max_records]
+            if tp in self.paused_partitions or not values:
+                continue
+            self.values[tp] = self.values[tp][max_records:]
+            batch[tp] = [record(tp.partition, self.offsets[tp] + index, value)
+                         for index, value in enumerate(values)]
+            self.offsets[tp] += len(values)
+        if not batch:
+            await asyncio.sleep(timeout_ms / 1000)
+        return batch
+
+
+class RecordingHandler:
+    def __init__(self):
+        self.batches = []
+        self.acks = []
+        self.saturated = False
+
+    async def handle_batch(self, objs, acks=None):
+        self.batches.append(objs)
+        self.acks.extend(acks or [])
+
+
+def test_offset_tracker():
+    tracker = OffsetTracker()
+    assert not tracker.uncommitted
+    for offset in range(10, 14):
+        tracker.add(offset)
+    assert tracker.watermark == 10
+    tracker.finish(11)
+    tracker.finish(13)
+    # 10 is still in flight
+    assert tracker.watermark == 10
+    tracker.finish(10)
+    assert tracker.watermark == 12
+    assert tracker.in_flight == 2
+    tracker.finish(12)
+    assert tracker.watermark == 14
+    assert tracker.in_flight == 0
+    assert tracker.uncommitted
+    tracker.committed = 14
+    assert not tracker.uncommitted
+    # offsets that are not in flight are ignored
+    tracker.finish(12)
+    tracker.add(14)
+    tracker.finish(13)
+    assert tracker.finished == set()
+    assert tracker.watermark == 14
+
+
+@pytest.mark.asyncio
+async def test_kafka_batch(composer):
+    values = [composer.message().encode('utf-8') for _ in range(3)]
+    values.insert(1, b'not a json')
+    consumer = KafkaAsyncConsumer(FakeKafkaConsumer(values), 'topic',
+                                  max_records=3)
+    batch = await consumer.consume_batch()
+    assert len(batch) == 2
+    assert all(isinstance(msg, GELFMessage) for msg in batch)
+    batch = await consumer.consume_batch()
+    assert len(batch) == 1
+    assert await consumer.consume_batch() == []
+
+
+@pytest.mark.asyncio
+async def test_kafka_partitions():
+    values = [f'v{index}'.encode() for index in range(6)]
+    fake = FakeKafkaConsumer(values, partitions=2)
+    consumer = KafkaAsyncConsumer(fake, 'topic', timeout_ms=10,
+                                  decoder=bytes.decode)
+    await consumer.start()
+    assert sorted(tp.partition for tp in consumer.tasks) == [0, 1]
+
+    handler = RecordingHandler()
+    runner = asyncio.create_task(consumer.run(handler))
+    await asyncio.sleep(0.05)
+    # every batch comes from one partition, records keep their order
+    assert sorted(map(tuple, handler.batches)) == [('v0', 'v2', 'v4'),
+                                                   ('v1', 'v3', 'v5')]
+
+    handler.saturated = True
+    await asyncio.sleep(0.05)
+    assert fake.paused_partitions == set(fake.partitions)
+    handler.saturated = False
+    await asyncio.sleep(0.05)
+    assert not fake.paused_partitions
+
+    await fake.listener.on_partitions_revoked(fake.partitions[:1])
+    assert list(consumer.tasks) == fake.partitions[1:]
+
+    runner.cancel()
+    await asyncio.gather(runner, return_exceptions=True)
+    await consumer.stop()
+    assert not consumer.tasks
+
+
+@pytest.mark.asyncio
+async def test_kafka_at_least_once():
+    values = [f'v{index}'.encode() for index in range(4)]
+    values.insert(2, b'\xff')
+    fake = FakeKafkaConsumer(values)
+    consumer = KafkaAsyncConsumer(fake, 'topic', timeout_ms=10,
+                                  decoder=bytes.decode, at_least_once=True,
+                                  commit_interval=0.02, commit_records=2)
+    await consumer.start()
+    handler = RecordingHandler()
+    runner = asyncio.create_task(consumer.run(handler))
+    await asyncio.sleep(0.05)
+    assert len(handler.acks) == 4
+    # nothing is delivered yet, undecodable record alone is not enough
+    assert fake.commits == []
+
+    handler.acks[1]()
+    handler.acks[3]()
+    await asyncio.sleep(0.05)
+    assert fake.commits == []
+    handler.acks[0]()
+    await asyncio.sleep(0.05)
+    # 0, 1, 2 (undecodable) and 4 are finished, 3 is still in flight
+    assert fake.commits == [{0: 3}]
+
+    handler.acks[2]()
+    runner.cancel()
+    await asyncio.gather(runner, return_exceptions=True)
+    await consumer.stop()
+    assert fake.commits == [{0: 3}, {0: 5}]
+
+
+@pytest.mark.asyncio
+async def test_kafka_late_ack_after_reassignment():
+    fake = FakeKafkaConsumer([b'v0', b'v1'])
+    consumer = KafkaAsyncConsumer(fake, 'topic', timeout_ms=10,
+                                  decoder=bytes.decode, at_least_once=True)
+    await consumer.start()
+    handler = RecordingHandler()
+    runner = asyncio.create_task(consumer.run(handler))
+    await asyncio.sleep(0.05)
+    assert len(handler.acks) == 2
+
+    # partition is revoked while deliveries are pending, then reassigned
+    await fake.listener.on_partitions_revoked(fake.partitions)
+    await fake.listener.on_partitions_assigned(fake.partitions)
+    tracker = consumer.trackers[fake.partitions[0]]
+    for ack in handler.acks:
+        ack()
+    assert tracker.finished == set()
+    assert tracker.watermark is None
+
+    runner.cancel()
+    await asyncio.gather(runner, return_exceptions=True)
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_file_consumer(tmp_path, composer):
+    ndjson = tmp_path / 'capture.ndjson'
+    ndjson.write_text('\n'.join([composer.message(), '', 'not a json',
+                                  composer.message()]) + '\n')
+    dump = tmp_path / 'capture.gelf'
+    dump.write_bytes(b'\x00'.join(composer.message().encode()
+                                  for _ in range(3)) + b'\x00')
+    (tmp_path / 'empty').write_bytes(b'')
+    consumer = FileAsyncConsumer.from_dict({
+        'paths': [ndjson, tmp_path / 'empty', dump], 'max_records': 3})
+    await consumer.start()
+    assert isinstance(await consumer.consume(), GELFMessage)
+    batch = await consumer.consume_batch()
+    assert len(batch) == 2
+    assert all(isinstance(msg, GELFMessage) for msg in batch)
+    assert not consumer.exhausted
+    assert len(await consumer.consume_batch()) == 2
+    assert consumer.exhausted
+    assert await consumer.consume_batch() == []
+    assert await consumer.consume() is None
+    # default batch of exhausted source has no None message
+    assert await AbstractAsyncConsumer.consume_batch(consumer) == []
+    await consumer.stop()
+
+    handler = RecordingHandler()
+    handler.wait_drained = None
+    consumer = FileAsyncConsumer([dump], file_format='gelf')
+    await consumer.start()
+    await asyncio.wait_for(consumer.run(handler), 1)
+    assert sum(map(len, handler.batches)) == 3
+
+    with pytest.raises(ValueError):
+        FileAsyncConsumer([dump], file_format='csv')
+
+
+@pytest.mark.asyncio
+async def test_file_consumer_realtime(tmp_path):
+    path = tmp_path / 'capture.ndjson'
+    path.write_text('\n'.join(json.dumps({'timestamp': 100 + delay})
+                              for delay in (0, 0, 0.2)))
+    consumer = FileAsyncConsumer([path], speed=2, decoder=json.loads)
+    await consumer.start()
+    started = time.monotonic()
+    # third message is due in 0.1 seconds
+    assert len(await consumer.consume_batch()) == 2
+    assert len(await consumer.consume_batch()) == 1
+    assert time.monotonic() - started >= 0.09
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_gelf_consumer(composer):
+    consumer = GELFAsyncConsumer.from_dict({
+        'host': '127.0.0.1', 'tcp_port': None, 'udp_port': None,
+        'timeout_ms': 10})
+    await consumer.start()
+    assert await consumer.consume_batch() == []
+    await consumer.stop()
+
+    # ports are picked by OS
+    consumer = GELFAsyncConsumer('127.0.0.1', 0, 0, timeout_ms=10,
+                                 max_message_size=4096)
+    await consumer.start()
+    tcp_port, udp_port = consumer.tcp_port, consumer.udp_port
+    loop = asyncio.get_running_loop()
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', tcp_port)
+    writer.write(composer.message().encode() + b'\x00not a json\x00'
+                 + composer.message().encode())
+    await writer.drain()
+    writer.close()
+    payload = gzip.compress(composer.message().encode())
+    half = len(payload) // 2
+    sender, _ = await loop.create_datagram_endpoint(
+        asyncio.DatagramProtocol, remote_addr=('127.0.0.1', udp_port))
+    for number, part in enumerate((payload[:half], payload[half:])):
+        sender.sendto(b'\x1e\x0fmessage1' + bytes([number, 2]) + part)
+    sender.close()
+    await asyncio.sleep(0.05)
+
+    batch = await consumer.consume_batch()
+    assert len(batch) == 3
+    assert all(isinstance(msg, GELFMessage) for msg in batch)
+    await consumer.stop()
+    assert consumer.tcp_server is None
 
 
 @pytest.mark.asyncio
@@ -36,14 +323,6 @@ async def test_kafka(kafka_creds, kafka_producer, kafka_consumer, composer):
     topic = kafka_creds.get('topic')
     consumer = KafkaAsyncConsumer(k_consumer, topic)
     await consumer.start()
-    count = await consumer.consumer_target_count()
-    assert isinstance(count, int)
-
-    fork = await consumer.fork()
-    assert fork is not None
-    assert isinstance(fork, KafkaAsyncConsumer)
-    assert isinstance(fork.consumer, aiokafka.AIOKafkaConsumer)
-    await fork.stop()
 
     # empty the queue
     while True:
@@ -0,0 +1,95 @@
+import copy
+import datetime
+import ipaddress
+import json
+import pickle
+
+import pytest
+from pydantic import ValidationError
+
+from critical.manipulator.decoders import decode_full, get_decoder
+from critical.manipulator.decoders import LazyDecoder, decode_compact
+from critical.manipulator.models import GELFMessage, LazyGELFMessage
+from critical.manipulator.models import CompactGELFMessage
+from critical.manipulator.static_filters import SourceIPFilter
+from critical.manipulator.formatters import CopyFieldFormatter
+
+
+def test_full_decoder(composer):
+    value = composer.message().encode('utf-8')
+    assert isinstance(decode_full(value), GELFMessage)
+    assert get_decoder('full') is decode_full
+    with pytest.raises(ValueError):
+        get_decoder('invalid')
+
+
+def test_lazy_decoder(composer):
+    msg_dict = composer.message_dict(ip_address='127.0.0.1', short='test')
+    msg_dict['_custom'] = 'custom value'
+    value = composer.message().encode('utf-8')
+
+    decoder = get_decoder('lazy', frozenset({'_gl2_remote_ip',
+                                             'short_message'}))
+    assert isinstance(decoder, LazyDecoder)
+    gelf = decoder(value)
+    assert isinstance(gelf, LazyGELFMessage)
+    assert set(gelf.dict(by_alias=True)) == {'_gl2_remote_ip',
+                                             'short_message'}
+    assert isinstance(gelf.gl2_remote_ip_, ipaddress.IPv4Address)
+    with pytest.raises(AttributeError):
+        gelf.full_message_
+
+    gelf = LazyGELFMessage(msg_dict)
+    reference = GELFMessage(**msg_dict)
+    assert gelf.dict() == reference.dict()
+    assert gelf.dict(by_alias=True) == reference.dict(by_alias=True)
+    assert gelf.timestamp_ == reference.timestamp_
+    assert gelf._custom == 'custom value'
+    assert SourceIPFilter(ips=['127.0.0.1']).filter(gelf) is True
+    assert CopyFieldFormatter('short_message').format(gelf) == 'test'
+
+    for copied in (copy.copy(gelf), pickle.loads(pickle.dumps(gelf))):
+        assert copied.dict() == gelf.dict()
+        assert copied._custom == 'custom value'
+
+    msg_dict['_gl2_remote_ip'] = 'not an IP'
+    gelf = LazyGELFMessage(msg_dict)
+    assert gelf.short_message == 'test'
+    with pytest.raises(ValidationError):
+        gelf.gl2_remote_ip_
+
+
+def test_compact_decoder(composer):
+    msg_dict = composer.message_dict(ip_address='127.0.0.1', short='test')
+    msg_dict['_custom'] = 'custom value'
+    value = json.dumps(msg_dict).encode('utf-8')
+
+    decoder = get_decoder('compact')
+    assert decoder is decode_compact
+    gelf = decoder(value)
+    assert isinstance(gelf, CompactGELFMessage)
+    reference = GELFMessage(**msg_dict)
+    assert gelf.dict() == reference.dict()
+    assert gelf.dict(by_alias=True) == reference.dict(by_alias=True)
+    assert gelf.gl2_remote_ip_int == 0x7f000001
+    assert gelf.timestamp == reference.timestamp
+    assert gelf.timestamp_ == reference.timestamp_
+    assert gelf.id_ == reference.id_
+    assert gelf._custom == 'custom value'
+    with pytest.raises(AttributeError):
+        gelf._missing
+    assert SourceIPFilter(ips=['127.0.0.1']).filter(gelf) is True
+    assert CopyFieldFormatter('short_message').format(gelf) == 'test'
+
+    # Graylog timestamps end with Z
+    msg_dict['_timestamp'] = '2023-01-01T10:00:00.123Z'
+    gelf = CompactGELFMessage(msg_dict)
+    assert gelf.timestamp_ == GELFMessage(**msg_dict).timestamp_
+    assert gelf.timestamp_.utcoffset() == datetime.timedelta(0)
+
+    msg_dict['_gl2_remote_ip'] = 'not an IP'
+    with pytest.raises(ValueError):
+        CompactGELFMessage(msg_dict)
+    msg_dict.pop('host')
+    with pytest.raises(ValueError):
+        CompactGELFMessage(msg_dict)
@@ -0,0 +1,175 @@
+import asyncio
+
+import pytest
+
+from critical.manipulator.delivery import Acknowledgement, OutboundQueue
+from critical.manipulator.handler import Handler
+from critical.manipulator.formatters import CopyFieldFormatter
+from critical.manipulator.senders import DummySender
+
+
+class RecordingSender(DummySender):
+    def __init__(self, receivers, delay: float = 0, **kwargs):
+        super().__init__(receivers, **kwargs)
+        self.delay = delay
+        self.sent = []
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def send_one(self, message, receiver):
+        await self.release.wait()
+        await asyncio.sleep(self.delay)
+        self.sent.append(message)
+
+
+class QueueingSender(DummySender):
+    """Queues messages and returns futures, like TelegramSender"""
+    def __init__(self, receivers, **kwargs):
+        super().__init__(receivers, **kwargs)
+        self.futures = []
+
+    async def send_one(self, message, receiver):
+        future = asyncio.get_running_loop().create_future()
+        self.futures.append(future)
+        return future
+
+
+@pytest.mark.asyncio
+async def test_outbound_queue():
+    sender = RecordingSender([None])
+    queue = OutboundQueue(sender, [], workers=2, maxsize=10)
+    await queue.start()
+    for index in range(5):
+        await queue.put(str(index))
+    await queue.stop()
+    assert sorted(sender.sent) == ['0', '1', '2', '3', '4']
+    assert queue.depth == 0
+    assert not queue.tasks
+
+
+@pytest.mark.asyncio
+async def test_backpressure(composer):
+    sender = RecordingSender([None])
+    sender.release.clear()
+    handler = Handler([], [], CopyFieldFormatter('short_message'), [sender],
+                      'consumer_spec',
+                      delivery={'queue_size': 10, 'high_water': 6,
+                                'low_water': 2})
+    await handler.start()
+    await handler.handle_batch([composer.gelf() for _ in range(5)])
+    assert not handler.saturated
+    await handler.handle_batch([composer.gelf() for _ in range(3)])
+    assert handler.saturated
+    assert await handler.wait_drained(0.01) is False
+    assert sum(handler.queue_depth.values()) >= 6
+
+    sender.release.set()
+    assert await handler.wait_drained(1) is True
+    assert not handler.saturated
+    await handler.stop()
+    assert len(sender.sent) == 8
+    assert handler.stats()['queue_depth'] == {'RecordingSender#0': 0}
+
+
+@pytest.mark.asyncio
+async def test_acknowledgement(composer):
+    acked = []
+    ack = Acknowledgement(lambda: acked.append('a'), 2)
+    ack()
+    assert acked == []
+    ack()
+    assert acked == ['a']
+    Acknowledgement(lambda: acked.append('b'), 0)
+    assert acked == ['a', 'b']
+
+    sender = QueueingSender([1, 2])
+    other = RecordingSender([None])
+    handler = Handler([], [], CopyFieldFormatter('short_message'),
+                      [sender, other], 'consumer_spec')
+    await handler.start()
+    acked = []
+    gelfs = [composer.gelf() for _ in range(2)]
+    await handler.handle_batch(gelfs, [lambda: acked.append(0),
+                                       lambda: acked.append(1)])
+    await asyncio.sleep(0.01)
+    # second sender is done, first one still waits for deliveries
+    assert len(other.sent) == 2
+    assert len(sender.futures) == 4
+    assert acked == []
+    for future in sender.futures[2:]:
+        future.set_result(True)
+    await asyncio.sleep(0.01)
+    assert acked == [1]
+    for future in sender.futures[:2]:
+        future.set_result(True)
+    await handler.stop()
+    assert acked == [1, 0]
+
+
+class FailingFormatter(CopyFieldFormatter):
+    def format(self, obj):
+        if obj.short_message == 'bad':
+            raise ValueError('bad message')
+        return super().format(obj)
+
+
+@pytest.mark.asyncio
+async def test_failed_message_acknowledged(composer):
+    sender = RecordingSender([None])
+    handler = Handler([], [], FailingFormatter('short_message'), [sender],
+                      'consumer_spec')
+    await handler.start()
+    acked = []
+    gelfs = [composer.gelf(short=short)
+             for short in ('good', 'bad', 'good', 'good')]
+    await handler.handle_batch(gelfs, [lambda i=i: acked.append(i)
+                                       for i in range(4)])
+    await handler.stop()
+    # failed message is dropped, the rest of batch is delivered
+    assert sorted(acked) == [0, 1, 2, 3]
+    assert sender.sent == ['good'] * 3
+
+    other = RecordingSender([None])
+    handler = Handler([], [], FailingFormatter('short_message'),
+                      [sender, other], 'consumer_spec')
+
+    async def broken_put(message, ack=None):
+        raise RuntimeError('queue is broken')
+
+    handler.queues[1].put = broken_put
+    await handler.start()
+    acked = []
+    with pytest.raises(RuntimeError):
+        await handler.handle_batch(gelfs[:1], [lambda: acked.append(0)])
+    await handler.stop()
+    assert acked == [0]
+
+
+@pytest.mark.asyncio
+async def test_stop_timeout():
+    # deliveries are never finished by sender
+    sender = QueueingSender([1])
+    queue = OutboundQueue(sender, [], maxsize=10, batch_size=2,
+                          stop_timeout=0.05)
+    acked = []
+    await queue.start()
+    for index in range(2):
+        await queue.put(str(index), lambda i=index: acked.append(i))
+    await asyncio.sleep(0.01)
+    await queue.stop()
+    assert sorted(acked) == [0, 1]
+    assert all(future.cancelled() for future in sender.futures)
+
+    # sender is stuck, queued messages are dropped and acknowledged too
+    sender = RecordingSender([None])
+    sender.release.clear()
+    queue = OutboundQueue(sender, [], maxsize=10, batch_size=1,
+                          stop_timeout=0.05)
+    acked = []
+    await queue.start()
+    for index in range(3):
+        await queue.put(str(index), lambda i=index: acked.append(i))
+    await queue.stop()
+    assert sorted(acked) == [0, 1, 2]
+    assert sender.sent == []
+    assert not queue.tasks
@@ -1,6 +1,46 @@
+import asyncio
+
 import pytest
 
 from critical.manipulator.dynamic_filters import RedisExcludeRegexp
+from critical.manipulator.dynamic_filters import RedisExcludePattern
+
+
+class FakeRedis:
+    def __init__(self, sets: dict):
+        self.sets = sets
+        self.calls = 0
+
+    async def smembers(self, key):
+        self.calls += 1
+        await asyncio.sleep(0)
+        return set(self.sets.get(key, ()))
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def close(self):
+        pass
+
+
+class FakePipeline:
+    def __init__(self, fake_redis: FakeRedis):
+        self.redis = fake_redis
+        self.keys = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def smembers(self, key):
+        self.keys.append(key)
+        return self
+
+    async def execute(self):
+        self.redis.calls += 1
+        return [set(self.redis.sets.get(key, ())) for key in self.keys]
 
 
 @pytest.mark.asyncio
@@ -19,6 +59,7 @@ async def test_redis_exclude_regexp(composer, redis_creds):
     await current_filter.redis.srem('test_key', 'test_value')
 
     await current_filter.redis.sadd(key, r'inva[lid')
+    current_filter.invalidate(key)
     message_include = 'message that contains inva[lid regexp'
     message_exclude = 'message that contains nothing bad'
     assert await current_filter.filter(message_include, key) is True
@@ -26,3 +67,65 @@ async def test_redis_exclude_regexp(composer, redis_creds):
     await current_filter.redis.srem('test_key', 'test_value')
 
     await current_filter.stop()
+
+
+@pytest.mark.asyncio
+async def test_redis_cache():
+    fake_redis = FakeRedis({'tg_1': {'bad'}})
+    current_filter = RedisExcludePattern(fake_redis, cache_ttl=60)
+    assert await current_filter.filter('bad message', 'tg_1') is True
+    assert await current_filter.filter('good message', 'tg_1') is False
+    assert await current_filter.filter('bad message', 'tg_2') is False
+    assert fake_redis.calls == 2
+
+    fake_redis.sets['tg_1'] = {'good'}
+    assert await current_filter.filter('good message', 'tg_1') is False
+    current_filter.invalidate('tg_1')
+    assert await current_filter.filter('good message', 'tg_1') is True
+    assert fake_redis.calls == 3
+
+    # invalidation during fetch must not leave stale set in cache
+    fetch = asyncio.create_task(current_filter.patterns('tg_3'))
+    await asyncio.sleep(0)
+    current_filter.invalidate()
+    await fetch
+    assert 'tg_3' not in current_filter.cache
+
+    current_filter = RedisExcludePattern(fake_redis, cache_ttl=0)
+    await current_filter.filter('good message', 'tg_1')
+    await current_filter.filter('good message', 'tg_1')
+    assert fake_redis.calls == 6
+    assert not current_filter.cache
+
+
+@pytest.mark.asyncio
+async def test_redis_compiled_matcher():
+    fake_redis = FakeRedis({'tg_1': {r'\d{3}', r'inva[lid'}})
+    current_filter = RedisExcludeRegexp(fake_redis, cache_ttl=0)
+    assert await current_filter.filter('contains 123', 'tg_1') is True
+    assert await current_filter.filter('contains inva[lid', 'tg_1') is True
+    assert await current_filter.filter('contains nothing', 'tg_1') is False
+    matcher = await current_filter.matcher('tg_1')
+    # same patterns fetched again, matcher is reused
+    assert await current_filter.matcher('tg_1') is matcher
+
+    fake_redis.sets['tg_1'] = {r'nothing$'}
+    assert await current_filter.matcher('tg_1') is not matcher
+    assert await current_filter.filter('contains nothing', 'tg_1') is True
+
+
+@pytest.mark.asyncio
+async def test_redis_filter_many():
+    fake_redis = FakeRedis({'tg_1': {'bad'}, 'tg_2': {'worse'}})
+    current_filter = RedisExcludePattern(fake_redis, cache_ttl=60)
+    keys = ['tg_1', 'tg_2', 'tg_3']
+    assert await current_filter.filter_many('bad', keys) == [True, False,
+                                                             False]
+    assert fake_redis.calls == 1
+    assert await current_filter.filter_many('worse', keys) == [False, True,
+                                                               False]
+    assert fake_redis.calls == 1
+    current_filter.invalidate('tg_2')
+    assert await current_filter.filter_many('worse', keys) == [False, True,
+                                                               False]
+    assert fake_redis.calls == 2
@@ -1,5 +1,10 @@
+import pytest
+
 from critical.manipulator.formatters import CopyFieldFormatter
 from critical.manipulator.formatters import SimpleMailFormatter
+from critical.manipulator.formatters import TemplateFormatter
+from critical.manipulator.models import GELFMessage, LazyGELFMessage
+from critical.manipulator.models import CompactGELFMessage
 
 
 def test_copy_filed(composer):
@@ -36,8 +41,41 @@ def test_simple_main(composer):
     assert formatter_output.startswith('Subject: ')
     assert len(formatter_output.split('\n')) >= 3
 
+    formatter = SimpleMailFormatter(subject_field='host',
+                                    body_field='short_message',
+                                    template='{subject}|{body}')
+    gelf = composer.gelf(hostname='sw', short='test')
+    formatter_output = formatter.format(gelf)
+    assert formatter_output == 'sw|test\n\n' + gelf.timestamp_.isoformat()
+
     formatter = SimpleMailFormatter.from_dict({'subject_field': 'short_message',
                                                'body_field': 'short_message'})
     formatter_output = formatter.format(gelf)
     assert formatter_output.startswith('Subject: ')
     assert len(formatter_output.split('\n')) >= 3
+
+
+def test_template(composer):
+    formatter = TemplateFormatter('{host} ({_gl2_remote_ip}): {short_message}'
+                                  ' [{level:>3}] {_custom!r} {facility_}')
+    assert formatter.required_fields == {'host', '_gl2_remote_ip',
+                                         'short_message', 'level', '_custom',
+                                         '_facility'}
+    msg_dict = composer.message_dict(hostname='sw', short='test',
+                                     ip_address='127.0.0.1')
+    expected = 'sw (127.0.0.1): test [  6] None local7'
+    assert formatter.format(GELFMessage(**msg_dict)) == expected
+    assert formatter.format(CompactGELFMessage(msg_dict)) == expected
+    assert formatter.format(LazyGELFMessage(msg_dict)) == expected
+    msg_dict['_custom'] = 'value'
+    expected = "sw (127.0.0.1): test [  6] 'value' local7"
+    assert formatter.format(GELFMessage(**msg_dict)) == expected
+    assert formatter.format(CompactGELFMessage(msg_dict)) == expected
+
+    formatter = TemplateFormatter.from_dict({'template': 'no fields'})
+    assert formatter.format(GELFMessage(**msg_dict)) == 'no fields'
+
+    with pytest.raises(ValueError):
+        TemplateFormatter('{} positional')
+    with pytest.raises(ValueError):
+        TemplateFormatter('{host:{width}} nested')
@@ -0,0 +1,56 @@
+import gzip
+import time
+import zlib
+
+import pytest
+
+from critical.manipulator.gelf_input import ChunkAssembler, decompress
+
+
+def chunks(payload: bytes, size: int, message_id: bytes = b'12345678'):
+    parts = [payload[index:index + size]
+             for index in range(0, len(payload), size)]
+    return [b'\x1e\x0f' + message_id + bytes([number, len(parts)]) + part
+            for number, part in enumerate(parts)]
+
+
+def test_decompress():
+    payload = b'{"short_message": "test"}'
+    assert decompress(payload, 100) == payload
+    assert decompress(zlib.compress(payload), 100) == payload
+    assert decompress(gzip.compress(payload), 100) == payload
+    with pytest.raises(ValueError):
+        decompress(zlib.compress(b'x' * 1000), 100)
+
+
+def test_chunk_assembler():
+    payload = b'{"short_message": "' + b'a' * 100 + b'"}'
+    assembler = ChunkAssembler(timeout=0.05, max_messages=2)
+    parts = chunks(payload, 30)
+    # chunks may come in any order and repeat
+    assert assembler.add(parts[2]) is None
+    assert assembler.add(parts[2]) is None
+    for part in parts[:2] + parts[3:-1]:
+        assert assembler.add(part) is None
+    assert assembler.add(parts[-1]) == payload
+    assert not assembler.messages
+
+    with pytest.raises(ValueError):
+        assembler.add(b'\x1e\x0f12345678\x02\x02')
+    with pytest.raises(ValueError):
+        assembler.add(b'\x1e\x0f123')
+
+    # the oldest incomplete message makes room for a new one
+    for message_id in (b'aaaaaaaa', b'bbbbbbbb', b'cccccccc'):
+        assembler.add(chunks(payload, 30, message_id)[0])
+    assert list(assembler.messages) == [b'bbbbbbbb', b'cccccccc']
+    assert assembler.dropped == 1
+    time.sleep(0.06)
+    assembler.expire()
+    assert not assembler.messages
+    assert assembler.dropped == 3
+
+    small = ChunkAssembler(max_size=50)
+    with pytest.raises(ValueError):
+        for part in parts:
+            small.add(part)
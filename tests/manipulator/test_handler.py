@@ -2,7 +2,7 @@ import logging
 
 import pytest
 
-from critical.manipulator.handler import Handler
+from critical.manipulator.handler import Handler, HandlerGroup
 from critical.manipulator.formatters import DummyFormatter
 from critical.manipulator.static_filters import DummyStaticFilter
 from critical.manipulator.dynamic_filters import DummyDynamicFilter
@@ -16,8 +16,10 @@ async def test_handler(composer):
     await handler.start()
     gelf = composer.gelf()
     await handler.handle(gelf)
+    await handler.handle_batch([gelf, composer.gelf()])
     handler.static_filters = [DummyStaticFilter(False)]
     await handler.handle(gelf)
+    await handler.handle_batch([gelf])
     await handler.stop()
 
     valid_dict = {
@@ -32,6 +34,33 @@ async def test_handler(composer):
     handler = Handler.from_dict(valid_dict.copy())
     logging.error(valid_dict)
 
+    lazy_dict = {
+        'formatter': {'class': 'CopyFieldFormatter',
+                      'field': 'full_message_'},
+        'static_filters': [{'class': 'SourceIPFilter',
+                            'ips': ['127.0.0.1']}],
+        'senders': [{'class': 'DummySender'}],
+        'consumer_specification': 'consumer_spec',
+        'decoding': 'lazy'
+    }
+    handler = Handler.from_dict(lazy_dict)
+    assert handler.required_fields == {'_gl2_remote_ip', '_full_message'}
+    assert handler.decoder.fields == {'_gl2_remote_ip', '_full_message'}
+
+    adaptive_dict = {
+        'formatter': {'class': 'DummyFormatter'},
+        'static_filters': [{'class': 'DummyStaticFilter'},
+                           {'class': 'DummyStaticFilter', 'valid': False}],
+        'senders': [{'class': 'DummySender'}],
+        'consumer_specification': 'consumer_spec',
+        'adaptive_static_filters': {'interval': 2}
+    }
+    handler = Handler.from_dict(adaptive_dict)
+    assert handler.filter_chain.interval == 2
+    await handler.handle_batch([gelf, gelf, gelf])
+    assert handler.filter_chain.filters[0].valid is False
+    assert handler.stats()['static_filters'][0]['pass_rate'] == 0
+
     invalid_dict_formatter = {
         'formatter': {'class': 'InvalidClass'},
         'static_filters': [{'class': 'DummyStaticFilter'}],
@@ -75,3 +104,67 @@ async def test_handler(composer):
     }
     with pytest.raises(AttributeError):
         handler = Handler.from_dict(invalid_dict_sender)
+
+
+@pytest.mark.asyncio
+async def test_handler_group(composer):
+    def lazy_dict(field, spec='consumer_spec'):
+        return {
+            'formatter': {'class': 'CopyFieldFormatter', 'field': field},
+            'senders': [{'class': 'DummySender'}],
+            'consumer_specification': spec,
+            'decoding': 'lazy'
+        }
+
+    first = Handler.from_dict(lazy_dict('host'))
+    second = Handler.from_dict(lazy_dict('short_message'))
+    group = HandlerGroup([first, second], 'critical')
+    assert group.name == 'critical'
+    assert group.decoding == 'lazy'
+    # one decoder serves every handler
+    assert group.decoder.fields == {'host', 'short_message'}
+
+    received = []
+    received_acks = []
+
+    async def handle_batch(objs, acks=None):
+        received.append(objs)
+        received_acks.append(acks)
+
+    for handler in group.handlers:
+        handler.handle_batch = handle_batch
+    gelf = composer.gelf()
+    await group.handle_batch([gelf])
+    assert received == [[gelf], [gelf]]
+
+    async def failing_batch(objs, acks=None):
+        acks[0]()
+        raise RuntimeError('handler is broken')
+
+    # failing handler doesn't stop the next one, its part is done once
+    first.handle_batch = failing_batch
+    acked = []
+    await group.handle_batch([gelf, gelf], [lambda: acked.append(0),
+                                            lambda: acked.append(1)])
+    assert received == [[gelf], [gelf], [gelf, gelf]]
+    assert acked == []
+    for ack in received_acks[-1]:
+        ack()
+    assert acked == [0, 1]
+
+    full = Handler.from_dict({
+        'formatter': {'class': 'DummyFormatter'},
+        'senders': [{'class': 'DummySender'}],
+        'consumer_specification': 'consumer_spec'
+    })
+    group = HandlerGroup([first, full])
+    assert group.decoding == 'full'
+    assert group.required_fields is None
+    assert group.name == 'consumer_spec'
+    await group.start()
+    assert not group.saturated
+    assert await group.wait_drained(0.1)
+    await group.stop()
+
+    with pytest.raises(ValueError):
+        HandlerGroup([first, Handler.from_dict(lazy_dict('host', 'other'))])
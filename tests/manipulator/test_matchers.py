@@ -0,0 +1,45 @@
+import random
+
+from critical.manipulator.matchers import LiteralMatcher, RegexpRuleset
+
+
+def test_literal_matcher():
+    matcher = LiteralMatcher(['he', 'she', 'his', 'hers'])
+    assert matcher.find('ushers') == 'she'
+    assert matcher.find('ahis') == 'his'
+    assert matcher.find('sh') is None
+    assert matcher.search('hers') is True
+    assert matcher.search('xyz') is False
+
+    assert LiteralMatcher([]).search('anything') is False
+    assert LiteralMatcher(['']).search('anything') is True
+    assert LiteralMatcher(['', 'a']).search('anything') is True
+    assert LiteralMatcher(['single']).find('single pattern') == 'single'
+
+
+def test_literal_matcher_against_naive():
+    rnd = random.Random(0)
+    for _ in range(1000):
+        # regular expression syntax is matched literally
+        patterns = [''.join(rnd.choices('ab.(', k=rnd.randint(1, 4)))
+                    for _ in range(rnd.randint(1, 8))]
+        text = ''.join(rnd.choices('ab.(', k=rnd.randint(0, 16)))
+        expected = any(pattern in text for pattern in patterns)
+        matcher = LiteralMatcher(patterns)
+        assert matcher.search(text) is expected
+        found = matcher.find(text)
+        assert found in patterns and found in text if expected \
+            else found is None
+
+
+def test_regexp_ruleset():
+    ruleset = RegexpRuleset([r'\d{3}', r'inva[lid', r'(a)\1', r'(?i)HELLO',
+                             r'(?P<name>zz)', r'x|y'])
+    assert ruleset.combined.pattern == r'(?:\d{3})|(?:x|y)'
+    assert len(ruleset.regexps) == 3
+    assert ruleset.literals.patterns == ['inva[lid']
+    for text in ['123', 'inva[lid', 'baab', 'hello', 'zz', 'y']:
+        assert ruleset.search(text) is True
+    for text in ['12', 'invalid', 'ab', 'hell', 'z', 'nothing']:
+        assert ruleset.search(text) is False
+    assert RegexpRuleset([]).search('anything') is False
@@ -0,0 +1,134 @@
+import asyncio
+
+import pytest
+
+from critical.manipulator.consumers import KafkaAsyncConsumer
+from critical.manipulator.formatters import DummyFormatter
+from critical.manipulator.handler import Handler
+from critical.manipulator.metrics import (METRICS, Counter, Histogram,
+                                          Metrics, serve_metrics)
+from critical.manipulator.static_filters import (AdaptiveFilterChain,
+                                                 DummyStaticFilter)
+from critical.manipulator.dynamic_filters import DummyDynamicFilter
+from critical.manipulator.senders import DummySender
+from tests.manipulator.test_consumers import (FakeKafkaConsumer,
+                                              RecordingHandler)
+
+
+@pytest.fixture
+def metrics():
+    METRICS.__init__()
+    METRICS.enabled = True
+    yield METRICS
+    METRICS.__init__()
+
+
+def test_render():
+    counter = Counter('test_total', 'Test counter', ['name'])
+    counter.inc('a')
+    counter.inc('a', amount=2)
+    counter.inc('quoted "b"')
+    assert counter.render() == (
+        '# HELP test_total Test counter\n'
+        '# TYPE test_total counter\n'
+        'test_total{name="a"} 3\n'
+        'test_total{name="quoted \\"b\\""} 1')
+
+    histogram = Histogram('test_seconds', 'Test histogram', ['stage'],
+                          buckets=[0.1, 1])
+    histogram.observe(0.05, 'x', count=2)
+    histogram.observe(0.5, 'x')
+    histogram.observe(5, 'x')
+    assert histogram.samples() == [
+        'test_seconds_bucket{stage="x",le="0.1"} 2',
+        'test_seconds_bucket{stage="x",le="1.0"} 3',
+        'test_seconds_bucket{stage="x",le="+Inf"} 4',
+        'test_seconds_sum{stage="x"} 5.6',
+        'test_seconds_count{stage="x"} 4']
+
+
+@pytest.mark.asyncio
+async def test_handler_metrics(composer, metrics):
+    handler = Handler([DummyStaticFilter(True), DummyStaticFilter(False)],
+                      [DummyDynamicFilter()], DummyFormatter(),
+                      [DummySender([1, 2])], 'consumer_spec', name='test')
+    await handler.start()
+    await handler.handle_batch([composer.gelf(), composer.gelf()])
+    handler.static_filters = [DummyStaticFilter(True)]
+    await handler.handle_batch([composer.gelf()])
+    await handler.stop()
+    assert metrics.consumed.values == {('test',): 3}
+    assert metrics.filtered.values == {('test',): 2}
+    assert metrics.queued.values == {('test',): 1}
+    assert metrics.static_rejections.values == {
+        ('test', 'DummyStaticFilter#1'): 2}
+    assert metrics.dynamic_rejections.values == {
+        ('DummySender', 'DummyDynamicFilter'): 2}
+    stages = {labels[0] for labels in metrics.latency.values}
+    assert stages == {'filter', 'format', 'dynamic_filter'}
+
+    chain = AdaptiveFilterChain([DummyStaticFilter(True),
+                                 DummyStaticFilter(False)])
+    handler.filter_chain = chain
+    assert handler.rejected_by(composer.gelf()) == 'DummyStaticFilter#1'
+    chain.chain[1][0].valid = True
+    assert handler.rejected_by(composer.gelf()) is None
+
+
+@pytest.mark.asyncio
+async def test_consumer_metrics(metrics):
+    values = [f'v{index}'.encode() for index in range(5)]
+    fake = FakeKafkaConsumer(values)
+    consumer = KafkaAsyncConsumer(fake, 'topic', max_records=2,
+                                  timeout_ms=10, decoder=bytes.decode)
+    await consumer.start()
+    handler = RecordingHandler()
+    runner = asyncio.create_task(consumer.run(handler))
+    await asyncio.sleep(0.05)
+    runner.cancel()
+    await asyncio.gather(runner, return_exceptions=True)
+    await consumer.stop()
+    assert metrics.lag.values == {('topic', 0): 0}
+    counts, _ = metrics.latency.values[('decode',)]
+    assert sum(counts) == 5
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(metrics):
+    metrics.consumed.inc('test', amount=5)
+    server = await serve_metrics('127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = (await reader.read()).decode()
+        writer.close()
+        assert response.startswith('HTTP/1.1 200 OK')
+        assert 'critical_messages_consumed_total{handler="test"} 5' \
+            in response
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET / HTTP/1.1\r\n\r\n')
+        assert (await reader.read()).startswith(b'HTTP/1.1 404')
+        writer.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+    # other instance is served instead of global one
+    other = Metrics()
+    other.consumed.inc('other')
+    server = await serve_metrics('127.0.0.1', 0, metrics=other)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /metrics HTTP/1.1\r\n\r\n')
+        response = (await reader.read()).decode()
+        writer.close()
+        assert other.enabled
+        assert 'critical_messages_consumed_total{handler="other"} 1' \
+            in response
+        assert 'handler="test"' not in response
+    finally:
+        server.close()
+        await server.wait_closed()
@@ -0,0 +1,43 @@
+from critical.manipulator.handler import Handler
+from critical.manipulator.profiling import (end_to_end, format_report,
+                                            load_values, profile_stages,
+                                            stub_config)
+
+
+def test_profile(composer, tmp_path):
+    sample = tmp_path / 'sample.ndjson'
+    lines = [composer.message(short='Link down'),
+             composer.message(short='Link up'),
+             composer.message(short='Link down'), 'not json']
+    sample.write_text('\n'.join(lines))
+    assert len(load_values(sample)) == 4
+    assert len(load_values(sample, limit=2)) == 2
+
+    config = {'consumer_specification': 'test',
+              'formatter': {'class': 'DummyFormatter'},
+              'static_filters': [{'class': 'MessageBodyFilter',
+                                  'pattern': 'down'},
+                                 {'class': 'DummyStaticFilter',
+                                  'valid': True}],
+              'dynamic_filters': [{'class': 'DummyDynamicFilter'}],
+              'senders': [{'class': 'TerminalSender', 'receivers': [1]}]}
+    stubbed = stub_config(config)
+    assert stubbed['senders'] == [{'class': 'DummySender',
+                                   'receivers': [1]}]
+    assert stubbed['dynamic_filters'] == []
+    assert config['senders'][0]['class'] == 'TerminalSender'
+
+    values = load_values(sample)
+    stages = profile_stages(Handler.from_dict(stub_config(config)), values)
+    assert [stats.name for stats in stages] == [
+        'decode', 'MessageBodyFilter#0', 'DummyStaticFilter#1', 'format']
+    assert [(stats.calls, stats.passed) for stats in stages] == [
+        (4, 3), (3, 2), (3, 3), (2, 2)]
+
+    profile_path = tmp_path / 'handler.prof'
+    elapsed = end_to_end(stub_config(config), values, batch_size=2,
+                         profile_path=profile_path)
+    assert profile_path.stat().st_size > 0
+    report = format_report(stages, elapsed, len(values))
+    assert 'Cheapest static filters order: ' in report
+    assert 'Handler end to end: 4 messages' in report
@@ -0,0 +1,152 @@
+import asyncio
+import time
+
+import pytest
+
+from critical.manipulator.ratelimit import DeliveryScheduler, RetryLater
+from critical.manipulator.ratelimit import TokenBucket, pack_messages
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert bucket.take() is True
+    assert bucket.take() is True
+    assert bucket.take() is False
+    assert 0 < bucket.delay() <= 0.1
+
+    bucket.block(5)
+    assert bucket.delay() > 4
+    assert bucket.take() is False
+
+    bucket = TokenBucket(rate=10, capacity=2)
+    bucket.drain()
+    assert bucket.take() is False
+
+
+def test_pack_messages():
+    assert pack_messages(['a', 'b', 'c'], limit=10) == ['a\n\nb\n\nc']
+    assert pack_messages(['aaaa', 'bbbb', 'cc'], limit=10) == \
+        ['aaaa\n\nbbbb', 'cc']
+    packed = pack_messages(['line one\nline two\nline three'], limit=18)
+    assert packed == ['line one\nline two', 'line three']
+    packed = pack_messages(['x' * 25], limit=10)
+    assert packed == ['x' * 10, 'x' * 10, 'x' * 5]
+    assert all(len(text) <= 4096 for text in
+               pack_messages(['alert ' * 300] * 10, limit=4096))
+
+
+@pytest.mark.asyncio
+async def test_scheduler_coalesces():
+    delivered = []
+
+    async def deliver(destination, message):
+        delivered.append(message)
+        return True
+
+    scheduler = DeliveryScheduler(
+        deliver, TokenBucket(1000, 100),
+        lambda destination: TokenBucket(rate=1000, capacity=100),
+        linger=0.05, pack=lambda messages: pack_messages(messages, 10))
+    futures = [await scheduler.submit('chat', text)
+               for text in ('aaaa', 'bbbb', 'cc')]
+    assert await asyncio.gather(*futures) == [True] * 3
+    assert delivered == ['aaaa\n\nbbbb', 'cc']
+    await scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_isolates_destinations():
+    delivered = []
+    attempts = {}
+
+    async def deliver(destination, message):
+        attempts[message] = attempts.get(message, 0) + 1
+        if message == 'flood-0' and attempts[message] == 1:
+            raise RetryLater(0.2)
+        delivered.append((time.monotonic(), destination, message))
+        return True
+
+    def bucket_for(destination):
+        if destination == 'slow':
+            return TokenBucket(rate=5)
+        return TokenBucket(rate=1000, capacity=100)
+
+    scheduler = DeliveryScheduler(deliver, TokenBucket(1000, 100),
+                                  bucket_for)
+    start = time.monotonic()
+    futures = [await scheduler.submit('slow', f'flood-{index}')
+               for index in range(3)]
+    futures += [await scheduler.submit('fast', f'fast-{index}')
+                for index in range(10)]
+    assert await asyncio.gather(*futures[3:]) == [True] * 10
+    fast_done = time.monotonic() - start
+    # fast chat is not waiting for flooded one
+    assert fast_done < 0.1
+    assert scheduler.depth['slow'] > 0
+
+    assert await asyncio.gather(*futures[:3]) == [True] * 3
+    slow = [item for item in delivered if item[1] == 'slow']
+    assert [item[2] for item in slow] == ['flood-0', 'flood-1', 'flood-2']
+    # retry after 429 and rate of 5 per second
+    assert slow[0][0] - start >= 0.2
+    assert slow[2][0] - slow[0][0] >= 0.3
+    await scheduler.close()
+    assert not scheduler.tasks
+
+
+@pytest.mark.asyncio
+async def test_scheduler_close_timeout():
+    delivered = []
+
+    async def deliver(destination, message):
+        delivered.append(message)
+        return True
+
+    scheduler = DeliveryScheduler(deliver, TokenBucket(1000, 100),
+                                  lambda destination: TokenBucket(rate=2),
+                                  close_timeout=0.1)
+    futures = [await scheduler.submit('slow', str(index))
+               for index in range(5)]
+    start = time.monotonic()
+    await scheduler.close()
+    assert time.monotonic() - start < 0.3
+    # first message is delivered at once, the rest are dropped
+    assert delivered == ['0']
+    assert [future.result() for future in futures] == [True] + [None] * 4
+    assert not scheduler.tasks
+
+
+@pytest.mark.asyncio
+async def test_scheduler_overflow():
+    delivered = []
+
+    async def deliver(destination, message):
+        delivered.append((destination, message))
+        return True
+
+    def bucket_for(destination):
+        if destination == 'group':
+            return TokenBucket(rate=1 / 60)
+        return TokenBucket(rate=1000, capacity=100)
+
+    scheduler = DeliveryScheduler(deliver, TokenBucket(1000, 100),
+                                  bucket_for, queue_size=3)
+    futures = []
+    for index in range(10):
+        # submitting to flooded group never waits
+        futures.append(await asyncio.wait_for(
+            scheduler.submit('group', f'group-{index}'), 0.1))
+        futures.append(await asyncio.wait_for(
+            scheduler.submit('private', f'private-{index}'), 0.1))
+    private = await asyncio.wait_for(asyncio.gather(*futures[1::2]), 1)
+    assert private == [True] * 10
+    assert [message for destination, message in delivered
+            if destination == 'group'] == ['group-0']
+    # group-1 waits for token, group-7..9 are queued, the rest were
+    # dropped to make room for new ones
+    assert scheduler.depth['group'] == 3
+    results = [future.result() if future.done() else 'pending'
+               for future in futures[0::2]]
+    assert results == [True, 'pending'] + [None] * 5 + ['pending'] * 3
+    scheduler.close_timeout = 0
+    await scheduler.close()
@@ -0,0 +1,135 @@
+import asyncio
+import os
+
+import pytest
+
+from critical.manipulator.handler import Handler
+from critical.manipulator.reload import ConfigWatcher, ReloadableHandler
+from critical.manipulator.senders import DummySender
+
+
+def config(receivers=None, drop=True):
+    return {'formatter': {'class': 'DummyFormatter'},
+            'dynamic_filters': [{'class': 'DummyDynamicFilter',
+                                 'drop': drop}],
+            'senders': [{'class': 'DummySender',
+                         'receivers': receivers or [1]},
+                        {'class': 'DummySender',
+                         'receivers': receivers or [1]}],
+            'name': 'test',
+            'consumer_specification': 'consumer_spec'}
+
+
+class CountingSender(DummySender):
+    def __init__(self, receivers, **kwargs):
+        super().__init__(receivers, **kwargs)
+        self.started = self.stopped = 0
+
+    async def start(self):
+        self.started += 1
+
+    async def stop(self):
+        self.stopped += 1
+
+
+def test_reuse_components():
+    old = Handler.from_dict(config())
+    new = Handler.from_dict(config(), old)
+    # identical senders are reused one to one
+    assert new.senders == old.senders
+    assert new.senders[0] is not new.senders[1]
+    assert new.dynamic_filters == old.dynamic_filters
+    assert len(new.shared) == 3
+
+    changed = Handler.from_dict(config(receivers=[2], drop=False), new)
+    assert not set(changed.senders) & set(new.senders)
+    assert changed.dynamic_filters[0] is not new.dynamic_filters[0]
+    assert changed.shared == []
+
+
+@pytest.mark.asyncio
+async def test_swap(composer):
+    shared = CountingSender([1])
+    replaced = CountingSender([1])
+    old = Handler([], [], Handler.from_dict(config()).formatter,
+                  [shared, replaced], 'consumer_spec', 'old')
+    reloadable = ReloadableHandler(old)
+    await reloadable.start()
+    await reloadable.handle(composer.gelf())
+
+    added = CountingSender([1])
+    new = Handler([], [], old.formatter, [shared, added], 'consumer_spec',
+                  'new')
+    new.shared = [shared]
+    await reloadable.swap(new)
+    assert reloadable.target is new
+    assert reloadable.name == 'old'
+    assert (shared.started, shared.stopped) == (1, 0)
+    assert (replaced.started, replaced.stopped) == (1, 1)
+    assert (added.started, added.stopped) == (1, 0)
+
+    await reloadable.handle_batch([composer.gelf()])
+    assert isinstance(reloadable.decoder(composer.message().encode()),
+                      type(composer.gelf()))
+    await reloadable.stop()
+    assert shared.stopped == added.stopped == 1
+
+
+class BlockingTarget:
+    """Target whose batches wait, like handler waiting for queue room"""
+    consumer_specification = 'consumer_spec'
+    name = 'blocking'
+    components = []
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.handling = 0
+        self.stopped_while_handling = None
+
+    async def start(self):
+        pass
+
+    async def handle_batch(self, objs, acks=None):
+        self.handling += 1
+        await self.release.wait()
+        self.handling -= 1
+
+    async def stop(self, keep=()):
+        self.stopped_while_handling = self.handling
+
+
+@pytest.mark.asyncio
+async def test_swap_waits_for_calls():
+    old = BlockingTarget()
+    reloadable = ReloadableHandler(old)
+    handling = [asyncio.create_task(reloadable.handle_batch([]))
+                for _ in range(2)]
+    await asyncio.sleep(0.01)
+
+    new = BlockingTarget()
+    swapping = asyncio.create_task(reloadable.swap(new))
+    await asyncio.sleep(0.01)
+    # next messages go to new target, old one is not stopped yet
+    assert reloadable.target is new
+    assert not swapping.done()
+
+    old.release.set()
+    await asyncio.wait_for(swapping, 1)
+    await asyncio.gather(*handling)
+    assert old.stopped_while_handling == 0
+    assert reloadable.calls == {}
+
+
+def test_config_watcher(tmp_path):
+    first = tmp_path / 'first.yaml'
+    first.write_text('name: first')
+    watcher = ConfigWatcher(lambda: sorted(tmp_path.glob('*.yaml')))
+    assert not watcher.changed()
+    stat = first.stat()
+    os.utime(first, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert watcher.changed()
+    assert not watcher.changed()
+    (tmp_path / 'second.yaml').write_text('name: second')
+    assert watcher.changed()
+    first.unlink()
+    assert watcher.changed()
@@ -1,12 +1,15 @@
 import asyncio
 import datetime
+import time
 import pytest
+from aiosmtplib import SMTPServerDisconnected
 from aiogram.methods import SendMessage
 from aiogram.types import Chat, Message
 
 from critical.manipulator.dynamic_filters import AbstractDynamicFilter
 from critical.manipulator.senders import TelegramSender
 from critical.manipulator.senders import MailSender
+from critical.manipulator.senders import DummySender
 
 
 class DummyFilter(AbstractDynamicFilter):
@@ -22,6 +25,55 @@ class DummyFilter(AbstractDynamicFilter):
         return self.valid
 
 
+class FakeSMTP:
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.is_connected = False
+        self.connects = 0
+        self.noops = 0
+        self.drop_next = False
+        self.sent = []
+
+    async def connect(self):
+        self.connects += 1
+        self.is_connected = True
+
+    async def noop(self):
+        self.noops += 1
+
+    def close(self):
+        self.is_connected = False
+
+    async def sendmail(self, sender, receivers, message):
+        if self.drop_next:
+            self.drop_next = False
+            raise SMTPServerDisconnected('Connection lost')
+        await asyncio.sleep(self.delay)
+        self.sent.append((receivers, message))
+        return {}, 'OK'
+
+
+class KeyFilter(AbstractDynamicFilter):
+    def __init__(self, keys):
+        self.keys = keys
+
+    @classmethod
+    def from_dict(cls, settings: dict):
+        return KeyFilter(settings.get('keys', []))
+
+    async def filter(self, message: str, key: str) -> bool:
+        return key in self.keys
+
+
+@pytest.mark.asyncio
+async def test_unfiltered_receivers():
+    sender = DummySender([1, 2, 3, 4])
+    sender.prefix = 'tg_'
+    assert await sender.unfiltered_receivers('test') == [1, 2, 3, 4]
+    filters = [KeyFilter(['tg_1']), KeyFilter(['tg_3', 'tg_1'])]
+    assert await sender.unfiltered_receivers('test', filters) == [2, 4]
+
+
 @pytest.mark.asyncio
 async def test_telegram_sender(telegram_bot, telegram_chat_ids, telegram_creds):
     sender = TelegramSender(telegram_bot, telegram_chat_ids)
@@ -109,3 +161,97 @@ async def test_mail_sender(smtp_creds, mail_creds):
     await sender.send_one('Test message', mail_creds['receivers'][0])
     await sender.stop()
     await asyncio.sleep(0.5)
+
+
+@pytest.mark.asyncio
+async def test_mail_sender_pool():
+    sender = MailSender(FakeSMTP(0.1), 'critical@example.com',
+                        ['a@example.com', 'b@example.com'])
+    sender.pool.clients.append(FakeSMTP(0.1))
+    sender.pool.idle.put_nowait(sender.pool.clients[1])
+    await sender.start()
+    assert all(client.is_connected for client in sender.pool.clients)
+
+    start = time.monotonic()
+    await asyncio.gather(sender.send_one('test', 'a@example.com'),
+                         sender.send_one('test', 'b@example.com'))
+    # both mails are sent concurrently by two connections
+    assert time.monotonic() - start < 0.15
+    assert [len(client.sent) for client in sender.pool.clients] == [1, 1]
+
+    # idle connection is checked before use
+    sender.pool.keepalive = 0
+    await sender.send_one('test', 'a@example.com')
+    assert sum(client.noops for client in sender.pool.clients) == 1
+    await sender.stop()
+    assert not any(client.is_connected for client in sender.pool.clients)
+
+    # dropped connection is reopened and sending is retried
+    smtp = FakeSMTP()
+    sender = MailSender(smtp, 'critical@example.com', ['a@example.com'])
+    await sender.start()
+    smtp.drop_next = True
+    await sender.send('test')
+    assert len(smtp.sent) == 1
+    assert smtp.connects == 2
+    await sender.stop()
+
+
+@pytest.mark.asyncio
+async def test_mail_sender_transactions():
+    smtp = FakeSMTP()
+    receivers = ['a@example.com', 'b@example.com', 'c@example.com']
+    sender = MailSender(smtp, 'critical@example.com', receivers)
+    await sender.start()
+    await sender.send('Subject: test\n\nbody',
+                      [KeyFilter(['mail_c@example.com'])])
+    # one transaction with multiple RCPT TO, filtered receiver is skipped
+    assert len(smtp.sent) == 1
+    assert smtp.sent[0][0] == receivers[:2]
+    await sender.stop()
+
+    smtp = FakeSMTP()
+    sender = MailSender(smtp, 'critical@example.com', receivers,
+                        digest_window=0.1)
+    await sender.start()
+    await sender.send('first')
+    await sender.send('second', [KeyFilter(['mail_c@example.com'])])
+    assert not smtp.sent
+    await asyncio.sleep(0.15)
+    # receivers with the same alerts share digest transaction
+    assert sorted(len(item[0]) for item in smtp.sent) == [1, 2]
+    digest = dict((tuple(item[0]), item[1]) for item in smtp.sent)
+    assert 'Subject: Critical Bot Message: 2 alert(s)' in \
+        digest[tuple(receivers[:2])]
+    assert 'first' in digest[(receivers[2],)]
+    assert 'second' not in digest[(receivers[2],)]
+
+    await sender.send('third')
+    await sender.stop()
+    # pending digests are flushed on stop
+    assert len(smtp.sent) == 3
+
+
+@pytest.mark.asyncio
+async def test_mail_sender_digest_interrupted():
+    smtp = FakeSMTP(0.1)
+    receivers = ['a@example.com', 'b@example.com', 'c@example.com']
+    sender = MailSender(smtp, 'critical@example.com', receivers,
+                        digest_window=0.05)
+    await sender.start()
+    first = await sender.send('first')
+    await sender.send('second', [KeyFilter(['mail_c@example.com'])])
+    await asyncio.sleep(0.07)
+    # digest loop is sending, new alerts go to the next digest
+    third = await sender.send('third')
+    assert first != third
+    await sender.stop()
+    await asyncio.sleep(0)
+    # interrupted digests are sent on stop, together with the next one
+    assert first[0].done() and third[0].done()
+    digest = dict((tuple(item[0]), item[1]) for item in smtp.sent)
+    assert len(smtp.sent) == 2
+    assert all(text in digest[tuple(receivers[:2])]
+               for text in ('first', 'second', 'third'))
+    assert 'first' in digest[(receivers[2],)]
+    assert 'third' in digest[(receivers[2],)]
@@ -1,6 +1,9 @@
+from critical.manipulator.models import CompactGELFMessage
 from critical.manipulator.static_filters import SourceIPFilter
 from critical.manipulator.static_filters import MessageBodyFilter
 from critical.manipulator.static_filters import MessageBodyAnyFilter
+from critical.manipulator.static_filters import AdaptiveFilterChain
+from critical.manipulator.static_filters import DummyStaticFilter
 
 
 def test_source_ip_filter(composer):
@@ -43,6 +46,36 @@ def test_source_ip_filter(composer):
     assert current_filter.filter(message_exclude_2) is False
 
 
+def test_source_ip_filter_index(composer):
+    current_filter = SourceIPFilter(prefixes=['10.0.0.0/8', '10.1.0.0/16',
+                                              '11.0.0.0/8', '2001:db8::/32'],
+                                    ips=['192.168.0.1', '192.168.0.2',
+                                         '::1'])
+    assert current_filter.index[4] == ([0x0a000000, 0xc0a80001],
+                                       [0x0bffffff, 0xc0a80002])
+    assert len(current_filter.index[6][0]) == 2
+    for ip_address in ['10.0.0.0', '11.255.255.255', '192.168.0.2',
+                       '2001:db8::1', '::1']:
+        message = composer.gelf(ip_address=ip_address)
+        assert current_filter.filter(message) is True
+    for ip_address in ['9.255.255.255', '12.0.0.0', '192.168.0.3',
+                       '2001:db9::1', '::2']:
+        message = composer.gelf(ip_address=ip_address)
+        assert current_filter.filter(message) is False
+
+    message = CompactGELFMessage(composer.message_dict(ip_address='::1'))
+    assert current_filter.filter(message) is True
+    message = CompactGELFMessage(composer.message_dict(ip_address='12.0.0.1'))
+    assert current_filter.filter(message) is False
+
+    current_filter = SourceIPFilter(prefixes=[f'10.{i}.{j}.0/24'
+                                              for i in range(0, 256, 2)
+                                              for j in range(256)])
+    assert len(current_filter.index[4][0]) == 128
+    assert current_filter.filter(composer.gelf(ip_address='10.2.3.4'))
+    assert not current_filter.filter(composer.gelf(ip_address='10.3.3.4'))
+
+
 def test_message_body_filter(composer):
     current_filter = MessageBodyFilter(pattern='text')
     message_include = composer.gelf(short='message with good text')
@@ -79,6 +112,17 @@ def test_message_body_any_filter(composer):
     assert current_filter.filter(message_exclude_2) is False
     assert current_filter.filter(message_exclude_3) is False
 
+    current_filter = MessageBodyAnyFilter(patterns=['one', 'two'],
+                                          field='host')
+    assert current_filter.required_fields == {'host'}
+    assert current_filter.filter(composer.gelf(hostname='one.example.com'))
+    assert not current_filter.filter(composer.gelf(hostname='example.com',
+                                                   short='one'))
+
+    current_filter = MessageBodyFilter(pattern='one', field='_full_message')
+    assert current_filter.required_fields == {'_full_message'}
+    assert current_filter.filter(composer.gelf(short='one'))
+
     current_filter = SourceIPFilter.from_dict({
         'prefixes': ['10.0.0.0/8', '192.168.0.0/16'],
         'ips': ['127.0.0.1']
@@ -91,4 +135,32 @@ def test_message_body_any_filter(composer):
 
     current_filter = MessageBodyAnyFilter.from_dict({
         'patterns': ['test', 'another']
-    })
\ No newline at end of file
+    })
+
+
+def test_adaptive_filter_chain(composer):
+    allowing = MessageBodyAnyFilter(patterns=['one', 'two'])
+    denying = SourceIPFilter(prefixes=['10.0.0.0/8'], exclude=True)
+    passing = DummyStaticFilter(True)
+    chain = AdaptiveFilterChain([passing, allowing, denying], interval=10)
+    assert chain.filters == [passing, allowing, denying]
+
+    messages = [composer.gelf(ip_address='10.0.0.1', short='one'),
+                composer.gelf(ip_address='10.0.0.1', short='two'),
+                composer.gelf(ip_address='192.168.0.1', short='one'),
+                composer.gelf(ip_address='192.168.0.1', short='three'),
+                composer.gelf(ip_address='10.0.0.1', short='one')]
+    expected = [False, False, True, False, False]
+    for _ in range(2):
+        assert [chain.filter(msg) for msg in messages] == expected
+    # filter that passes everything is useless to run first
+    assert chain.filters[-1] is passing
+    assert chain.filters[0] is denying
+    assert [chain.filter(msg) for msg in messages] == expected
+
+    stats = chain.dump()
+    assert [item['filter'] for item in stats] == ['SourceIPFilter#2',
+                                                   'MessageBodyAnyFilter#1',
+                                                   'DummyStaticFilter#0']
+    assert stats[0]['pass_rate'] < 1
+    assert stats[-1]['pass_rate'] == 1
@@ -0,0 +1,64 @@
+import logging
+import threading
+import time
+
+from critical.manipulator.supervisor import Supervisor, merge_stats
+
+
+def crashing_target(message: str, on_stats=None, worker=0):
+    logging.getLogger('critical.main').error(message)
+    on_stats([{'handler': 'test', 'static_filters': [],
+               'queue_depth': {'DummySender#0': 1}}])
+    time.sleep(0.2)
+    raise SystemExit(1)
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append(record)
+
+
+def test_merge_stats():
+    report = [{'handler': 'test',
+               'static_filters': [{'filter': 'SourceIPFilter#0',
+                                   'calls': 100, 'pass_rate': 0.5,
+                                   'mean_cost_us': 1.0}],
+               'queue_depth': {'TelegramSender#0': 3}}]
+    other = [{'handler': 'test',
+              'static_filters': [{'filter': 'SourceIPFilter#0',
+                                  'calls': 300, 'pass_rate': 0.1,
+                                  'mean_cost_us': 3.0}],
+              'queue_depth': {'TelegramSender#0': 2}}]
+    merged = merge_stats([report, other])
+    assert merged == [{'handler': 'test',
+                       'workers': 2,
+                       'static_filters': [{'filter': 'SourceIPFilter#0',
+                                           'calls': 400,
+                                           'pass_rate': 0.2,
+                                           'mean_cost_us': 2.5}],
+                       'queue_depth': {'TelegramSender#0': 5}}]
+    assert merge_stats([]) == []
+
+
+def test_supervisor_restarts_workers():
+    handler = ListHandler()
+    supervisor = Supervisor(crashing_target, ('hello',), workers=2,
+                            level_name='INFO', restart_delay=0.1,
+                            handlers=[handler])
+    thread = threading.Thread(target=supervisor.run)
+    thread.start()
+    deadline = time.monotonic() + 30
+    while supervisor.restarts < 2 and time.monotonic() < deadline:
+        time.sleep(0.1)
+    supervisor.stop()
+    thread.join()
+    assert supervisor.restarts >= 2
+    assert not any(process.is_alive()
+                   for process in supervisor.processes.values())
+    names = {record.name for record in handler.records
+             if record.getMessage() == 'hello'}
+    assert {'critical.main#0', 'critical.main#1'} <= names